@@ -0,0 +1,218 @@
+"""
+Load test of the two serving modes side by side: gunicorn with the Flask
+app, and uvicorn with the ASGI app from hrs_asgi. Every one of --connections
+keep-alive connections polls the status of a patient for --duration
+seconds, and latency and throughput are reported per server. Start both
+against the same storage first, e.g.:
+
+    HRS_WORKERS=4 HRS_BIND=127.0.0.1:5000 gunicorn -c gunicorn.conf.py
+    uvicorn --factory hrs_asgi:create_asgi_app --workers 4 --port 8000
+    python benchmarks/bench_asgi.py --url http://127.0.0.1:5000 \\
+        --url http://127.0.0.1:8000 --connections 2000
+
+Sync gunicorn workers serve one connection each at a time, so most
+connections wait. The event loop keeps them all open. --in-process drives
+the ASGI app directly without sockets to measure the adapter alone, offline
+on the memory backend.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+PATIENT_ID = "bench_asgi"
+
+
+def percentile(values, q):
+    """
+    Gets a percentile of latencies.
+    Args:
+        values (list): Sorted latencies.
+        q (float): Percentile, 0 to 100.
+
+    Returns:
+        float: The percentile, None if there are no values.
+    """
+    if not values:
+        return None
+    return values[min(int(len(values) * q / 100), len(values) - 1)]
+
+
+class Connection(object):
+    """
+    Keep-alive HTTP/1.1 connection, reopened when the server closes it.
+    Responses must have a Content-Length.
+    """
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.netloc = parts.netloc
+        self.reader = self.writer = None
+
+    async def request(self, method, path, body=None):
+        """
+        Sends one request and reads the response.
+        Returns:
+            tuple: Status code and body.
+        """
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(
+                self.host, self.port)
+        data = b"" if body is None else json.dumps(body).encode()
+        self.writer.write(
+            "{} {} HTTP/1.1\r\nHost: {}\r\nContent-Type: application/json"
+            "\r\nContent-Length: {}\r\n\r\n".format(
+                method, path, self.netloc, len(data)).encode() + data)
+        await self.writer.drain()
+        head = await self.reader.readuntil(b"\r\n\r\n")
+        lines = head.decode("latin-1").split("\r\n")
+        headers = dict(line.lower().split(": ", 1) for line in lines[1:] if line)
+        body = await self.reader.readexactly(int(headers["content-length"]))
+        if headers.get("connection") == "close" or \
+                lines[0].startswith("HTTP/1.0"):
+            self.close()
+        return int(lines[0].split(" ")[1]), body
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+
+async def poll_http(url, connections, duration):
+    """
+    Polls the status of the patient over connections keep-alive
+    connections for duration seconds.
+    Returns:
+        tuple: Sorted latencies in ms, errors, and connections refused.
+    """
+    latencies = []
+    errors = [0, 0]
+
+    async def client():
+        connection = Connection(url)
+        deadline = time.perf_counter() + duration
+        try:
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                status, _ = await connection.request(
+                    "GET", "/api/status/{}".format(PATIENT_ID))
+                latencies.append((time.perf_counter() - start) * 1000)
+                if status != 200:
+                    errors[0] += 1
+        except ConnectionRefusedError:
+            errors[1] += 1
+        except (OSError, asyncio.IncompleteReadError):
+            errors[0] += 1
+        finally:
+            connection.close()
+
+    await asyncio.gather(*(client() for _ in range(connections)))
+    return sorted(latencies), errors[0], errors[1]
+
+
+async def seed_http(url):
+    """
+    Creates the polled patient with one heart rate.
+    """
+    connection = Connection(url)
+    await connection.request("POST", "/api/new_patient",
+                             {"patient_id": PATIENT_ID,
+                              "attending_email": "bench@duke.edu",
+                              "user_age": 30})
+    await connection.request("POST", "/api/heart_rate",
+                             {"patient_id": PATIENT_ID, "heart_rate": 80})
+    connection.close()
+
+
+async def poll_in_process(app, connections, duration):
+    """
+    Polls the status of the patient through the ASGI app without sockets,
+    connections requests at a time.
+    Returns:
+        tuple: Sorted latencies in ms, errors, and connections refused.
+    """
+    latencies = []
+    errors = [0]
+
+    async def request(method, path, body=None):
+        data = b"" if body is None else json.dumps(body).encode()
+        scope = {"type": "http", "method": method, "path": path,
+                 "query_string": b"",
+                 "headers": [(b"content-type", b"application/json")]}
+        sent = []
+
+        async def receive():
+            return {"type": "http.request", "body": data}
+
+        async def send(message):
+            sent.append(message)
+
+        await app(scope, receive, send)
+        return sent[0]["status"]
+
+    async def client():
+        deadline = time.perf_counter() + duration
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            status = await request("GET", "/api/status/{}".format(PATIENT_ID))
+            latencies.append((time.perf_counter() - start) * 1000)
+            if status != 200:
+                errors[0] += 1
+
+    await request("POST", "/api/new_patient",
+                  {"patient_id": PATIENT_ID,
+                   "attending_email": "bench@duke.edu", "user_age": 30})
+    await request("POST", "/api/heart_rate",
+                  {"patient_id": PATIENT_ID, "heart_rate": 80})
+    await asyncio.gather(*(client() for _ in range(connections)))
+    return sorted(latencies), errors[0], 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", action="append", default=[],
+                        help="Server to load, repeat to compare servers.")
+    parser.add_argument("--in-process", action="store_true",
+                        help="Drive the ASGI app directly, on the memory "
+                             "backend.")
+    parser.add_argument("--connections", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--threads", type=int, default=32,
+                        help="Threads of the ASGI app with --in-process.")
+    args = parser.parse_args()
+    if not args.url and not args.in_process:
+        parser.error("give --url or --in-process")
+
+    runs = []
+    for url in args.url:
+        asyncio.run(seed_http(url))
+        runs.append((url, asyncio.run(
+            poll_http(url, args.connections, args.duration))))
+    if args.in_process:
+        os.environ["HRS_STORAGE"] = "memory"
+        from hrs_asgi import ASGIApp
+        from heart_rate_sentinel_server import create_app
+        app = ASGIApp(create_app({"storage": "memory"}), args.threads)
+        runs.append(("in-process", asyncio.run(
+            poll_in_process(app, args.connections, args.duration))))
+        app.executor.shutdown()
+
+    print("{:>28} {:>9} {:>9} {:>9} {:>9} {:>7} {:>8}".format(
+        "server", "req/s", "p50 ms", "p95 ms", "p99 ms", "errors", "refused"))
+    for name, (latencies, errors, refused) in runs:
+        print("{:>28} {:>9.0f} {:>9.2f} {:>9.2f} {:>9.2f} {:>7} {:>8}".format(
+            name, len(latencies) / args.duration, percentile(latencies, 50),
+            percentile(latencies, 95), percentile(latencies, 99), errors,
+            refused))
+
+
+if __name__ == "__main__":
+    main()
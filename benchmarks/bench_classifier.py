@@ -0,0 +1,46 @@
+"""
+Compares classifying many (age, heart rate) pairs one at a time with the
+scalar is_tachycardic against one vectorized classify call. Runs in
+memory, no database needed.
+
+    python benchmarks/bench_classifier.py
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from hrs_classifier import classify, is_tachycardic  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", default="1000,100000,1000000")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print("{:>10} {:>12} {:>12} {:>8}".format(
+        "samples", "scalar ms", "vector ms", "speedup"))
+    for size in (int(s) for s in args.sizes.split(",")):
+        ages = rng.integers(0, 90, size)
+        heart_rates = rng.integers(40, 200, size)
+        age_list, hr_list = ages.tolist(), heart_rates.tolist()
+
+        start = time.perf_counter()
+        scalar = [is_tachycardic(age, hr) for age, hr in zip(age_list, hr_list)]
+        scalar_ms = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        vector = classify(ages, heart_rates)
+        vector_ms = (time.perf_counter() - start) * 1000
+
+        assert vector.tolist() == scalar
+        print("{:>10} {:>12.2f} {:>12.2f} {:>7.0f}x".format(
+            size, scalar_ms, vector_ms, scalar_ms / vector_ms))
+
+
+if __name__ == "__main__":
+    main()
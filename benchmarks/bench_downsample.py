@@ -0,0 +1,62 @@
+"""
+Compares the json payload and time of returning a day of raw samples
+against bucketed (min/max/mean) and LTTB downsampling to a few hundred
+points, as a chart would ask for. Runs in memory, no database needed.
+
+    python benchmarks/bench_downsample.py
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from hrs_downsample import aggregate, lttb  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--samples", type=int, default=86400,
+                        help="Samples in the window, one per second by default.")
+    parser.add_argument("--points", type=int, default=500)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    timestamps = np.arange(args.samples, dtype=np.int64) * 86400 * 10 ** 6 \
+        // args.samples
+    heart_rates = (80 + 20 * np.sin(np.arange(args.samples) / 3600) +
+                   rng.normal(0, 5, args.samples)).astype(np.int64)
+    width = -(-86400 * 10 ** 6 // args.points)
+
+    start = time.perf_counter()
+    raw = json.dumps(heart_rates.tolist())
+    raw_ms = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    starts, counts, sums, mins, maxs = aggregate(
+        timestamps, np.ones_like(heart_rates), heart_rates, heart_rates,
+        heart_rates, width)
+    bucketed = json.dumps([
+        {"start": int(s), "count": int(c), "mean": int(t) / int(c),
+         "min": int(lo), "max": int(hi)}
+        for s, c, t, lo, hi in zip(starts, counts, sums, mins, maxs)])
+    bucket_ms = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    kept = lttb(timestamps, heart_rates, args.points)
+    reduced = json.dumps([{"timestamp": int(timestamps[i]),
+                           "heart_rate": int(heart_rates[i])} for i in kept])
+    lttb_ms = (time.perf_counter() - start) * 1000
+
+    print("{:>10} {:>12} {:>10}".format("series", "bytes", "ms"))
+    for name, payload, ms in (("raw", raw, raw_ms),
+                              ("bucket", bucketed, bucket_ms),
+                              ("lttb", reduced, lttb_ms)):
+        print("{:>10} {:>12} {:>10.2f}".format(name, len(payload), ms))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Compares heart rate ingestion throughput of POST /api/heart_rate against
+POST /api/heart_rate/batch, in process through the flask test client.
+Needs a scratch mongo database, which gets wiped! --storage memory
+or --storage sqlite measure those backends instead, offline.
+
+    python benchmarks/bench_ingest.py --url mongodb://localhost:27017/hrs_bench
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import heart_rate_sentinel_server as server  # noqa: E402
+from hrs_memory_db import MemoryDatabase  # noqa: E402
+from hrs_sqlite_db import SQLiteDatabase  # noqa: E402
+
+
+def add_patients(client, n_patients):
+    """
+    Creates the patients that samples get posted to.
+    Args:
+        client: Flask test client.
+        n_patients (int): Number of patients to create.
+
+    Returns:
+        list: IDs of the created patients.
+    """
+    patient_ids = ["bench{}".format(i) for i in range(n_patients)]
+    for patient_id in patient_ids:
+        client.post("/api/new_patient", json={
+            "patient_id": patient_id,
+            "attending_email": "bench@duke.edu",
+            "user_age": 21,
+        })
+    return patient_ids
+
+
+def bench_single(client, patient_ids, n_samples):
+    """
+    Posts samples one request at a time.
+    Returns:
+        float: Samples per second.
+    """
+    start = time.perf_counter()
+    for i in range(n_samples):
+        client.post("/api/heart_rate", json={
+            "patient_id": patient_ids[i % len(patient_ids)],
+            "heart_rate": 60 + i % 40,
+        })
+    return n_samples / (time.perf_counter() - start)
+
+
+def bench_batch(client, patient_ids, n_samples, batch_size):
+    """
+    Posts samples batch_size records at a time.
+    Returns:
+        float: Samples per second.
+    """
+    start = time.perf_counter()
+    for lo in range(0, n_samples, batch_size):
+        records = [{
+            "patient_id": patient_ids[i % len(patient_ids)],
+            "heart_rate": 60 + i % 40,
+        } for i in range(lo, min(lo + batch_size, n_samples))]
+        client.post("/api/heart_rate/batch", json={"records": records})
+    return n_samples / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", default="mongodb://localhost:27017/hrs_bench")
+    parser.add_argument("--storage", default="mongo",
+                        choices=("mongo", "memory", "sqlite"))
+    parser.add_argument("--sqlite-path", default="bench.sqlite3",
+                        help="Scratch SQLite file, removed afterwards.")
+    parser.add_argument("--patients", type=int, default=100)
+    parser.add_argument("--samples", type=int, default=5000)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    if args.storage == "memory":
+        server.patients = MemoryDatabase()
+    elif args.storage == "sqlite":
+        server.patients = SQLiteDatabase(args.sqlite_path)
+    else:
+        from hrs_db import HRDatabase, HRBucket, Patient
+        server.patients = HRDatabase(args.url)
+        Patient._mongometa.collection.delete_many({})
+        HRBucket._mongometa.collection.delete_many({})
+    client = server.get_app().test_client()
+    patient_ids = add_patients(client, args.patients)
+
+    single = bench_single(client, patient_ids, args.samples)
+    batch = bench_batch(client, patient_ids, args.samples, args.batch_size)
+    print("single: {:>12.0f} samples/s".format(single))
+    print("batch:  {:>12.0f} samples/s ({:.0f}x)".format(batch, batch / single))
+    if args.storage == "mongo":
+        Patient._mongometa.collection.delete_many({})
+        HRBucket._mongometa.collection.delete_many({})
+    elif args.storage == "sqlite":
+        server.patients.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(args.sqlite_path + suffix):
+                os.remove(args.sqlite_path + suffix)
+
+
+if __name__ == "__main__":
+    main()
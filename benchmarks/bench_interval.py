@@ -0,0 +1,52 @@
+"""
+Measures IntervalIndex query latency over random windows as the number of
+samples of a patient grows. Runs in memory, no database needed.
+
+    python benchmarks/bench_interval.py
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from hrs_index import IntervalIndex  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", default="1000,100000,1000000,10000000")
+    parser.add_argument("--queries", type=int, default=10000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print("{:>10} {:>10} {:>10} {:>12}".format(
+        "samples", "build s", "query us", "append us"))
+    for size in (int(s) for s in args.sizes.split(",")):
+        # one sample per second
+        timestamps = np.arange(size, dtype=np.int64) * 1000000
+        heart_rates = rng.integers(40, 200, size)
+
+        start = time.perf_counter()
+        index = IntervalIndex(timestamps, heart_rates)
+        build = time.perf_counter() - start
+
+        windows = np.sort(rng.integers(0, size * 1000000, (args.queries, 2)))
+        start = time.perf_counter()
+        for since, until in windows:
+            index.query(since, until)
+        query = (time.perf_counter() - start) / args.queries * 1e6
+
+        start = time.perf_counter()
+        for i in range(1000):
+            index.extend([(size + i) * 1000000], [80])
+        append = (time.perf_counter() - start) / 1000 * 1e6
+
+        print("{:>10} {:>10.3f} {:>10.1f} {:>12.1f}".format(
+            size, build, query, append))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Measures per-request lookup latency of HRDatabase as the patient
+collection grows. Needs a scratch mongo database, which gets wiped!
+--storage memory measures the in memory backend instead, offline.
+--cache-size puts the patient metadata cache in front, as the server does.
+
+    python benchmarks/bench_lookup.py --url mongodb://localhost:27017/hrs_bench
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from hrs_memory_db import MemoryDatabase  # noqa: E402
+from hrs_cache import CachedStorage, LRUCache  # noqa: E402
+
+
+def seed(collection, start, stop, chunk=10000):
+    """
+    Inserts patients with IDs in [start, stop) directly through pymongo.
+    Args:
+        collection: Patient collection.
+        start (int): First ID to insert.
+        stop (int): One past the last ID to insert.
+        chunk (int): Documents per insert_many call.
+    """
+    for lo in range(start, stop, chunk):
+        hi = min(lo + chunk, stop)
+        collection.insert_many([{
+            "_id": str(i),
+            "attending_email": "bench@duke.edu",
+            "user_age": 21,
+        } for i in range(lo, hi)], ordered=False)
+
+
+def seed_memory(database, start, stop):
+    """
+    Adds patients with IDs in [start, stop) to an in memory database.
+    Args:
+        database (MemoryDatabase): Database to seed.
+        start (int): First ID to insert.
+        stop (int): One past the last ID to insert.
+    """
+    for i in range(start, stop):
+        database.add_patient({"patient_id": str(i),
+                              "attending_email": "bench@duke.edu",
+                              "user_age": 21})
+
+
+def time_lookups(database, n_patients, n_lookups):
+    """
+    Times random get_patient calls.
+    Args:
+        database (HRDatabase): Database under test.
+        n_patients (int): Number of patients currently seeded.
+        n_lookups (int): Number of lookups to time.
+
+    Returns:
+        list: Latency of each lookup in milliseconds.
+    """
+    latencies = []
+    for _ in range(n_lookups):
+        patient_id = random.randrange(n_patients)
+        start = time.perf_counter()
+        database.get_patient(patient_id)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return sorted(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", default="mongodb://localhost:27017/hrs_bench")
+    parser.add_argument("--storage", default="mongo", choices=("mongo", "memory"))
+    parser.add_argument("--sizes", default="1000,10000,100000,1000000")
+    parser.add_argument("--lookups", type=int, default=1000)
+    parser.add_argument("--cache-size", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.storage == "memory":
+        database = MemoryDatabase()
+        collection = None
+    else:
+        from hrs_db import HRDatabase, Patient
+        database = HRDatabase(args.url)
+        collection = Patient._mongometa.collection
+        collection.delete_many({})
+    if args.cache_size:
+        database = CachedStorage(database, LRUCache(args.cache_size))
+
+    seeded = 0
+    print("{:>10} {:>10} {:>10} {:>10}".format(
+        "patients", "p50 ms", "p95 ms", "p99 ms"))
+    for size in sorted(int(s) for s in args.sizes.split(",")):
+        if collection is None:
+            seed_memory(database, seeded, size)
+        else:
+            seed(collection, seeded, size)
+        seeded = size
+        lat = time_lookups(database, size, args.lookups)
+        print("{:>10} {:>10.3f} {:>10.3f} {:>10.3f}".format(
+            size,
+            lat[len(lat) // 2],
+            lat[int(len(lat) * 0.95)],
+            lat[int(len(lat) * 0.99)]))
+    if args.cache_size:
+        print("cache:", database.cache.metrics())
+    if collection is not None:
+        collection.delete_many({})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Measures what the metrics of hrs_metrics cost per request: the same status
+polls and heart rate posts are timed with "metrics" on and off, in process
+on the memory backend, where requests are cheapest and the overhead shows
+the most. Runs alternate to even out noise, and the best run counts.
+
+    python benchmarks/bench_metrics.py
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ["HRS_STORAGE"] = "memory"
+
+import heart_rate_sentinel_server as server  # noqa: E402
+from hrs_metrics import Histogram  # noqa: E402
+
+
+def run(enabled, requests):
+    """
+    Times requests with metrics on or off.
+    Args:
+        enabled (bool): Whether or not metrics are kept.
+        requests (int): Requests of each kind.
+
+    Returns:
+        dict: Microseconds per request by kind.
+    """
+    app = server.create_app({"storage": "memory", "metrics": enabled})
+    client = app.test_client()
+    client.post("/api/new_patient", json={"patient_id": "bench",
+                                          "attending_email": "b@duke.edu",
+                                          "user_age": 30})
+    client.post("/api/heart_rate", json={"patient_id": "bench",
+                                         "heart_rate": 80})
+    timings = {}
+
+    start = time.perf_counter()
+    for _ in range(requests):
+        client.get("/api/status/bench")
+    timings["status"] = (time.perf_counter() - start) / requests * 1e6
+
+    start = time.perf_counter()
+    for _ in range(requests):
+        client.post("/api/heart_rate", json={"patient_id": "bench",
+                                             "heart_rate": 80})
+    timings["heart_rate"] = (time.perf_counter() - start) / requests * 1e6
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    best = {True: {}, False: {}}
+    for _ in range(args.rounds):
+        for enabled in (False, True):
+            for kind, us in run(enabled, args.requests).items():
+                best[enabled][kind] = min(best[enabled].get(kind, us), us)
+
+    print("{:>12} {:>10} {:>10} {:>10} {:>9}".format(
+        "request", "off us", "on us", "cost us", "overhead"))
+    for kind in ("status", "heart_rate"):
+        off, on = best[False][kind], best[True][kind]
+        print("{:>12} {:>10.1f} {:>10.1f} {:>10.1f} {:>8.1f}%".format(
+            kind, off, on, on - off, (on - off) / off * 100))
+
+    histogram = Histogram("bench_seconds", "Bench.", ("route",))
+    start = time.perf_counter()
+    for _ in range(100000):
+        histogram.observe(("/api/status/<patient_id>",), 0.0003)
+    print("Histogram.observe: {:.2f} us".format(
+        (time.perf_counter() - start) / 100000 * 1e6))
+
+
+if __name__ == "__main__":
+    main()
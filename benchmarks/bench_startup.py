@@ -0,0 +1,62 @@
+"""
+Measures the cold start of a worker: a fresh interpreter importing the
+server and calling create_app, as gunicorn does per worker. Storage must
+not connect during start, so this needs no database, and an unreachable
+HRS_MONGO_URI is set to make sure.
+
+    python benchmarks/bench_startup.py --target-ms 500
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+CHILD = """
+import json, time
+start = time.perf_counter()
+import heart_rate_sentinel_server as server
+imported = time.perf_counter()
+server.create_app()
+created = time.perf_counter()
+import pymodm.connection
+print(json.dumps({"import_ms": (imported - start) * 1000,
+                  "create_ms": (created - imported) * 1000,
+                  "connections": len(pymodm.connection._CONNECTIONS)}))
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--storage", default="mongo",
+                        choices=("mongo", "memory", "sqlite"))
+    parser.add_argument("--target-ms", type=float, default=500.0,
+                        help="Median import plus create_app time to stay under.")
+    args = parser.parse_args()
+
+    env = dict(os.environ, HRS_STORAGE=args.storage,
+               HRS_MONGO_URI="mongodb://192.0.2.1:27017/unreachable")
+    runs = []
+    for _ in range(args.runs):
+        out = subprocess.run([sys.executable, "-c", CHILD], cwd=ROOT, env=env,
+                             check=True, stdout=subprocess.PIPE).stdout
+        runs.append(json.loads(out.decode().strip().splitlines()[-1]))
+
+    totals = sorted(run["import_ms"] + run["create_ms"] for run in runs)
+    median = totals[len(totals) // 2]
+    print("{:>10} {:>10} {:>10}".format("import ms", "create ms", "total ms"))
+    for run in runs:
+        print("{:>10.1f} {:>10.1f} {:>10.1f}".format(
+            run["import_ms"], run["create_ms"],
+            run["import_ms"] + run["create_ms"]))
+    print("median {:.1f} ms, target {:.0f} ms, connections opened: {}".format(
+        median, args.target_ms, max(run["connections"] for run in runs)))
+    if median > args.target_ms or any(run["connections"] for run in runs):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
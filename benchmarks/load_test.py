@@ -0,0 +1,297 @@
+"""
+Drives a mix of patient creation, heart rate posts, status polls and
+interval averages against the server and reports latency percentiles and
+throughput per endpoint. Runs in process through the flask test client on
+the memory backend by default, so it needs no database or network and can
+gate regressions, e.g.:
+
+    python benchmarks/load_test.py --requests 20000 --max-p99-ms 20
+
+--url drives a running server over HTTP instead, e.g.
+--url http://127.0.0.1:5000/api/. The mix is given as weights per
+operation, and a fixed --seed replays the same sequence of operations.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# weights of the operations in the default mix, a dashboard heavy ward
+DEFAULT_MIX = "new_patient=1,heart_rate=40,status=40,interval_average=5"
+OPERATIONS = ("new_patient", "heart_rate", "status", "interval_average")
+
+
+class InProcess(object):
+    """
+    Sends requests through a flask test client, one per thread.
+    """
+
+    def __init__(self, storage):
+        os.environ["HRS_STORAGE"] = storage
+        import heart_rate_sentinel_server as server
+        self.app = server.create_app({"storage": storage})
+        self._local = threading.local()
+
+    def request(self, method, path, payload=None):
+        """
+        Sends a request.
+        Returns:
+            tuple: HTTP status code and decoded json body.
+        """
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        resp = client.open(path, method=method, json=payload)
+        return resp.status_code, resp.get_json()
+
+
+class OverHTTP(object):
+    """
+    Sends requests to a running server, over keep-alive connections.
+    """
+
+    def __init__(self, url, threads):
+        from hr_api import HRClient
+        self.client = HRClient(url, retries=0, pool_size=threads)
+        # the paths below carry /api/ already
+        self.root = self.client.base_url.rsplit("/api/", 1)[0]
+
+    def request(self, method, path, payload=None):
+        """
+        Sends a request.
+        Returns:
+            tuple: HTTP status code and decoded json body.
+        """
+        resp = self.client.session.request(method, self.root + path,
+                                           json=payload,
+                                           timeout=self.client.timeout)
+        return resp.status_code, resp.json()
+
+
+def parse_mix(mix):
+    """
+    Parses a mix like "heart_rate=10,status=5".
+    Args:
+        mix (str): Comma separated operation=weight pairs.
+
+    Returns:
+        tuple: Operations and their weights.
+    """
+    weights = {}
+    for pair in mix.split(","):
+        operation, weight = pair.split("=")
+        if operation not in OPERATIONS:
+            raise ValueError("operations must be among {}.".format(
+                ", ".join(OPERATIONS)))
+        weights[operation] = float(weight)
+    return tuple(weights), tuple(weights.values())
+
+
+class Worker(threading.Thread):
+    """
+    Thread sending its share of the requests and timing each one.
+    """
+
+    def __init__(self, target, patient_ids, lock, operations, weights,
+                 n_requests, seed, prefix):
+        super(Worker, self).__init__(daemon=True)
+        self.target = target
+        self.patient_ids = patient_ids
+        self.lock = lock
+        self.n_requests = n_requests
+        self.prefix = prefix
+        self.random = random.Random(seed)
+        self.sequence = self.random.choices(operations, weights, k=n_requests)
+        # (operation, latency ms, error class, None if the request worked)
+        self.samples = []
+
+    def run(self):
+        for i, operation in enumerate(self.sequence):
+            start = time.perf_counter()
+            try:
+                method, path, payload = self.build(operation, i)
+                start = time.perf_counter()
+                status, body = self.target.request(method, path, payload)
+                error = response_error(status, body)
+            except Exception as e:
+                # counted, whatever it is, and the worker goes on
+                error = type(e).__name__
+            self.samples.append(
+                (operation, (time.perf_counter() - start) * 1000, error))
+            if operation == "new_patient" and error is None:
+                with self.lock:
+                    self.patient_ids.append(payload["patient_id"])
+
+    def build(self, operation, i):
+        """
+        Builds the request of an operation.
+        Returns:
+            tuple: Method, path and json payload.
+        """
+        if operation == "new_patient":
+            return "POST", "/api/new_patient", {
+                "patient_id": "{}-{}".format(self.prefix, i),
+                "attending_email": "load@duke.edu",
+                "user_age": self.random.randint(1, 90)}
+        patient_id = self.random.choice(self.patient_ids)
+        if operation == "heart_rate":
+            return "POST", "/api/heart_rate", {
+                "patient_id": patient_id,
+                "heart_rate": self.random.randint(50, 160)}
+        if operation == "status":
+            return "GET", "/api/status/{}".format(patient_id), None
+        return "POST", "/api/heart_rate/interval_average", {
+            "patient_id": patient_id,
+            "heart_rate_average_since": time.strftime(
+                "%Y-%m-%dT%H:%M:%SZ", time.gmtime())}
+
+
+def response_error(status, body):
+    """
+    Classifies the answer to a request.
+    Args:
+        status (int): HTTP status code.
+        body: Decoded json body.
+
+    Returns:
+        str: Error class, e.g. HTTP 400 ValueError, None if the request
+            worked.
+    """
+    if isinstance(body, dict) and "error_type" in body:
+        return "HTTP {} {}".format(status, body["error_type"])
+    if status != 200:
+        return "HTTP {}".format(status)
+    return None
+
+
+def percentile(values, q):
+    """
+    Gets a percentile of sorted latencies.
+    Args:
+        values (list): Sorted latencies.
+        q (float): Percentile, 0 to 100.
+
+    Returns:
+        float: The percentile.
+    """
+    return values[min(int(len(values) * q / 100), len(values) - 1)]
+
+
+def summarize(samples, elapsed):
+    """
+    Summarizes the timed requests per operation and overall.
+    Args:
+        samples (list): (operation, latency ms, error class) of every
+            request.
+        elapsed (float): Wall time of the run in seconds.
+
+    Returns:
+        dict: count, errors, error_classes, rps, p50, p95 and p99 keyed by
+            operation, and by "all" for every request.
+    """
+    grouped = {}
+    for operation, latency, error in samples:
+        grouped.setdefault(operation, []).append((latency, error))
+        grouped.setdefault("all", []).append((latency, error))
+    summary = {}
+    for operation, rows in grouped.items():
+        latencies = sorted(latency for latency, _ in rows)
+        error_classes = {}
+        for _, error in rows:
+            if error is not None:
+                error_classes[error] = error_classes.get(error, 0) + 1
+        summary[operation] = {
+            "count": len(rows),
+            "errors": sum(error_classes.values()),
+            "error_classes": error_classes,
+            "rps": len(rows) / elapsed,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+        }
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="Base URI of a running server's API. "
+                                      "In process if not given.")
+    parser.add_argument("--storage", default="memory",
+                        choices=("mongo", "memory", "sqlite"),
+                        help="Backend of the in process server.")
+    parser.add_argument("--mix", default=DEFAULT_MIX)
+    parser.add_argument("--requests", type=int, default=10000)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--patients", type=int, default=100,
+                        help="Patients created before the run.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true",
+                        help="Print the summary as json.")
+    parser.add_argument("--max-p99-ms", type=float,
+                        help="Fail if the p99 of any operation exceeds it.")
+    args = parser.parse_args()
+
+    operations, weights = parse_mix(args.mix)
+    if args.url:
+        target = OverHTTP(args.url, args.threads)
+    else:
+        target = InProcess(args.storage)
+
+    prefix = "load{}".format(random.Random().randrange(10 ** 8))
+    patient_ids = []
+    for i in range(args.patients):
+        patient_id = "{}-seed-{}".format(prefix, i)
+        target.request("POST", "/api/new_patient", {
+            "patient_id": patient_id, "attending_email": "load@duke.edu",
+            "user_age": 30})
+        target.request("POST", "/api/heart_rate",
+                       {"patient_id": patient_id, "heart_rate": 80})
+        patient_ids.append(patient_id)
+
+    lock = threading.Lock()
+    share, extra = divmod(args.requests, args.threads)
+    workers = [Worker(target, patient_ids, lock, operations, weights,
+                      share + (i < extra), args.seed + i,
+                      "{}-{}".format(prefix, i))
+               for i in range(args.threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+
+    summary = summarize([sample for worker in workers
+                         for sample in worker.samples], elapsed)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print("{:>18} {:>8} {:>7} {:>9} {:>8} {:>8} {:>8}".format(
+            "operation", "count", "errors", "req/s", "p50 ms", "p95 ms",
+            "p99 ms"))
+        for operation in operations + ("all",):
+            if operation not in summary:
+                continue
+            row = summary[operation]
+            print("{:>18} {:>8} {:>7} {:>9.0f} {:>8.2f} {:>8.2f} {:>8.2f}"
+                  .format(operation, row["count"], row["errors"], row["rps"],
+                          row["p50"], row["p95"], row["p99"]))
+        for error, count in sorted(summary["all"]["error_classes"].items()):
+            print("{:>8} {}".format(count, error))
+
+    failed = any(row["errors"] for row in summary.values())
+    if args.max_p99_ms is not None:
+        failed = failed or any(row["p99"] > args.max_p99_ms
+                               for row in summary.values())
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
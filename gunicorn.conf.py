@@ -0,0 +1,33 @@
+"""
+gunicorn settings, used by running gunicorn from the project folder:
+
+    gunicorn -c gunicorn.conf.py
+
+Every worker opens its own mongo pool of up to mongo_max_pool_size
+connections on first use, so a deployment opens at most
+HRS_WORKERS * mongo_max_pool_size connections. The memory backend keeps
+its data in the worker, so it refuses to start with more than one.
+"""
+import os
+import multiprocessing
+
+bind = os.environ.get("HRS_BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("HRS_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+wsgi_app = "heart_rate_sentinel_server:create_app()"
+# import once in the master, workers fork from it. Nothing connects on
+# import, and post_fork makes sure no connection is shared anyway.
+preload_app = True
+
+
+def post_fork(server, worker):
+    import heart_rate_sentinel_server
+    heart_rate_sentinel_server.patients.after_fork()
+
+
+def on_starting(server):
+    import heart_rate_sentinel_server
+    if heart_rate_sentinel_server.patients.process_local and \
+            server.cfg.workers > 1:
+        # each worker would answer from, and snapshot, its own copy
+        raise RuntimeError("The memory backend keeps patients in one "
+                           "process, run it with HRS_WORKERS=1.")
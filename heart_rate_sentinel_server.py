@@ -1,76 +1,369 @@
+import hmac
 import json
+import time
 import datetime
-import sendgrid
-from hrs_db import HRDatabase
-from sendgrid.helpers.mail import *
-from flask import Flask, request, jsonify
+import functools
+import itertools
+import numpy as np
+from hrs_storage import make_storage, normalize_id, PATIENT_FIELDS
+from hrs_cache import LRUCache
+from hrs_time import parse_timestamp, format_timestamp, utc_now, \
+    to_micros, from_micros
+from hrs_alerts import AlertDispatcher, SendGridSender, StubSender
+from hrs_classifier import classify, is_tachycardic
+from hrs_metrics import Metrics, TimedSender, format_family, CONTENT_TYPE
+from hrs_profiler import Profiler, SORT_KEYS
+from flask import Flask, Response, request, jsonify, g
 
 app_name = "heart_rate_sentinel_server"
+MAX_BATCH_SIZE = 10000
+# highest heart rate accepted, in beats per minute
+MAX_HEART_RATE = 300
+MAX_PAGE_SIZE = 1000
+# header carrying admin_token, for the endpoints that rewrite every patient
+ADMIN_HEADER = "X-HRS-Admin"
+# points of a downsampled chart
+DEFAULT_POINTS = 500
+MAX_POINTS = 10000
 # self.database = hrs_db(app_name)
 app = Flask(app_name)
 
+
+def load_config(path="config.json"):
+    """
+    Reads the configuration, credentials included.
+    Args:
+        path (str): Path of config.json.
+
+    Returns:
+        dict: Contents of the file, empty if it cannot be read.
+    """
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
 # read in credentials, screws with tests.
-try:
-    with open("config.json", 'r') as f:
-        config_info = json.load(f)
-    sendgrid_API_KEY = config_info["SENDGRID_API_KEY"]
-    from_email = config_info["from_email"]
-except:
-    pass
+config_info = load_config()
+
+
+def _make_metrics(config):
+    """
+    Builds the metrics served at /metrics, unless "metrics" is false in
+    config.json.
+    Args:
+        config (dict): Contents of config.json.
+
+    Returns:
+        Metrics: Metrics of this process, None if they are off.
+    """
+    if not config.get("metrics", True):
+        return None
+    return Metrics()
 
-# testing in memory
-# patients = {}
 
-# testing using DM
-patients = HRDatabase()
+metrics = _make_metrics(config_info)
+
+
+def _make_profiler(config):
+    """
+    Builds the request profiler, if "profile_dir" is set in config.json.
+    Args:
+        config (dict): Contents of config.json.
+
+    Returns:
+        Profiler: The profiler, None if profiling is off.
+    """
+    if not config.get("profile_dir"):
+        return None
+    return Profiler(config["profile_dir"],
+                    sample_every=config.get("profile_sample_every", 0),
+                    token=config.get("profile_token"))
+
+
+profiler = _make_profiler(config_info)
+
+
+def _make_alerts(config, metrics=None):
+    """
+    Builds the alert pipeline. Without a SendGrid key alerts are only kept
+    in memory.
+    Args:
+        config (dict): Contents of config.json.
+        metrics (Metrics): If given, sends are timed into it.
+
+    Returns:
+        AlertDispatcher: Dispatcher sending the tachycardia alerts.
+    """
+    if config.get("SENDGRID_API_KEY"):
+        sender = SendGridSender(config["SENDGRID_API_KEY"], config["from_email"])
+    else:
+        sender = StubSender()
+    if metrics is not None:
+        sender = TimedSender(sender, metrics)
+    return AlertDispatcher(sender,
+                           workers=config.get("alert_workers", 2),
+                           max_queue=config.get("alert_queue_size", 1000),
+                           window=config.get("alert_window_seconds", 300),
+                           max_retries=config.get("alert_max_retries", 3),
+                           backoff=config.get("alert_backoff_seconds", 1.0))
+
+
+alerts = _make_alerts(config_info, metrics)
+
+# mongo by default, HRS_STORAGE=memory keeps everything in memory. Storage
+# connects on first use, not on import.
+patients = make_storage(config_info, metrics)
+
+
+def _make_responses(config):
+    """
+    Builds the cache of serialized read responses, keyed by (endpoint,
+    patient, version, query string). Bodies count against a byte budget,
+    and bodies over response_cache_entry_bytes are never cached.
+    Args:
+        config (dict): Contents of config.json.
+
+    Returns:
+        LRUCache: Cache of (body, mimetype) tuples.
+    """
+    return LRUCache(config.get("response_cache_size", 1024), ttl=None,
+                    max_bytes=config.get("response_cache_bytes", 64 << 20),
+                    max_entry_bytes=config.get("response_cache_entry_bytes",
+                                               1 << 20),
+                    sizeof=lambda cached: len(cached[0]))
+
+
+responses = _make_responses(config_info)
+
+
+def _versioned(view):
+    """
+    Serves a read endpoint of one patient by the patient's version. The
+    version is the ETag, so a poll with a matching If-None-Match gets a 304
+    without reading or serializing anything. Otherwise the serialized
+    response is taken from the response cache, and the view only runs
+    when the patient changed since the last request for the same URL.
+    Streamed responses are neither cached nor tagged.
+    Args:
+        view: View function taking the patient ID.
+
+    Returns:
+        function: The wrapped view.
+    """
+    @functools.wraps(view)
+    def wrapper(patient_id):
+        version = patients.get_version(patient_id)
+        if version is None:
+            return view(patient_id)
+        etag = str(version)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            key = (request.endpoint, normalize_id(patient_id), version,
+                   request.query_string)
+            cached = responses.get(key)
+            if cached is None:
+                response = view(patient_id)
+                if response.is_streamed:
+                    return response
+                cached = (response.get_data(), response.mimetype)
+                responses.put(key, cached)
+            response = Response(cached[0], mimetype=cached[1])
+        response.set_etag(etag)
+        # revalidate on every poll, which is cheap
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+    return wrapper
+
+
+@app.before_request
+def _start_request():
+    """
+    Counts the request in flight and starts its timer.
+    """
+    if metrics is not None:
+        g.request_start = time.perf_counter()
+        metrics.in_flight.inc()
+
+
+@app.after_request
+def _record_request(response):
+    """
+    Records the latency and status of the request by route, the URL rule
+    rather than the path so patient IDs do not become series.
+    Args:
+        response: Response of the request.
+
+    Returns:
+        object: The response.
+    """
+    start = g.get("request_start")
+    if start is not None:
+        route = "unmatched"
+        if request.url_rule is not None:
+            route = request.url_rule.rule
+        metrics.request_seconds.observe((request.method, route),
+                                        time.perf_counter() - start)
+        metrics.requests.inc((request.method, route,
+                              str(response.status_code)))
+    return response
+
+
+@app.teardown_request
+def _end_request(exception):
+    """
+    Counts the request out of flight, whether or not it failed.
+    """
+    if g.pop("request_start", None) is not None:
+        metrics.in_flight.dec()
+
+
+@app.before_request
+def _start_profile():
+    """
+    Starts profiling the request if it is sampled or asks for it with the
+    X-HRS-Profile header. The admin endpoints are never profiled.
+    """
+    if profiler is not None and \
+            not request.path.startswith("/api/admin/"):
+        g.profile = profiler.start(request.headers)
+
+
+@app.teardown_request
+def _end_profile(exception):
+    """
+    Adds the profile of the request to its route's total on disk.
+    """
+    profile = g.pop("profile", None)
+    if profile is not None:
+        route = "unmatched"
+        if request.url_rule is not None:
+            route = request.url_rule.rule
+        profiler.finish(profile, request.method, route)
 
 
 # for testing
 @app.route("/api/all_patients", methods=["GET"])
 def get_all():
     """
-    Gets all patients from the database.
+    Gets all patients from the database, streamed from a database cursor so
+    memory stays bounded. Optional query parameters:
+        limit: Page size. Returns {"patients": [...], "next_cursor": ID}.
+        cursor: next_cursor of the previous page.
+        fields: Comma separated fields to include, e.g. patient_id,user_age
+            to leave out the sample arrays.
+        format: ndjson to stream one patient per line instead.
     Returns:
         dict: All patients in the database. Key by ID.
 
     """
-    return jsonify(patients.get_all())
+    fields = PATIENT_FIELDS
+    if "fields" in request.args:
+        fields = tuple(request.args["fields"].split(","))
+        if any(field not in PATIENT_FIELDS for field in fields):
+            return error_handler(400, "fields must be among {}.".format(
+                ",".join(PATIENT_FIELDS)), "ValueError")
+        if "patient_id" not in fields:
+            fields = ("patient_id",) + fields
+
+    limit = request.args.get("limit")
+    if limit is not None:
+        if not limit.isdigit() or not 0 < int(limit) <= MAX_PAGE_SIZE:
+            return error_handler(400, "limit must be 1 to {}.".format(
+                MAX_PAGE_SIZE), "ValueError")
+        limit = int(limit)
+    cursor = request.args.get("cursor")
+
+    output_format = request.args.get("format", "json")
+    if output_format == "ndjson":
+        rows = patients.iter_patients(after=cursor, limit=limit, fields=fields)
+        return Response((json.dumps(row) + "\n" for row in rows),
+                        mimetype="application/x-ndjson")
+    if output_format != "json":
+        return error_handler(400, "format must be json or ndjson.", "ValueError")
+
+    if limit is None and cursor is None:
+        return Response(_stream_patient_dict(fields), mimetype="application/json")
+
+    limit = limit or MAX_PAGE_SIZE
+    # one extra to know if there is a next page
+    page = list(patients.iter_patients(after=cursor, limit=limit + 1,
+                                       fields=fields))
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        next_cursor = page[-1]["patient_id"]
+    return jsonify({"patients": page, "next_cursor": next_cursor})
+
+
+def _stream_patient_dict(fields):
+    """
+    Streams every patient as one json object keyed by ID, one patient at a
+    time.
+    Args:
+        fields (tuple): Fields to include for each patient.
+
+    Returns:
+        generator: Pieces of the json document.
+    """
+    yield "{"
+    separator = ""
+    for patient in patients.iter_patients(fields=fields):
+        yield "{}{}: {}".format(separator, json.dumps(patient["patient_id"]),
+                                json.dumps(patient))
+        separator = ", "
+    yield "}"
 
 
 @app.route("/api/status/<patient_id>", methods=["GET"])
+@_versioned
 def get_status(patient_id):
     """
-    Returns the status of the patient's most recent heart rate
+    Returns the status of the patient's most recent heart rate. The status is
+    evaluated, and alerts sent, when heart rates are posted, so this is only
+    a lookup.
     Args:
         patient_id (str): Status of the patient ID to retrieve.
 
     Returns:
         tuple: First element is if tachycardic, second element is timestamp.
     """
-
-    patient = patients.get_patient(patient_id)
-    if patient is None:
+    stats = patients.get_stats(patient_id)
+    if stats is None:
         return error_handler(500, "User does not exist.", "ValueError")
-    patient_age = patient.user_age
-
-    if patient.heart_rates == []:
+    if not stats["count"]:
         return jsonify((None, None))
-    recent_hr = patient.heart_rates[-1]
-    recent_hr_timestamp = patient.timestamps[-1]
-
-    is_tachycardic = _is_tachychardic(patient_age, recent_hr)
-    if is_tachycardic:
-        to_email = patient.attending_email
-        email_content = "Patient with ID {} is tachychardic.".format(patient_id)
-        send_email(to_email,
-                   email_subject="Patient Tachychardic",
-                   email_content=email_content)
+    recent_hr_timestamp = format_timestamp(stats["last_timestamp"])
+
+    is_tachycardic = stats["last_is_tachycardic"]
+    if is_tachycardic is None:
+        # samples posted before statuses were stored
+        patient = patients.get_patient(patient_id)
+        is_tachycardic = _is_tachychardic(patient.user_age,
+                                          stats["last_heart_rate"])
     return jsonify((is_tachycardic, recent_hr_timestamp))
 
 
+def _alert_tachycardic(patient):
+    """
+    Queues a tachycardia alert to the attending of a patient.
+    Args:
+        patient: The tachycardic patient.
+    """
+    email_content = "Patient with ID {} is tachychardic.".format(
+        patient.patient_id)
+    alerts.submit(patient.patient_id, patient.attending_email,
+                  email_subject="Patient Tachychardic",
+                  email_content=email_content)
+
+
 def _is_tachychardic(age: int, heart_rate: int):
     """
-    Determines if user is tacahychardic based on age and heart rate. Based on: https://en.wikipedia.org/wiki/Tachycardia
+    Determines if user is tacahychardic based on age and heart rate, from the
+    threshold table in hrs_classifier.
     Args:
         age (int): Age of the user.
         heart_rate (int): Heartrate of the user.
@@ -79,25 +372,63 @@ def _is_tachychardic(age: int, heart_rate: int):
         bool: Whether or not the user is tachychardic .
 
     """
-    if 1 <= age <= 2 and heart_rate > 151:
-        return True
-    elif 3 <= age <= 4 and heart_rate > 137:
-        return True
-    elif 5 <= age <= 7 and heart_rate > 133:
-        return True
-    elif 8 <= age <= 11 and heart_rate > 130:
-        return True
-    elif 12 <= age <= 15 and heart_rate > 119:
-        return True
-    elif age > 15 and heart_rate > 100:
-        return True
-    return False
+    return is_tachycardic(age, heart_rate)
+
+
+@app.route("/api/tachycardia/classify", methods=["POST"])
+def post_classify():
+    """
+    Determines which of many (age, heart rate) pairs are tachycardic, for
+    ward wide dashboards. Takes lists ages and heart_rates of equal length.
+    Returns:
+        list: Whether or not each pair is tachycardic.
+    """
+    content = request.get_json()
+    for key in ("ages", "heart_rates"):
+        if key not in content:
+            return error_handler(400, "Must have {}.".format(key), "AttributeError")
+    try:
+        ages = np.asarray(content["ages"])
+        heart_rates = np.asarray(content["heart_rates"])
+    except ValueError:
+        return error_handler(400, "ages and heart_rates must be lists of int.", "TypeError")
+    if ages.ndim != 1 or heart_rates.shape != ages.shape:
+        return error_handler(400, "ages and heart_rates must be lists of equal length.", "ValueError")
+    if ages.size and (ages.dtype.kind not in "iu" or heart_rates.dtype.kind not in "iu"):
+        return error_handler(400, "ages and heart_rates must be lists of int.", "TypeError")
+    if ages.size and (ages.min() < 0 or heart_rates.min() < 0):
+        return error_handler(400, "Invalid age or heart rate.", "ValueError")
+    return jsonify(classify(ages, heart_rates).tolist())
+
+
+@app.route("/api/status/reevaluate", methods=["POST"])
+def post_reevaluate_status():
+    """
+    Re-evaluates the stored status of every patient, e.g. after the
+    thresholds in hrs_classifier changed. Requires the X-HRS-Admin header
+    set to admin_token, and is off if no token is configured.
+    Returns:
+        dict: Number of patients evaluated and of statuses changed.
+    """
+    error = _check_admin()
+    if error is not None:
+        return error
+    evaluated, changed = patients.reclassify(classify)
+    return jsonify({"evaluated": evaluated, "changed": changed})
 
 
 @app.route("/api/heart_rate/<patient_id>", methods=["GET"])
+@_versioned
 def get_heart_rate(patient_id: str):
     """
-    Gets all heart rates that were recorded for a patient.
+    Gets all heart rates that were recorded for a patient. Optional query
+    parameters select a window, read only from the buckets overlapping it:
+        since: Earliest timestamp, inclusive.
+        until: Latest timestamp, exclusive.
+        limit: Page size. Returns {"records": [...], "next_cursor": cursor}
+            where records hold timestamp and heart_rate.
+        cursor: next_cursor of the previous page.
+        format: ndjson to stream one record per line instead, for exports.
     Args:
         patient_id (str): Patient to retrieve info for.
 
@@ -110,11 +441,85 @@ def get_heart_rate(patient_id: str):
     if patient is None:
         return error_handler(500, "User does not exist.", "ValueError")
 
-    all_heartrates = patient.heart_rates
-    return jsonify(all_heartrates)
+    if not request.args:
+        _, all_heartrates = patients.get_samples(patient_id)
+        return jsonify(all_heartrates)
+
+    try:
+        since, until = [parse_timestamp(request.args[key])
+                        if key in request.args else None
+                        for key in ("since", "until")]
+        skip = 0
+        if "cursor" in request.args:
+            micros, skip = request.args["cursor"].rsplit("-", 1)
+            since, skip = from_micros(int(micros)), int(skip)
+            if skip < 0:
+                raise ValueError("Invalid cursor")
+    except (ValueError, OverflowError):
+        return error_handler(400, "Invalid since, until or cursor.", "ValueError")
+
+    limit = request.args.get("limit")
+    if limit is not None:
+        if not limit.isdigit() or not 0 < int(limit) <= MAX_PAGE_SIZE:
+            return error_handler(400, "limit must be 1 to {}.".format(
+                MAX_PAGE_SIZE), "ValueError")
+        limit = int(limit)
+
+    records = _iter_hr_records(patient_id, since, until, skip)
+    output_format = request.args.get("format", "json")
+    if output_format == "ndjson":
+        if limit is not None:
+            records = itertools.islice(records, limit)
+        return Response((json.dumps(record) + "\n" for record, _ in records),
+                        mimetype="application/x-ndjson")
+    if output_format != "json":
+        return error_handler(400, "format must be json or ndjson.", "ValueError")
+
+    limit = limit or MAX_PAGE_SIZE
+    # one extra to know if there is a next page
+    page = list(itertools.islice(records, limit + 1))
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        next_cursor = page[-1][1]
+    return jsonify({"records": [record for record, _ in page],
+                    "next_cursor": next_cursor})
+
+
+def _iter_hr_records(patient_id, since, until, skip=0):
+    """
+    Iterates over the heart rate records of a patient in time order.
+    Args:
+        patient_id (str): Patient to retrieve records for.
+        since (datetime.datetime): Earliest timestamp, inclusive.
+        until (datetime.datetime): Latest timestamp, exclusive.
+        skip (int): Records at exactly since to leave out, already returned
+            by the previous page.
+
+    Returns:
+        generator: Tuples of a record dict with timestamp and heart_rate, and
+            the cursor continuing after that record.
+    """
+    micros, ties = None, 0
+    for timestamp, heart_rate in patients.iter_samples(patient_id, since, until):
+        if skip and timestamp == since:
+            skip -= 1
+            ties += 1
+            micros = to_micros(timestamp)
+            continue
+        timestamp_micros = to_micros(timestamp)
+        if timestamp_micros != micros:
+            micros, ties = timestamp_micros, 0
+        ties += 1
+        # the cursor counts records sharing the timestamp, so samples with
+        # equal timestamps are neither repeated nor skipped
+        yield ({"timestamp": format_timestamp(timestamp),
+                "heart_rate": heart_rate},
+               "{}-{}".format(micros, ties))
 
 
 @app.route("/api/heart_rate/average/<patient_id>", methods=["GET"])
+@_versioned
 def get_average(patient_id):
     """
     Gets the average heart rate of all recorded heart rates for a patient
@@ -124,14 +529,131 @@ def get_average(patient_id):
     Returns:
         float: Average heart rate.
     """
-    patient = patients.get_patient(patient_id)
-    if patient is None:
+    stats = patients.get_stats(patient_id)
+    if stats is None:
         return error_handler(500, "User does not exist.", "ValueError")
 
-    all_heartrates = patient.heart_rates
-    if not all_heartrates:
+    if not stats["count"]:
         return jsonify({})
-    return jsonify(sum(all_heartrates) / len(all_heartrates))
+    return jsonify(stats["mean"])
+
+
+@app.route("/api/heart_rate/downsample/<patient_id>", methods=["GET"])
+def get_downsampled(patient_id):
+    """
+    Downsamples the heart rates of a patient for charting. Optional query
+    parameters:
+        since: Earliest timestamp, inclusive.
+        until: Latest timestamp, exclusive.
+        method: bucket (default) for count, mean, min and max per bucket of
+            the window, or lttb for the samples that keep the shape of the
+            series.
+        points: Number of buckets or samples to aim for, 500 by default.
+        width: Bucket width in seconds. Derived from points and the window
+            if not given, rounded to whole minutes or hours so the rollups
+            kept on ingest can answer it. Open sides of the window are
+            closed by the patient's first and last sample.
+    Args:
+        patient_id (str): Patient to retrieve info for.
+
+    Returns:
+        dict: {"width": seconds, "buckets": [...]} for bucket, or
+            {"records": [...]} of timestamp and heart_rate for lttb.
+    """
+    if patients.get_patient(patient_id) is None:
+        return error_handler(500, "User does not exist.", "ValueError")
+
+    try:
+        since, until = [parse_timestamp(request.args[key])
+                        if key in request.args else None
+                        for key in ("since", "until")]
+        points = int(request.args.get("points", DEFAULT_POINTS))
+        width = request.args.get("width")
+        if width is not None:
+            width = datetime.timedelta(seconds=float(width))
+    except (ValueError, OverflowError):
+        return error_handler(400, "Invalid since, until, points or width.",
+                             "ValueError")
+    if not 3 <= points <= MAX_POINTS:
+        return error_handler(400, "points must be 3 to {}.".format(MAX_POINTS),
+                             "ValueError")
+
+    method = request.args.get("method", "bucket")
+    if method == "lttb":
+        timestamps, heart_rates = patients.downsample_lttb(
+            patient_id, points, since, until)
+        return jsonify({"records": [
+            {"timestamp": format_timestamp(from_micros(int(timestamp))),
+             "heart_rate": int(heart_rate)}
+            for timestamp, heart_rate in zip(timestamps, heart_rates)]})
+    if method != "bucket":
+        return error_handler(400, "method must be bucket or lttb.", "ValueError")
+
+    if width is None:
+        span = _sample_span(patient_id, since, until)
+        if span is None:
+            # nothing to chart
+            width = datetime.timedelta(minutes=1)
+        else:
+            width = _chart_width((span[1] - span[0]) / points)
+    if width <= datetime.timedelta(0):
+        return error_handler(400, "width must be positive.", "ValueError")
+
+    starts, counts, sums, mins, maxs = patients.downsample(
+        patient_id, width, since, until)
+    return jsonify({
+        "width": width.total_seconds(),
+        "buckets": [
+            {"start": format_timestamp(from_micros(int(start))),
+             "count": int(count), "mean": int(total) / int(count),
+             "min": int(low), "max": int(high)}
+            for start, count, total, low, high
+            in zip(starts, counts, sums, mins, maxs)],
+    })
+
+
+def _sample_span(patient_id, since, until):
+    """
+    Finds the part of a window that a patient's samples cover, so that a
+    window left open on either side is split by the samples' own span.
+    Only the first sample and the running aggregates are read.
+    Args:
+        patient_id (str): Patient to chart.
+        since (datetime.datetime): Start of the window, or None.
+        until (datetime.datetime): End of the window, or None.
+
+    Returns:
+        tuple: Start and end of the span. Returns None if the patient has
+            no samples in the window.
+    """
+    if since is None:
+        first = next(iter(patients.iter_samples(patient_id, until=until)), None)
+        if first is None:
+            return None
+        since = first[0]
+    if until is None:
+        stats = patients.get_stats(patient_id)
+        if not stats["count"] or stats["last_timestamp"] < since:
+            return None
+        until = stats["last_timestamp"] + datetime.timedelta(microseconds=1)
+    return since, until
+
+
+def _chart_width(width):
+    """
+    Rounds a bucket width up to whole seconds, minutes or hours, so that
+    wide buckets line up with the rollups.
+    Args:
+        width (datetime.timedelta): Smallest acceptable width.
+
+    Returns:
+        datetime.timedelta: Rounded width.
+    """
+    for unit in (datetime.timedelta(hours=1), datetime.timedelta(minutes=1)):
+        if width >= unit:
+            return -(-width // unit) * unit
+    unit = datetime.timedelta(seconds=1)
+    return max(-(-width // unit), 1) * unit
 
 
 # ---------- post stuff ----------
@@ -139,6 +661,9 @@ def get_average(patient_id):
 def post_interval_average():
     """
     Retrieves the average heart rate for all recordings before timestamp.
+    heart_rate_average_since is an ISO-8601 timestamp, UTC if no time zone.
+    If heart_rate_average_until is given as well, the average is instead
+    taken over since <= timestamp < until.
     Returns:
         dict: Original content with average heart rate in interval.
 
@@ -151,23 +676,50 @@ def post_interval_average():
 
     patient_id = str(content["patient_id"])
     heart_rate_ts = str(content["heart_rate_average_since"])
-
-    # get patient
-    # patient = await self.database.get_patient(patient_id)
-    patient = patients.get_patient(patient_id)
-    if patient is None:
+    if not _is_valid_timestamp(heart_rate_ts):
+        return error_handler(400, "Invalid heart_rate_average_since.", "ValueError")
+    since = parse_timestamp(heart_rate_ts)
+
+    if "heart_rate_average_until" in content:
+        until = content["heart_rate_average_until"]
+        if not _is_valid_timestamp(until):
+            return error_handler(400, "Invalid heart_rate_average_until.", "ValueError")
+        stats = patients.get_interval_stats(patient_id, since,
+                                            parse_timestamp(until))
+    else:
+        # everything up to and including since
+        stats = patients.get_interval_stats(
+            patient_id, until=since + datetime.timedelta(microseconds=1))
+    if stats is None:
         return error_handler(500, "User does not exist.", "ValueError")
 
-    before_hrs = []
-    # print("Current timestamps: ", patient["timestamps"], "Compare to: ", heart_rate_ts)
-    for i, timestamp in enumerate(patient.timestamps):
-        if heart_rate_ts >= timestamp:
-            before_hrs.append(patient.heart_rates[i])
+    return jsonify(stats["mean"])
 
-    if len(before_hrs) < 0:
-        return jsonify(None)
 
-    return jsonify(sum(before_hrs) / len(before_hrs))
+@app.route("/api/heart_rate/interval_stats", methods=["POST"])
+def post_interval_stats():
+    """
+    Summarizes the heart rates of a patient with since <= timestamp < until.
+    since and until are optional ISO-8601 timestamps, the window is unbounded
+    on any side that is left out.
+    Returns:
+        dict: count, mean, min, max and variance of the heart rates.
+    """
+    content = request.get_json()
+    if "patient_id" not in content:
+        return error_handler(400, "Must contain patient_id.", "AttributeError")
+
+    window = {}
+    for key in ("since", "until"):
+        if key in content:
+            if not _is_valid_timestamp(content[key]):
+                return error_handler(400, "Invalid {}.".format(key), "ValueError")
+            window[key] = parse_timestamp(content[key])
+
+    stats = patients.get_interval_stats(content["patient_id"], **window)
+    if stats is None:
+        return error_handler(500, "User does not exist.", "ValueError")
+    return jsonify(stats)
 
 
 @app.route("/api/new_patient", methods=["POST"])
@@ -201,7 +753,10 @@ def post_new_patient():
 @app.route("/api/heart_rate", methods=["POST"])
 def post_heart_rate():
     """
-    Posts new heart rate for a patient.
+    Posts new heart rate for a patient. Tachycardia is evaluated right away
+    and the attending is alerted if needed.
+    Returns:
+        dict: The posted sample with its generated timestamp and status.
     """
     updated_heartrate = request.get_json()
 
@@ -209,9 +764,6 @@ def post_heart_rate():
         return error_handler(400, "Must have patient_id.", "AttributeError")
 
     patient_id = updated_heartrate["patient_id"]
-    patient = patients.get_patient(patient_id)
-    if patient is None:
-        return error_handler(400, "Patient does not exist yet.", "ValueError")
 
     if "heart_rate" not in updated_heartrate:
         return error_handler(400, "Must have heart_rate.", "AttributeError")
@@ -219,21 +771,140 @@ def post_heart_rate():
     new_hr = updated_heartrate["heart_rate"]
     if type(new_hr) != int:
         return error_handler(400, "heart_rate must be type int.", "TypeError")
-    if new_hr < 0:
+    if not _is_valid_heart_rate(new_hr):
         return error_handler(400, "Invalid heart rate.", "ValueError")
 
-    new_hr = updated_heartrate["heart_rate"]
-    new_timestamp = str(datetime.datetime.now())
-
-    patients.add_hr(patient_id, new_hr, new_timestamp)
     patient = patients.get_patient(patient_id)
-    updated_info = patients.convert_to_json(patient)
-    return jsonify(updated_info)
+    if patient is None:
+        return error_handler(400, "Patient does not exist yet.", "ValueError")
+
+    new_timestamp = utc_now()
+    is_tachycardic = _is_tachychardic(patient.user_age, new_hr)
+    if not patients.add_hr(patient_id, new_hr, new_timestamp, is_tachycardic):
+        return error_handler(400, "Patient does not exist yet.", "ValueError")
+    if is_tachycardic:
+        _alert_tachycardic(patient)
+
+    posted = {
+        "patient_id": patient_id,
+        "heart_rate": new_hr,
+        "timestamp": format_timestamp(new_timestamp),
+        "is_tachycardic": is_tachycardic,
+    }
+    return jsonify(posted)
+
+
+@app.route("/api/heart_rate/batch", methods=["POST"])
+def post_heart_rate_batch():
+    """
+    Posts many heart rates across many patients at once. Records are
+    validated with the rules of a single post in one pass over the batch,
+    classified with one call and written with one bulk write.
+    Returns:
+        dict: accepted, the number of records written. timestamp, given to
+            records without one. is_tachycardic, the status of each record
+            in order, null where it was rejected. errors, the index,
+            status_code, msg and error_type of each rejected record.
+    """
+    content = request.get_json()
+    if "records" not in content:
+        return error_handler(400, "Must have records.", "AttributeError")
+
+    records = content["records"]
+    if type(records) != list:
+        return error_handler(400, "records must be type list.", "TypeError")
+    if len(records) > MAX_BATCH_SIZE:
+        return error_handler(
+            400, "At most {} records per batch.".format(MAX_BATCH_SIZE),
+            "ValueError")
+
+    now = utc_now()
+    errors = {}
+    # well formed records are checked as columns, the others one by one
+    well_formed = np.fromiter(
+        (type(record) is dict and "patient_id" in record and
+         type(record.get("heart_rate")) is int for record in records),
+        dtype=bool, count=len(records))
+    for i in np.flatnonzero(~well_formed).tolist():
+        errors[i] = _hr_record_error(records[i])
+    heart_rates = np.fromiter(
+        (record["heart_rate"] if ok and _is_valid_heart_rate(
+            record["heart_rate"]) else -1
+         for record, ok in zip(records, well_formed.tolist())),
+        dtype=np.int64, count=len(records))
+    for i in np.flatnonzero(well_formed & (heart_rates < 0)).tolist():
+        errors[i] = ("Invalid heart rate.", "ValueError")
+
+    timestamps = [now] * len(records)
+    for i, record in enumerate(records):
+        if i not in errors and "timestamp" in record:
+            try:
+                timestamps[i] = parse_timestamp(record["timestamp"])
+            except TypeError:
+                errors[i] = ("timestamp must be type str.", "TypeError")
+            except ValueError:
+                errors[i] = ("Invalid timestamp.", "ValueError")
+
+    checked = [i for i in range(len(records)) if i not in errors]
+    patient_ids = [normalize_id(records[i]["patient_id"]) for i in checked]
+    found = patients.get_patients(set(patient_ids))
+    known = [patient_id in found for patient_id in patient_ids]
+    valid = [i for i, ok in zip(checked, known) if ok]
+    patient_ids = [patient_id for patient_id, ok in zip(patient_ids, known)
+                   if ok]
+    valid_hrs = heart_rates[valid].tolist()
+    statuses = classify([found[patient_id].user_age
+                         for patient_id in patient_ids], valid_hrs).tolist()
+    existing = patients.add_hr_batch(list(zip(
+        patient_ids, valid_hrs, [timestamps[i] for i in valid], statuses)))
+
+    is_tachy = [None] * len(records)
+    tachycardic = set()
+    for i, patient_id, status in zip(valid, patient_ids, statuses):
+        # missing patients were not found, or removed since
+        if patient_id in existing:
+            is_tachy[i] = status
+            if status:
+                tachycardic.add(patient_id)
+    for patient_id in tachycardic:
+        _alert_tachycardic(found[patient_id])
+
+    for i in checked:
+        if is_tachy[i] is None:
+            errors[i] = ("Patient does not exist yet.", "ValueError")
+    return jsonify({
+        "accepted": len(records) - len(errors),
+        "timestamp": format_timestamp(now),
+        "is_tachycardic": is_tachy,
+        "errors": [{"index": i, "status_code": 400, "msg": msg,
+                    "error_type": error_type}
+                   for i, (msg, error_type) in sorted(errors.items())],
+    })
+
+
+def _hr_record_error(record):
+    """
+    Finds why a record of a batch heart rate post is not well formed.
+    Args:
+        record: Record that should be a dict with patient_id and an int
+            heart_rate.
+
+    Returns:
+        tuple: msg and error_type, as a single post would answer.
+    """
+    if type(record) != dict:
+        return "Record must be type dict.", "TypeError"
+    if "patient_id" not in record:
+        return "Must have patient_id.", "AttributeError"
+    if "heart_rate" not in record:
+        return "Must have heart_rate.", "AttributeError"
+    return "heart_rate must be type int.", "TypeError"
 
 
 def send_email(to_address: str, email_subject: str, email_content: str):
     """
-    Sends email regarding heart rate via Sendgrid API.
+    Sends email regarding heart rate via Sendgrid API, right away. Alerts
+    should go through alerts.submit instead, which does not block.
     Args:
         to_address: Address to send to
         email_subject: Subject of the email.
@@ -242,17 +913,156 @@ def send_email(to_address: str, email_subject: str, email_content: str):
     Returns:
         object: API response from Sendgrid Server.
     """
-    sg = sendgrid.SendGridAPIClient(apikey=sendgrid_API_KEY)
-    from_email = config_info["from_email"]
-    from_email = Email(from_email)
+    return alerts.sender.send(to_address, email_subject, email_content)
 
-    to_email = Email(to_address)
 
-    content = Content("text/plain", email_content)
+@app.route("/api/alerts/metrics", methods=["GET"])
+def get_alert_metrics():
+    """
+    Gets the state of the alert pipeline.
+    Returns:
+        dict: Queue depth and counts of alerts by outcome.
+    """
+    return jsonify(alerts.metrics())
 
-    mail = Mail(from_email, email_subject, to_email, content)
-    response = sg.client.mail.send.post(request_body=mail.get())
-    return response
+
+@app.route("/api/storage/metrics", methods=["GET"])
+def get_storage_metrics():
+    """
+    Gets the state of the storage backend in this worker, e.g. how much of
+    the mongo connection pool is in use.
+    Returns:
+        dict: Metrics of the backend.
+    """
+    return jsonify(patients.metrics())
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """
+    Gets the request, storage and alert timings of this worker, with the
+    counts of the alert pipeline and of the response cache, in the
+    Prometheus text format.
+    Returns:
+        str: The metrics.
+    """
+    if metrics is None:
+        return error_handler(404, "Metrics are off.", "ValueError")
+    alert_counts = alerts.metrics()
+    queue_depth = alert_counts.pop("queue_depth")
+    pending = alert_counts.pop("pending")
+    cache_counts = responses.metrics()
+    text = "".join((
+        metrics.render(),
+        format_family("hrs_alerts_total", "counter",
+                      "Alerts through the pipeline, by event.",
+                      [({"event": event}, count)
+                       for event, count in sorted(alert_counts.items())]),
+        format_family("hrs_alert_queue_depth", "gauge",
+                      "Alerts waiting for a worker.", [({}, queue_depth)]),
+        format_family("hrs_alerts_pending", "gauge",
+                      "Alerts queued or being sent.", [({}, pending)]),
+        format_family("hrs_response_cache_total", "counter",
+                      "Lookups of the response cache, by result.",
+                      [({"result": result}, cache_counts[result])
+                       for result in ("hits", "misses")]),
+        format_family("hrs_response_cache_oversized_total", "counter",
+                      "Responses too large for the response cache.",
+                      [({}, cache_counts["oversized"])]),
+        format_family("hrs_response_cache_bytes", "gauge",
+                      "Size of the cached response bodies.",
+                      [({}, cache_counts["bytes"])]),
+    ))
+    return Response(text, content_type=CONTENT_TYPE)
+
+
+@app.route("/api/admin/profiles", methods=["GET", "DELETE"])
+def get_profiles():
+    """
+    Lists the profiled routes of every worker, or deletes their profiles
+    with DELETE. Requires the X-HRS-Profile header set to profile_token, and
+    is off if no token is configured.
+    Returns:
+        list: name, method, route, requests and total seconds of each
+            profiled route, slowest first.
+    """
+    error = _check_profiler()
+    if error is not None:
+        return error
+    if request.method == "DELETE":
+        profiler.clear()
+    return jsonify(profiler.profiles())
+
+
+@app.route("/api/admin/profiles/<name>", methods=["GET"])
+def get_profile(name):
+    """
+    Gets the total profile of a route over every worker. Optional query
+    parameters:
+        sort: Column of the report to sort by, cumulative by default.
+        limit: Number of functions in the report, 30 by default.
+        format: pstats for the raw profile, to open with pstats or snakeviz.
+    Args:
+        name (str): Name of the profile, from /api/admin/profiles.
+
+    Returns:
+        str: The pstats report as text.
+    """
+    error = _check_profiler()
+    if error is not None:
+        return error
+    sort = request.args.get("sort", "cumulative")
+    if sort not in SORT_KEYS:
+        return error_handler(400, "sort must be among {}.".format(
+            ",".join(SORT_KEYS)), "ValueError")
+    limit = request.args.get("limit", "30")
+    if not limit.isdigit():
+        return error_handler(400, "limit must be a number.", "ValueError")
+
+    if request.args.get("format") == "pstats":
+        data = profiler.dump(name)
+        mimetype = "application/octet-stream"
+    else:
+        data = profiler.report(name, sort, int(limit))
+        mimetype = "text/plain"
+    if data is None:
+        return error_handler(404, "No profile named {}.".format(name),
+                             "ValueError")
+    return Response(data, mimetype=mimetype)
+
+
+def _check_profiler():
+    """
+    Checks that profiling is on and that the request may read profiles.
+    Without a profile_token nobody may, so the endpoints are not found.
+    Returns:
+        object: Error message information, None if the request may go on.
+    """
+    if profiler is None or profiler.token is None:
+        return error_handler(404, "Profiling is off.", "ValueError")
+    if not profiler.authorized(request.headers):
+        return error_handler(403, "X-HRS-Profile header missing or wrong.",
+                             "ValueError")
+    return None
+
+
+def _check_admin():
+    """
+    Checks that the request carries admin_token. Without one configured
+    nobody may, so the admin endpoints are not found.
+    Returns:
+        object: Error message information, None if the request may go on.
+    """
+    token = config_info.get("admin_token")
+    if token is None:
+        return error_handler(404, "Admin endpoints are off.", "ValueError")
+    value = request.headers.get(ADMIN_HEADER)
+    # constant time, the token is a secret
+    if value is None or not hmac.compare_digest(value.encode("utf-8"),
+                                                token.encode("utf-8")):
+        return error_handler(403, "X-HRS-Admin header missing or wrong.",
+                             "ValueError")
+    return None
 
 
 def _is_valid_email(email):
@@ -291,7 +1101,7 @@ def _is_valid_age(user_age):
 
 def _is_valid_heart_rate(heart_rate):
     """
-    Determines if the heart rate is valid.
+    Determines if the heart rate is valid, an int from 0 to MAX_HEART_RATE.
     Args:
         heart_rate: Heart rate in question.
 
@@ -301,14 +1111,15 @@ def _is_valid_heart_rate(heart_rate):
     """
     if type(heart_rate) != int:
         return False
-    if heart_rate < 0:
+    if heart_rate < 0 or heart_rate > MAX_HEART_RATE:
         return False
     return True
 
 
 def _is_valid_timestamp(timestamp):
     """
-    Determines if the timestamp for is valid.
+    Determines if the timestamp for is valid, ISO-8601 with an optional
+    time zone.
     Args:
         timestamp (str): Time stamp string in question
 
@@ -318,6 +1129,10 @@ def _is_valid_timestamp(timestamp):
     """
     if type(timestamp) != str:
         return False
+    try:
+        parse_timestamp(timestamp)
+    except ValueError:
+        return False
     return True
 
 
@@ -350,5 +1165,30 @@ def get_app():
     return app
 
 
+def create_app(config=None):
+    """
+    Configures the app for serving, e.g. from gunicorn with
+    "heart_rate_sentinel_server:create_app()". Alerts and storage are
+    rebuilt from the configuration, and storage still only connects on
+    first use.
+    Args:
+        config: Contents of config.json as a dict, or the path to read them
+            from. config.json if not given.
+
+    Returns:
+        object: Flask application object.
+    """
+    global config_info, metrics, profiler, alerts, patients, responses
+    if not isinstance(config, dict):
+        config = load_config(config or "config.json")
+    config_info = config
+    metrics = _make_metrics(config)
+    profiler = _make_profiler(config)
+    alerts = _make_alerts(config, metrics)
+    patients = make_storage(config, metrics)
+    responses = _make_responses(config)
+    return app
+
+
 if __name__ == "__main__":
     app.run(host="127.0.0.1")
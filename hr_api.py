@@ -1,147 +1,651 @@
+import os
 import json
 import requests
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-post_url = "http://127.0.0.1:5000/api/"
+# base URI of the API, HRS_API_URL overrides it
+post_url = os.environ.get("HRS_API_URL", "http://127.0.0.1:5000/api/")
+# (connect, read) timeouts in seconds
+DEFAULT_TIMEOUT = (3.05, 30)
+# responses worth retrying, the server or a proxy in front being overloaded
+RETRY_STATUSES = (429, 502, 503, 504)
+
+
+class HRClient(object):
+    """
+    Client of the heart rate API. Requests go through one requests.Session
+    with a connection pool, so connections are kept alive and reused instead
+    of paying a TCP handshake per call. Failed connections are retried with
+    exponential backoff for every method, since the request never reached
+    the server. Read errors and overloaded responses are only retried for
+    GETs, so a heart rate is never posted twice.
+    """
+
+    def __init__(self, base_url=None, timeout=DEFAULT_TIMEOUT, retries=3,
+                 backoff=0.5, pool_size=10):
+        """
+        Args:
+            base_url (str): Base URI of the API, e.g.
+                http://127.0.0.1:5000/api/. post_url if not given.
+            timeout: Seconds to wait for the server, one number or a
+                (connect, read) tuple.
+            retries (int): Retries of a failed request, 0 to disable.
+            backoff (float): Backoff factor, retries wait backoff * 2 ** n
+                seconds.
+            pool_size (int): Connections kept alive, i.e. threads that can
+                share the client without waiting for a connection.
+        """
+        base_url = base_url or post_url
+        self.base_url = base_url if base_url.endswith("/") else base_url + "/"
+        self.timeout = timeout
+        self.pool_size = pool_size
+        retry = Retry(total=retries, connect=retries, read=retries,
+                      status=retries, backoff_factor=backoff,
+                      status_forcelist=RETRY_STATUSES,
+                      allowed_methods=frozenset(["GET"]),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def close(self):
+        """
+        Closes the connections of the client.
+        """
+        self.session.close()
+
+    def fan_out(self, method, arguments, workers=None,
+                return_exceptions=False):
+        """
+        Makes many calls in parallel on a pool of threads sharing the
+        client's connections, for sync callers, e.g. to post the readings of
+        many patients at once.
+        Args:
+            method (str): Name of the method to call, e.g. post_heart_rate.
+            arguments (list): Tuple of arguments of every call.
+            workers (int): Calls in flight at once. pool_size if not given,
+                so no thread waits for a connection.
+            return_exceptions (bool): Whether to return the exception of a
+                failed call in place of its result instead of raising it.
+
+        Returns:
+            list: Results of the calls, in the order of arguments.
+        """
+        call = getattr(self, method)
+        with ThreadPoolExecutor(workers or self.pool_size) as executor:
+            futures = [executor.submit(call, *args) for args in arguments]
+        if not return_exceptions:
+            return [future.result() for future in futures]
+        return [future.exception() or future.result() for future in futures]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # ---------- general web interfacing ----------------------
+    def post(self, endpoint, payload, uri=None):
+        """
+        Posts to the flask web server.
+        Args:
+            endpoint: The endpoint of the API
+            payload: Payload according to what the web server requires.
+            uri: Web server uri. base_url if not given.
+
+        Returns:
+            object: Response from web server.
+
+        """
+        return self.session.post((uri or self.base_url) + endpoint,
+                                 json=payload, timeout=self.timeout)
+
+    def get(self, endpoint, uri=None):
+        """
+        Gets from the flask web server.
+        Args:
+            endpoint: The endpoint of the API
+            uri: Web server uri. base_url if not given.
+
+        Returns:
+            object: Response from web server.
+        """
+        return self.session.get((uri or self.base_url) + endpoint,
+                                timeout=self.timeout)
+
+    def _send(self, method, endpoint, payload=None):
+        """
+        Sends a request built by one of the *_request functions.
+        Args:
+            method (str): GET or POST.
+            endpoint: The endpoint of the API, with its query string.
+            payload: Body to post as JSON.
+
+        Returns:
+            object: Decoded answer of the server.
+        """
+        if method == "GET":
+            return byte_2_json(self.get(endpoint))
+        return byte_2_json(self.post(endpoint, payload))
+
+    # ---------- API ----------------------
+    def get_all_patients(self):
+        """
+        Obtains a list of all patients in the database. (For testing)
+        Returns:
+            dict: All patients currently in database referenced by ID.
+
+        """
+        return self._send(*all_patients_request())
+
+    def iter_all_patients(self, page_size: int = 500, fields: list = None):
+        """
+        Iterates over all patients in the database, one page per request.
+        Args:
+            page_size: Patients fetched per request.
+            fields: Fields to include, e.g. ["patient_id", "user_age"] to skip
+                the sample arrays. All fields if not given.
+
+        Returns:
+            generator: Dictionaries of the patients, in ID order.
+        """
+        cursor = None
+        while True:
+            page = self._send(*patients_page_request(page_size, fields,
+                                                     cursor))
+            for patient in page["patients"]:
+                yield patient
+            cursor = page["next_cursor"]
+            if cursor is None:
+                return
+
+    def add_new_patient(self, patient_id: str, attending_email: str,
+                        user_age: int):
+        """
+        Adds new patient to the database.
+        Args:
+            patient_id: ID of the patient.
+            attending_email: Email of the user
+            user_age: Age of the user.
+
+        Returns:
+            dict: Patient that added.
+        """
+        return self._send(*new_patient_request(patient_id, attending_email,
+                                               user_age))
+
+    def get_interval_average(self, patient_id: str, timestamp: str,
+                             until: str = None):
+        """
+        Gets the average heart rate from before a timestamp.
+        Args:
+            patient_id: ID of the patient.
+            timestamp: ISO-8601 timestamp, e.g. 2018-11-16T10:23:45.123456+00:00
+                as returned by get_patient_status. UTC if it has no time zone.
+            until: Optional ISO-8601 timestamp. If given, the average is taken
+                over timestamp <= t < until instead.
+
+        Returns:
+            float: Average heart rate from before the timestamp.
+        """
+        return self._send(*interval_average_request(patient_id, timestamp,
+                                                    until))
+
+    def get_interval_stats(self, patient_id: str, since: str = None,
+                           until: str = None):
+        """
+        Summarizes the heart rates of a patient with since <= t < until.
+        Args:
+            patient_id: ID of the patient.
+            since: Optional ISO-8601 start of the window.
+            until: Optional ISO-8601 end of the window.
+
+        Returns:
+            dict: count, mean, min, max and variance of the heart rates.
+        """
+        return self._send(*interval_stats_request(patient_id, since, until))
+
+    def post_heart_rate(self, patient_id: str, heart_rate: int):
+        """
+        Posts a heart rate to a patient. Timestamp automatically generated.
+        Args:
+            patient_id: ID of the patient.
+            heart_rate: Heart rate to post.
+
+        Returns:
+            dict: The posted sample: patient_id, heart_rate and timestamp.
+
+        """
+        return self._send(*heart_rate_request(patient_id, heart_rate))
+
+    def post_heart_rate_batch(self, samples):
+        """
+        Posts many heart rates, possibly for many patients, in one request.
+        Args:
+            samples: (patient_id, heart_rate) or (patient_id, heart_rate,
+                timestamp) tuples. Timestamps are generated if not given.
+
+        Returns:
+            list: Status of each sample, in order. Written samples carry
+                status_code 200 and is_tachycardic, failed samples the same
+                status_code, msg and error_type as a failed single post.
+        """
+        return batch_statuses(self._send(*batch_request(samples)))
+
+    def get_patient_status(self, patient_id: str):
+        """
+        Obtains patient status. Sends email if tachychardic.
+        Args:
+            patient_id: ID of the patient.
+
+        Returns:
+            tuple: first is if tachychardic, second is timestamp.
+
+        """
+        return self._send(*status_request(patient_id))
+
+    def get_heart_rate(self, patient_id: str):
+        """
+        Obtains all heart rates from the
+        Args:
+            patient_id: ID of the patient.
+
+        Returns:
+            list: List of all heart rates from the patient.
+
+        """
+        return self._send(*heart_rates_request(patient_id))
+
+    def iter_heart_rates(self, patient_id: str, since: str = None,
+                         until: str = None, page_size: int = 1000):
+        """
+        Iterates over the heart rates of a patient in a time window, one page
+        per request.
+        Args:
+            patient_id: ID of the patient.
+            since: Earliest timestamp, inclusive. Unbounded if not given.
+            until: Latest timestamp, exclusive. Unbounded if not given.
+            page_size: Heart rates fetched per request.
+
+        Returns:
+            generator: Dictionaries with timestamp and heart_rate, in time order.
+        """
+        cursor = None
+        while True:
+            page = self._send(*heart_rates_page_request(
+                patient_id, since, until, page_size, cursor))
+            for record in page["records"]:
+                yield record
+            cursor = page["next_cursor"]
+            if cursor is None:
+                return
+
+    def get_downsampled(self, patient_id: str, since: str = None,
+                        until: str = None, points: int = 500,
+                        method: str = "bucket", width: float = None):
+        """
+        Obtains a downsampled series of a patient's heart rates, for charting.
+        Args:
+            patient_id: ID of the patient.
+            since: Earliest timestamp, inclusive. Unbounded if not given.
+            until: Latest timestamp, exclusive. Unbounded if not given.
+            points: Number of buckets or samples to aim for.
+            method: bucket for count, mean, min and max per bucket, or lttb for
+                the samples that keep the shape of the series.
+            width: Bucket width in seconds, derived from points if not given.
+
+        Returns:
+            dict: {"width": seconds, "buckets": [...]} for bucket, or
+                {"records": [...]} for lttb.
+        """
+        return self._send(*downsampled_request(patient_id, since, until,
+                                               points, method, width))
+
+    def get_heart_rate_average(self, patient_id: str):
+        """
+        Obtains an average heart rate of the patient.
+        Args:
+            patient_id: ID of the patient.
+
+        Returns:
+            float: Average heart rate of the patient.
+        """
+        return self._send(*average_request(patient_id))
+
+
+# client behind the module functions
+default_client = HRClient()
+
+
+def set_default_client(client):
+    """
+    Replaces the client behind the module functions, e.g. to change the
+    base URL, timeouts or retries.
+    Args:
+        client (HRClient): The new client.
+    """
+    global default_client
+    default_client = client
+
+
+def fan_out(method, arguments, workers=None, return_exceptions=False):
+    """
+    HRClient.fan_out on the default client.
+    """
+    return default_client.fan_out(method, arguments, workers,
+                                  return_exceptions)
 
 
 # ---------- general web interfacing ----------------------
 
-def post(endpoint, payload, uri="http://127.0.0.1:5000/api/"):
+def post(endpoint, payload, uri=None):
     """
-    Posts to the flask web server.
+    Posts to the flask web server through the default client.
     Args:
         endpoint: The endpoint of the API
         payload: Payload according to what the web server requires.
-        uri: Web server uri.
+        uri: Web server uri. The default client's base_url if not given.
 
     Returns:
         object: Response from web server.
 
     """
-    return requests.post(uri + endpoint, json=payload)
+    return default_client.post(endpoint, payload, uri)
 
 
-def get(endpoint, uri="http://127.0.0.1:5000/api/"):
+def get(endpoint, uri=None):
     """
-    Gets from the flask web server.
+    Gets from the flask web server through the default client.
     Args:
         endpoint: The endpoint of the API
-        uri: Web server uri.
+        uri: Web server uri. The default client's base_url if not given.
 
     Returns:
         object: Response from web server.
     """
-    return requests.get(uri + endpoint)
+    return default_client.get(endpoint, uri)
 
 
-# ---------- API ----------------------
+# ---------- API, through the default client ----------------------
 def get_all_patients():
     """
-    Obtains a list of all patients in the database. (For testing)
-    Returns:
-        dict: All patients currently in database referenced by ID.
+    HRClient.get_all_patients on the default client.
+    """
+    return default_client.get_all_patients()
 
+
+def iter_all_patients(page_size: int = 500, fields: list = None):
+    """
+    HRClient.iter_all_patients on the default client.
     """
-    resp = get("all_patients")
-    return byte_2_json(resp)
+    return default_client.iter_all_patients(page_size, fields)
 
 
 def add_new_patient(patient_id: str, attending_email: str, user_age: int):
     """
-    Adds new patient to the database.
+    HRClient.add_new_patient on the default client.
+    """
+    return default_client.add_new_patient(patient_id, attending_email,
+                                          user_age)
+
+
+def get_interval_average(patient_id: str, timestamp: str, until: str = None):
+    """
+    HRClient.get_interval_average on the default client.
+    """
+    return default_client.get_interval_average(patient_id, timestamp, until)
+
+
+def get_interval_stats(patient_id: str, since: str = None, until: str = None):
+    """
+    HRClient.get_interval_stats on the default client.
+    """
+    return default_client.get_interval_stats(patient_id, since, until)
+
+
+def post_heart_rate(patient_id: str, heart_rate: int):
+    """
+    HRClient.post_heart_rate on the default client.
+    """
+    return default_client.post_heart_rate(patient_id, heart_rate)
+
+
+def post_heart_rate_batch(samples):
+    """
+    HRClient.post_heart_rate_batch on the default client.
+    """
+    return default_client.post_heart_rate_batch(samples)
+
+
+def get_patient_status(patient_id: str):
+    """
+    HRClient.get_patient_status on the default client.
+    """
+    return default_client.get_patient_status(patient_id)
+
+
+def get_heart_rate(patient_id: str):
+    """
+    HRClient.get_heart_rate on the default client.
+    """
+    return default_client.get_heart_rate(patient_id)
+
+
+def iter_heart_rates(patient_id: str, since: str = None, until: str = None,
+                     page_size: int = 1000):
+    """
+    HRClient.iter_heart_rates on the default client.
+    """
+    return default_client.iter_heart_rates(patient_id, since, until, page_size)
+
+
+def get_downsampled(patient_id: str, since: str = None, until: str = None,
+                    points: int = 500, method: str = "bucket",
+                    width: float = None):
+    """
+    HRClient.get_downsampled on the default client.
+    """
+    return default_client.get_downsampled(patient_id, since, until, points,
+                                          method, width)
+
+
+def get_heart_rate_average(patient_id: str):
+    """
+    HRClient.get_heart_rate_average on the default client.
+    """
+    return default_client.get_heart_rate_average(patient_id)
+
+
+# ---------- requests of the API, shared with hr_api_async ----------
+# each returns the method, the endpoint with its query string and the payload
+
+def all_patients_request():
+    """
+    Builds the request of get_all_patients.
+    """
+    return "GET", "all_patients", None
+
+
+def patients_page_request(page_size, fields=None, cursor=None):
+    """
+    Builds the request of a page of iter_all_patients.
     Args:
-        patient_id: ID of the patient.
-        attending_email: Email of the user
-        user_age: Age of the user.
+        page_size (int): Patients fetched per request.
+        fields (list): Fields to include. All fields if not given.
+        cursor: next_cursor of the previous page, None for the first one.
+    """
+    endpoint = "all_patients?limit={}".format(page_size)
+    if fields is not None:
+        endpoint += "&fields={}".format(",".join(fields))
+    if cursor is not None:
+        endpoint += "&cursor={}".format(quote(str(cursor)))
+    return "GET", endpoint, None
 
-    Returns:
-        dict: Patient that added.
+
+def new_patient_request(patient_id, attending_email, user_age):
     """
-    payload = {
+    Builds the request of add_new_patient.
+    """
+    return "POST", "new_patient", {
         "patient_id": patient_id,
         "attending_email": attending_email,
         "user_age": user_age
     }
-    resp = post("new_patient", payload)
-    return byte_2_json(resp)
 
 
-def get_interval_average(patient_id: str, timestamp: str):
+def interval_average_request(patient_id, timestamp, until=None):
     """
-    Gets the average heart rate from before a timestamp.
-    Args:
-        patient_id: ID of the patient.
-        timestamp: timestamp in form YYYY-MM-DD HH:MM:SS.#######
-
-    Returns:
-        float: Average heart rate from before the timestamp.
+    Builds the request of get_interval_average.
     """
     payload = {
         "patient_id": patient_id,
         "heart_rate_average_since": timestamp,
     }
-    resp = post("heart_rate/interval_average", payload)
-    return byte_2_json(resp)
+    if until is not None:
+        payload["heart_rate_average_until"] = until
+    return "POST", "heart_rate/interval_average", payload
 
 
-def post_heart_rate(patient_id: str, heart_rate: int):
+def interval_stats_request(patient_id, since=None, until=None):
     """
-    Posts a heart rate to a patient. Timestamp automatically generated.
-    Args:
-        patient_id: ID of the patient.
-        heart_rate: Heart rate to post.
+    Builds the request of get_interval_stats.
+    """
+    payload = {"patient_id": patient_id}
+    if since is not None:
+        payload["since"] = since
+    if until is not None:
+        payload["until"] = until
+    return "POST", "heart_rate/interval_stats", payload
 
-    Returns:
-        dict: Updated patient information.
 
+def heart_rate_request(patient_id, heart_rate):
     """
-    payload = {
+    Builds the request of post_heart_rate.
+    """
+    return "POST", "heart_rate", {
         "patient_id": patient_id,
         "heart_rate": heart_rate,
     }
-    resp = post("heart_rate", payload)
-    return byte_2_json(resp)
 
 
-def get_patient_status(patient_id: str):
+def batch_request(samples):
+    """
+    Builds the request of post_heart_rate_batch, see batch_payload.
     """
-    Obtains patient status. Sends email if tachychardic.
+    return "POST", "heart_rate/batch", batch_payload(samples)
+
+
+def status_request(patient_id):
+    """
+    Builds the request of get_patient_status.
+    """
+    return "GET", "status/{}".format(patient_id), None
+
+
+def heart_rates_request(patient_id):
+    """
+    Builds the request of get_heart_rate.
+    """
+    return "GET", "heart_rate/{}".format(patient_id), None
+
+
+def heart_rates_page_request(patient_id, since=None, until=None,
+                             page_size=1000, cursor=None):
+    """
+    Builds the request of a page of iter_heart_rates.
     Args:
-        patient_id: ID of the patient.
+        patient_id (str): ID of the patient.
+        since (str): Earliest timestamp, inclusive. Unbounded if not given.
+        until (str): Latest timestamp, exclusive. Unbounded if not given.
+        page_size (int): Heart rates fetched per request.
+        cursor: next_cursor of the previous page, None for the first one.
+    """
+    endpoint = "heart_rate/{}?limit={}".format(patient_id, page_size)
+    endpoint += _window_params(since, until)
+    if cursor is not None:
+        endpoint += "&cursor={}".format(quote(str(cursor)))
+    return "GET", endpoint, None
 
-    Returns:
-        tuple: first is if tachychardic, second is timestamp.
 
+def downsampled_request(patient_id, since=None, until=None, points=500,
+                        method="bucket", width=None):
     """
-    resp = get("status/{}".format(patient_id))
-    return byte_2_json(resp)
+    Builds the request of get_downsampled.
+    """
+    endpoint = "heart_rate/downsample/{}?points={}&method={}".format(
+        patient_id, points, method)
+    endpoint += _window_params(since, until)
+    if width is not None:
+        endpoint += "&width={}".format(width)
+    return "GET", endpoint, None
 
 
-def get_heart_rate(patient_id: str):
+def average_request(patient_id):
     """
-    Obtains all heart rates from the
+    Builds the request of get_heart_rate_average.
+    """
+    return "GET", "heart_rate/average/{}".format(patient_id), None
+
+
+def _window_params(since, until):
+    """
+    Builds the since and until query parameters of a time window.
     Args:
-        patient_id: ID of the patient.
+        since (str): Earliest timestamp, inclusive, or None.
+        until (str): Latest timestamp, exclusive, or None.
 
     Returns:
-        list: List of all heart rates from the patient.
-
+        str: The parameters, each starting with &.
     """
-    resp = get("heart_rate/{}".format(patient_id))
-    return byte_2_json(resp)
+    params = ""
+    if since is not None:
+        params += "&since={}".format(quote(since))
+    if until is not None:
+        params += "&until={}".format(quote(until))
+    return params
 
 
-def get_heart_rate_average(patient_id: str):
+def batch_payload(samples):
+    """
+    Builds the body of a batch heart rate post.
+    Args:
+        samples: (patient_id, heart_rate) or (patient_id, heart_rate,
+            timestamp) tuples.
+
+    Returns:
+        dict: The records to post.
+    """
+    records = []
+    for sample in samples:
+        record = {
+            "patient_id": sample[0],
+            "heart_rate": sample[1],
+        }
+        if len(sample) > 2 and sample[2] is not None:
+            record["timestamp"] = sample[2]
+        records.append(record)
+    return {"records": records}
+
+
+def batch_statuses(json_resp):
     """
-    Obtains an average heart rate of the patient.
+    Expands the answer of a batch heart rate post to a status per sample.
     Args:
-        patient_id: ID of the patient.
+        json_resp (dict): Answer of the server.
 
     Returns:
-        float: Average heart rate of the patient.
+        list: Status of each sample, in order.
     """
-    resp = get("heart_rate/average/{}".format(patient_id))
-    return byte_2_json(resp)
+    statuses = [{"status_code": 200, "is_tachycardic": is_tachycardic}
+                for is_tachycardic in json_resp["is_tachycardic"]]
+    for error in json_resp["errors"]:
+        statuses[error.pop("index")] = error
+    return statuses
 
 
 def byte_2_json(resp):
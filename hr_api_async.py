@@ -0,0 +1,345 @@
+"""
+asyncio client of the heart rate API, for fleet simulators and gateways
+pushing readings of many patients at once, e.g.:
+
+    async with AsyncHRClient(concurrency=64) as client:
+        await asyncio.gather(*(client.post_heart_rate(patient_id, 80)
+                               for patient_id in patient_ids))
+
+Requests go through one aiohttp.ClientSession on the event loop, with
+concurrency keep-alive connections. An asyncio.Semaphore keeps at most
+concurrency requests in flight, the rest wait their turn. Requests are built
+by the same functions of hr_api as HRClient's, retries follow HRClient, and
+errors of the server raise the same exceptions as hr_api.
+Sync callers use hr_api.fan_out instead.
+"""
+import json
+import asyncio
+import yarl
+import aiohttp
+from hr_api import (post_url, DEFAULT_TIMEOUT, RETRY_STATUSES, error_catcher,
+                    all_patients_request, patients_page_request,
+                    new_patient_request, interval_average_request,
+                    interval_stats_request, heart_rate_request, batch_request,
+                    batch_statuses, status_request, heart_rates_request,
+                    heart_rates_page_request, downsampled_request,
+                    average_request)
+
+# failures of a request worth retrying for GETs only, the server may have
+# acted on it
+_READ_ERRORS = (aiohttp.ServerDisconnectedError, aiohttp.ClientPayloadError,
+                asyncio.TimeoutError)
+
+
+class AsyncHRClient(object):
+    """
+    asyncio version of HRClient with bounded concurrency. Failed connections
+    are retried with exponential backoff for every method, read errors and
+    overloaded responses only for GETs, as in HRClient.
+    """
+
+    def __init__(self, base_url=None, concurrency=32,
+                 timeout=DEFAULT_TIMEOUT, retries=3, backoff=0.5):
+        """
+        Args:
+            base_url (str): Base URI of the API. hr_api.post_url if not
+                given.
+            concurrency (int): Requests in flight at once, and connections
+                kept alive.
+            timeout: Seconds to wait for the server, one number or a
+                (connect, read) tuple.
+            retries (int): Retries of a failed request, 0 to disable.
+            backoff (float): Backoff factor, retries wait backoff * 2 ** n
+                seconds.
+        """
+        base_url = base_url or post_url
+        self.base_url = base_url if base_url.endswith("/") else base_url + "/"
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        # made on first use, they belong to the running event loop
+        self._session = None
+        self._semaphore = None
+
+    def _open(self):
+        """
+        Opens the session of the client, on first use.
+
+        Returns:
+            aiohttp.ClientSession: The session.
+        """
+        if self._session is None:
+            connect, read = (self.timeout if isinstance(self.timeout, tuple)
+                             else (self.timeout, self.timeout))
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+                timeout=aiohttp.ClientTimeout(sock_connect=connect,
+                                              sock_read=read))
+        return self._session
+
+    async def close(self):
+        """
+        Closes the connections of the client.
+        """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        self._open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    # ---------- general web interfacing ----------------------
+    async def _request(self, method, endpoint, payload=None):
+        """
+        Sends a request, retrying it as HRClient does, and decodes the
+        answer.
+        Args:
+            method (str): GET or POST.
+            endpoint: The endpoint of the API.
+            payload: Body to post as JSON.
+
+        Returns:
+            object: Decoded answer of the server.
+        """
+        session = self._open()
+        attempt = 0
+        while True:
+            retry = attempt < self.retries
+            try:
+                async with self._semaphore:
+                    # sent as built by hr_api, without normalizing it
+                    async with session.request(
+                            method, yarl.URL(self.base_url + endpoint,
+                                             encoded=True),
+                            json=payload) as resp:
+                        # read in full, so the connection is kept alive
+                        body = await resp.read()
+                        if (retry and method == "GET"
+                                and resp.status in RETRY_STATUSES):
+                            raise _Retry()
+                return error_catcher(json.loads(body.decode("utf-8")))
+            except _Retry:
+                pass
+            except aiohttp.ClientConnectorError:
+                if not retry:
+                    raise
+            except _READ_ERRORS:
+                if not retry or method != "GET":
+                    raise
+            await asyncio.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+
+    async def post(self, endpoint, payload):
+        """
+        Posts to the flask web server.
+        Args:
+            endpoint: The endpoint of the API
+            payload: Payload according to what the web server requires.
+
+        Returns:
+            object: Decoded answer of the server.
+        """
+        return await self._request("POST", endpoint, payload)
+
+    async def get(self, endpoint):
+        """
+        Gets from the flask web server.
+        Args:
+            endpoint: The endpoint of the API
+
+        Returns:
+            object: Decoded answer of the server.
+        """
+        return await self._request("GET", endpoint)
+
+    # ---------- API ----------------------
+    async def get_all_patients(self):
+        """
+        Obtains a list of all patients in the database. (For testing)
+        Returns:
+            dict: All patients currently in database referenced by ID.
+        """
+        return await self._request(*all_patients_request())
+
+    async def iter_all_patients(self, page_size: int = 500,
+                                fields: list = None):
+        """
+        Iterates over all patients in the database, one page per request.
+        Args:
+            page_size: Patients fetched per request.
+            fields: Fields to include. All fields if not given.
+
+        Returns:
+            async_generator: Dictionaries of the patients, in ID order.
+        """
+        cursor = None
+        while True:
+            page = await self._request(*patients_page_request(
+                page_size, fields, cursor))
+            for patient in page["patients"]:
+                yield patient
+            cursor = page["next_cursor"]
+            if cursor is None:
+                return
+
+    async def add_new_patient(self, patient_id: str, attending_email: str,
+                              user_age: int):
+        """
+        Adds new patient to the database.
+        Args:
+            patient_id: ID of the patient.
+            attending_email: Email of the user
+            user_age: Age of the user.
+
+        Returns:
+            dict: Patient that added.
+        """
+        return await self._request(*new_patient_request(
+            patient_id, attending_email, user_age))
+
+    async def get_interval_average(self, patient_id: str, timestamp: str,
+                                   until: str = None):
+        """
+        Gets the average heart rate from before a timestamp.
+        Args:
+            patient_id: ID of the patient.
+            timestamp: ISO-8601 timestamp. UTC if it has no time zone.
+            until: Optional ISO-8601 timestamp. If given, the average is
+                taken over timestamp <= t < until instead.
+
+        Returns:
+            float: Average heart rate from before the timestamp.
+        """
+        return await self._request(*interval_average_request(
+            patient_id, timestamp, until))
+
+    async def get_interval_stats(self, patient_id: str, since: str = None,
+                                 until: str = None):
+        """
+        Summarizes the heart rates of a patient with since <= t < until.
+        Args:
+            patient_id: ID of the patient.
+            since: Optional ISO-8601 start of the window.
+            until: Optional ISO-8601 end of the window.
+
+        Returns:
+            dict: count, mean, min, max and variance of the heart rates.
+        """
+        return await self._request(*interval_stats_request(
+            patient_id, since, until))
+
+    async def post_heart_rate(self, patient_id: str, heart_rate: int):
+        """
+        Posts a heart rate to a patient. Timestamp automatically generated.
+        Args:
+            patient_id: ID of the patient.
+            heart_rate: Heart rate to post.
+
+        Returns:
+            dict: The posted sample: patient_id, heart_rate and timestamp.
+        """
+        return await self._request(*heart_rate_request(patient_id,
+                                                       heart_rate))
+
+    async def post_heart_rate_batch(self, samples):
+        """
+        Posts many heart rates, possibly for many patients, in one request.
+        Args:
+            samples: (patient_id, heart_rate) or (patient_id, heart_rate,
+                timestamp) tuples. Timestamps are generated if not given.
+
+        Returns:
+            list: Status of each sample, in order.
+        """
+        return batch_statuses(await self._request(*batch_request(samples)))
+
+    async def get_patient_status(self, patient_id: str):
+        """
+        Obtains patient status.
+        Args:
+            patient_id: ID of the patient.
+
+        Returns:
+            tuple: first is if tachychardic, second is timestamp.
+        """
+        return await self._request(*status_request(patient_id))
+
+    async def get_heart_rate(self, patient_id: str):
+        """
+        Obtains all heart rates of a patient.
+        Args:
+            patient_id: ID of the patient.
+
+        Returns:
+            list: List of all heart rates from the patient.
+        """
+        return await self._request(*heart_rates_request(patient_id))
+
+    async def iter_heart_rates(self, patient_id: str, since: str = None,
+                               until: str = None, page_size: int = 1000):
+        """
+        Iterates over the heart rates of a patient in a time window, one page
+        per request.
+        Args:
+            patient_id: ID of the patient.
+            since: Earliest timestamp, inclusive. Unbounded if not given.
+            until: Latest timestamp, exclusive. Unbounded if not given.
+            page_size: Heart rates fetched per request.
+
+        Returns:
+            async_generator: Dictionaries with timestamp and heart_rate, in
+                time order.
+        """
+        cursor = None
+        while True:
+            page = await self._request(*heart_rates_page_request(
+                patient_id, since, until, page_size, cursor))
+            for record in page["records"]:
+                yield record
+            cursor = page["next_cursor"]
+            if cursor is None:
+                return
+
+    async def get_downsampled(self, patient_id: str, since: str = None,
+                              until: str = None, points: int = 500,
+                              method: str = "bucket", width: float = None):
+        """
+        Obtains a downsampled series of a patient's heart rates, for
+        charting.
+        Args:
+            patient_id: ID of the patient.
+            since: Earliest timestamp, inclusive. Unbounded if not given.
+            until: Latest timestamp, exclusive. Unbounded if not given.
+            points: Number of buckets or samples to aim for.
+            method: bucket or lttb.
+            width: Bucket width in seconds, derived from points if not given.
+
+        Returns:
+            dict: {"width": seconds, "buckets": [...]} for bucket, or
+                {"records": [...]} for lttb.
+        """
+        return await self._request(*downsampled_request(
+            patient_id, since, until, points, method, width))
+
+    async def get_heart_rate_average(self, patient_id: str):
+        """
+        Obtains an average heart rate of the patient.
+        Args:
+            patient_id: ID of the patient.
+
+        Returns:
+            float: Average heart rate of the patient.
+        """
+        return await self._request(*average_request(patient_id))
+
+
+class _Retry(Exception):
+    """
+    Raised for an answer to retry, e.g. 503 to a GET.
+    """
@@ -0,0 +1,226 @@
+import os
+import time
+import queue
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class SendGridSender(object):
+    """
+    Sends emails through a single SendGrid client that is reused for every
+    alert instead of being built per email.
+    """
+
+    def __init__(self, api_key, from_email):
+        # imported here, only deployments that send email pay for it
+        import sendgrid
+        self._client = sendgrid.SendGridAPIClient(apikey=api_key)
+        self._from_email = from_email
+
+    def send(self, to_address, email_subject, email_content):
+        """
+        Sends a plain text email.
+        Args:
+            to_address: Address to send to
+            email_subject: Subject of the email.
+            email_content: Content of the email.
+
+        Returns:
+            object: API response from Sendgrid Server.
+        """
+        from sendgrid.helpers.mail import Email, Content, Mail
+        mail = Mail(Email(self._from_email), email_subject,
+                    Email(to_address), Content("text/plain", email_content))
+        return self._client.client.mail.send.post(request_body=mail.get())
+
+
+class StubSender(object):
+    """
+    Keeps the most recent emails in memory instead of sending them. Used in
+    tests and when no SendGrid key is configured.
+    """
+
+    def __init__(self, max_kept=1000, fail_times=0):
+        """
+        Args:
+            max_kept (int): Number of sent emails to remember.
+            fail_times (int): Number of sends that raise before succeeding,
+                to exercise retries.
+        """
+        self.sent = deque(maxlen=max_kept)
+        self.fail_times = fail_times
+
+    def send(self, to_address, email_subject, email_content):
+        """
+        Records an email.
+        Args:
+            to_address: Address to send to
+            email_subject: Subject of the email.
+            email_content: Content of the email.
+        """
+        if self.fail_times > 0:
+            self.fail_times -= 1
+            raise IOError("Stub send failure.")
+        self.sent.append((to_address, email_subject, email_content))
+
+
+class AlertDispatcher(object):
+    """
+    Sends alerts from a bounded queue on background worker threads, so
+    requests never wait on the email provider. Alerts for the same patient
+    and address are coalesced while one is queued, and de-duplicated for
+    window seconds after one was sent. Failed sends are retried with
+    exponential backoff.
+    """
+
+    def __init__(self, sender, workers=2, max_queue=1000, window=300.0,
+                 max_retries=3, backoff=1.0):
+        """
+        Args:
+            sender: Object with send(to_address, email_subject, email_content).
+            workers (int): Number of worker threads.
+            max_queue (int): Alerts that can wait before new ones are dropped.
+            window (float): Seconds an alert suppresses repeats of itself.
+            max_retries (int): Retries of a failed send before giving up.
+            backoff (float): Seconds before the first retry, doubling after.
+        """
+        self.sender = sender
+        self.workers = workers
+        self.window = window
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._last_sent = {}
+        self._threads = []
+        self._pid = None
+        self._counts = dict.fromkeys(
+            ("submitted", "sent", "coalesced", "suppressed", "dropped",
+             "failed", "retries"), 0)
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counts[name] += amount
+
+    def _start(self):
+        """
+        Starts the workers on first use. Threads do not survive a fork, so
+        they are started again in a forked worker process.
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._threads = [
+                threading.Thread(target=self._work, daemon=True,
+                                 name="alert-worker-{}".format(i))
+                for i in range(self.workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+            self._pid = os.getpid()
+
+    def submit(self, patient_id, to_address, email_subject, email_content):
+        """
+        Queues an alert without waiting for it to be sent.
+        Args:
+            patient_id: ID of the patient the alert is about.
+            to_address: Address to send to
+            email_subject: Subject of the email.
+            email_content: Content of the email.
+
+        Returns:
+            bool: Whether or not the alert was queued.
+        """
+        self._start()
+        key = (str(patient_id), to_address)
+        with self._lock:
+            self._counts["submitted"] += 1
+            if key in self._pending:
+                self._counts["coalesced"] += 1
+                return False
+            last_sent = self._last_sent.get(key)
+            if last_sent is not None and \
+                    time.monotonic() - last_sent < self.window:
+                self._counts["suppressed"] += 1
+                return False
+            self._pending.add(key)
+        try:
+            self._queue.put_nowait((key, email_subject, email_content))
+        except queue.Full:
+            with self._lock:
+                self._pending.discard(key)
+                self._counts["dropped"] += 1
+            logger.warning("Alert queue full, dropped alert for %s.", key)
+            return False
+        return True
+
+    def _work(self):
+        """
+        Worker loop, sends queued alerts forever.
+        """
+        while True:
+            key, email_subject, email_content = self._queue.get()
+            try:
+                sent = self._send(key[1], email_subject, email_content)
+                with self._lock:
+                    self._pending.discard(key)
+                    if sent:
+                        self._last_sent[key] = time.monotonic()
+                        self._prune()
+            finally:
+                self._queue.task_done()
+
+    def _prune(self):
+        """
+        Forgets sent alerts whose window has passed. Called with the lock.
+        """
+        if len(self._last_sent) < 10000:
+            return
+        cutoff = time.monotonic() - self.window
+        for key in [key for key, sent in self._last_sent.items()
+                    if sent < cutoff]:
+            del self._last_sent[key]
+
+    def _send(self, to_address, email_subject, email_content):
+        """
+        Sends one alert, retrying with exponential backoff.
+        Returns:
+            bool: Whether or not the alert was sent.
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.sender.send(to_address, email_subject, email_content)
+                self._count("sent")
+                return True
+            except Exception:
+                if attempt == self.max_retries:
+                    logger.exception("Giving up on alert to %s.", to_address)
+                    break
+                self._count("retries")
+                time.sleep(self.backoff * 2 ** attempt)
+        self._count("failed")
+        return False
+
+    def flush(self):
+        """
+        Blocks until every queued alert was handled.
+        """
+        self._queue.join()
+
+    def metrics(self):
+        """
+        Gets counters of the pipeline.
+        Returns:
+            dict: Queue depth and counts of alerts by outcome.
+        """
+        with self._lock:
+            metrics = dict(self._counts)
+            metrics["pending"] = len(self._pending)
+        metrics["queue_depth"] = self._queue.qsize()
+        return metrics
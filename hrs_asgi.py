@@ -0,0 +1,251 @@
+"""
+Asyncio serving mode: the routes of heart_rate_sentinel_server as an ASGI
+application, e.g. for uvicorn:
+
+    uvicorn --factory hrs_asgi:create_asgi_app --workers 4
+
+Connections are held by the event loop, so a worker keeps thousands of idle
+or slow gateway connections open without a thread or process for each.
+Only requests being handled take a thread, from a pool of asgi_threads
+threads sized against the mongo pool. A streamed response keeps its thread
+until its last chunk is sent, so exports and ndjson pages count against
+the pool for as long as the client takes to read them. Storage calls block, pymongo as much
+as motor, which is pymongo in a thread pool, so this is where they run.
+Alerts are queued and sent by the AlertDispatcher threads, so no request
+waits on SendGrid.
+"""
+import io
+import os
+import sys
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import heart_rate_sentinel_server
+
+# threads running views, per worker
+DEFAULT_THREADS = 32
+# largest request body read, the batch endpoint takes up to 10000 records
+MAX_BODY_SIZE = 16 * 1024 * 1024
+# body chunks of a response buffered between its thread and the event loop
+STREAM_BUFFER = 8
+# put on the queue instead of the end of the body when the application fails
+_FAILED = object()
+
+
+class ASGIApp(object):
+    """
+    Serves a WSGI application, the Flask app, over ASGI. Every request is
+    handled in the thread pool, and streamed responses are passed to the
+    event loop one chunk at a time. If the application fails after the
+    response started, the response is not ended, the error is raised to
+    the server instead, which aborts the connection. The JSON contract is
+    the Flask one, byte for byte.
+    """
+
+    def __init__(self, wsgi_app, threads=DEFAULT_THREADS,
+                 max_body_size=MAX_BODY_SIZE):
+        """
+        Args:
+            wsgi_app: WSGI application to serve.
+            threads (int): Requests handled at once.
+            max_body_size (int): Largest request body accepted, in bytes.
+        """
+        self.wsgi_app = wsgi_app
+        self.threads = threads
+        self.max_body_size = max_body_size
+        self.executor = ThreadPoolExecutor(threads,
+                                           thread_name_prefix="hrs-asgi")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+        else:
+            raise ValueError("Unsupported scope type {}.".format(scope["type"]))
+
+    async def _lifespan(self, receive, send):
+        """
+        Answers the server's startup and shutdown. Storage connects on first
+        use, so there is nothing to start. The threads are stopped on
+        shutdown.
+        """
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.executor.shutdown(wait=True)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _http(self, scope, receive, send):
+        """
+        Handles one request: reads the body on the event loop, runs the view
+        in the thread pool and sends the response back.
+        """
+        body = []
+        size = 0
+        more = True
+        while more:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > self.max_body_size:
+                await self._send_simple(send, 413, b"Request body too large.")
+                return
+            body.append(chunk)
+            more = message.get("more_body", False)
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(STREAM_BUFFER)
+        stop = threading.Event()
+        done = loop.run_in_executor(self.executor, self._respond,
+                                    wsgi_environ(scope, b"".join(body)),
+                                    loop, queue, stop)
+        finished = False
+        try:
+            start = await queue.get()
+            if start is None or start is _FAILED:
+                # done raises the error, before anything was sent
+                finished = True
+                return
+            await send({"type": "http.response.start", "status": start[0],
+                        "headers": start[1]})
+            chunk = await queue.get()
+            ended = False
+            # a failure leaves the body unended, done raises its error
+            while chunk is not _FAILED and not ended:
+                following = None if chunk is None else await queue.get()
+                ended = following is None
+                await send({"type": "http.response.body", "body": chunk or b"",
+                            "more_body": not ended})
+                chunk = following
+            finished = True
+        finally:
+            if not finished:
+                # e.g. the client went away, let the thread wind down
+                stop.set()
+                chunk = await queue.get()
+                while chunk is not None and chunk is not _FAILED:
+                    chunk = await queue.get()
+            await done
+
+    def _respond(self, environ, loop, queue, stop):
+        """
+        Runs the WSGI application and hands its status, headers and body
+        chunks to the event loop through queue, then None, or _FAILED if the
+        application raised. Called in the
+        thread pool. A streamed body is read in this one thread, because
+        storage cursors behind it, e.g. SQLite's, cannot move between
+        threads.
+        Args:
+            environ (dict): WSGI environ of the request.
+            loop: Event loop of the request.
+            queue (asyncio.Queue): Queue read by the event loop.
+            stop (threading.Event): Set when the response is not wanted
+                anymore.
+        """
+        def put(item):
+            # waits while the queue is full, e.g. for a slow client
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [int(status.split(" ", 1)[0]), [
+                (name.lower().encode("latin-1"), value.encode("latin-1"))
+                for name, value in headers]]
+
+        end = _FAILED
+        try:
+            iterable = self.wsgi_app(environ, start_response)
+            try:
+                sent_start = False
+                for chunk in iterable:
+                    if stop.is_set():
+                        break
+                    if not sent_start:
+                        put(tuple(started))
+                        sent_start = True
+                    if chunk:
+                        put(chunk)
+                if not sent_start and not stop.is_set():
+                    put(tuple(started))
+            finally:
+                if hasattr(iterable, "close"):
+                    iterable.close()
+            end = None
+        finally:
+            put(end)
+
+    @staticmethod
+    async def _send_simple(send, status, body):
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(b"content-type", b"text/plain")]})
+        await send({"type": "http.response.body", "body": body})
+
+
+def wsgi_environ(scope, body):
+    """
+    Builds the WSGI environ of an ASGI http request.
+    Args:
+        scope (dict): ASGI scope of the request.
+        body (bytes): Request body.
+
+    Returns:
+        dict: The WSGI environ.
+    """
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf8").decode(
+            "latin-1"),
+        "PATH_INFO": scope["path"].encode("utf8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/{}".format(scope.get("http_version", "1.1")),
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+            continue
+        if name == "CONTENT_LENGTH":
+            continue
+        key = "HTTP_" + name
+        environ[key] = environ[key] + "," + value if key in environ else value
+    return environ
+
+
+def create_asgi_app(config=None):
+    """
+    Configures the app for serving over ASGI, as create_app does for WSGI.
+    The thread pool has HRS_ASGI_THREADS threads, or asgi_threads from the
+    configuration, 32 by default.
+    Args:
+        config: Contents of config.json as a dict, or the path to read them
+            from. config.json if not given.
+
+    Returns:
+        ASGIApp: ASGI application serving every route of the server.
+    """
+    app = heart_rate_sentinel_server.create_app(config)
+    threads = int(os.environ.get(
+        "HRS_ASGI_THREADS", heart_rate_sentinel_server.config_info.get(
+            "asgi_threads", DEFAULT_THREADS)))
+    return ASGIApp(app, threads)
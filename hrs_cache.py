@@ -0,0 +1,247 @@
+import time
+import threading
+from collections import OrderedDict
+from hrs_storage import normalize_id
+
+
+class LRUCache(object):
+    """
+    Thread safe cache holding up to max_size entries for ttl seconds each,
+    evicting the least recently used entry when full. With a byte budget
+    it also evicts until the entries fit in max_bytes, and never stores an
+    entry larger than max_entry_bytes.
+    """
+
+    def __init__(self, max_size=10000, ttl=60.0, max_bytes=None,
+                 max_entry_bytes=None, sizeof=len):
+        """
+        Args:
+            max_size (int): Number of entries kept.
+            ttl (float): Seconds an entry is served before it is read again.
+                Entries never expire if None.
+            max_bytes (int): Total size of the entries kept. Unbounded if
+                None.
+            max_entry_bytes (int): Size above which an entry is not stored.
+                max_bytes if None.
+            sizeof: Function giving the size of a value in bytes, only
+                used with a byte budget.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_bytes if max_entry_bytes is None \
+            else max_entry_bytes
+        self.sizeof = sizeof
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._counts = dict.fromkeys(
+            ("hits", "misses", "evictions", "expirations", "invalidations",
+             "oversized"), 0)
+
+    def get(self, key):
+        """
+        Looks up an entry.
+        Args:
+            key: Key of the entry.
+
+        Returns:
+            object: The cached value, None on a miss.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and \
+                    time.monotonic() - entry[1] > self.ttl:
+                del self._entries[key]
+                self._bytes -= entry[2]
+                self._counts["expirations"] += 1
+                entry = None
+            if entry is None:
+                self._counts["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._counts["hits"] += 1
+            return entry[0]
+
+    def put(self, key, value):
+        """
+        Stores an entry, evicting the least recently used ones if full.
+        Args:
+            key: Key of the entry.
+            value: Value to cache, not None.
+
+        Returns:
+            bool: Whether or not the entry was stored, False if it is larger
+                than max_entry_bytes.
+        """
+        size = 0
+        if self.max_entry_bytes is not None:
+            size = self.sizeof(value)
+            if size > self.max_entry_bytes:
+                with self._lock:
+                    self._counts["oversized"] += 1
+                    self._discard(key)
+                return False
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (value, time.monotonic(), size)
+            self._bytes += size
+            while len(self._entries) > self.max_size or \
+                    (self.max_bytes is not None and
+                     self._bytes > self.max_bytes):
+                self._bytes -= self._entries.popitem(last=False)[1][2]
+                self._counts["evictions"] += 1
+        return True
+
+    def _discard(self, key):
+        """
+        Drops an entry. Called with the lock.
+        Args:
+            key: Key of the entry.
+
+        Returns:
+            bool: Whether or not there was an entry.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        self._bytes -= entry[2]
+        return True
+
+    def invalidate(self, key):
+        """
+        Drops an entry.
+        Args:
+            key: Key of the entry.
+        """
+        with self._lock:
+            if self._discard(key):
+                self._counts["invalidations"] += 1
+
+    def clear(self):
+        """
+        Drops every entry.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def metrics(self):
+        """
+        Gets counters of the cache.
+        Returns:
+            dict: Size, bytes, hit rate and counts of hits, misses,
+                evictions, expirations, invalidations and entries too large
+                to store.
+        """
+        with self._lock:
+            metrics = dict(self._counts)
+            metrics["size"] = len(self._entries)
+            metrics["bytes"] = self._bytes
+        lookups = metrics["hits"] + metrics["misses"]
+        metrics["hit_rate"] = metrics["hits"] / lookups if lookups else None
+        return metrics
+
+
+class CachedStorage(object):
+    """
+    Read-through cache of patient metadata in front of a storage backend.
+    get_patient and get_patients are answered from an LRUCache, so
+    existence checks and age lookups do not reach the database. Entries are
+    dropped by add_patient and remove_patient of this process, and expire
+    after the cache's ttl for changes made by other processes. Missing
+    patients are not cached. Everything else goes straight to the backend.
+    """
+
+    def __init__(self, storage, cache=None):
+        """
+        Args:
+            storage (HRStorage): Backend to cache.
+            cache (LRUCache): Cache of patients by normalized ID.
+        """
+        self.storage = storage
+        self.cache = cache or LRUCache()
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    def get_patient(self, patient_id):
+        """
+        Finds a patient, from the cache if possible.
+        Args:
+            patient_id (str): ID of the patient to find.
+
+        Returns:
+            object: Information of the patient. Returns None if DNE.
+        """
+        patient_id = normalize_id(patient_id)
+        patient = self.cache.get(patient_id)
+        if patient is None:
+            patient = self.storage.get_patient(patient_id)
+            if patient is not None:
+                self.cache.put(patient_id, patient)
+        return patient
+
+    def get_patients(self, patient_ids):
+        """
+        Finds many patients, reading only the uncached ones with one query.
+        Args:
+            patient_ids (list): IDs of the patients to find.
+
+        Returns:
+            dict: Patients that exist, keyed by normalized ID.
+        """
+        found = {}
+        missing = []
+        for patient_id in {normalize_id(patient_id) for patient_id in patient_ids}:
+            patient = self.cache.get(patient_id)
+            if patient is None:
+                missing.append(patient_id)
+            else:
+                found[patient_id] = patient
+        if missing:
+            loaded = self.storage.get_patients(missing)
+            for patient_id, patient in loaded.items():
+                self.cache.put(patient_id, patient)
+            found.update(loaded)
+        return found
+
+    def add_patient(self, user_info):
+        """
+        Adds a new patient.
+        Args:
+            user_info (dict): Dictionary with the user's info.
+        """
+        self.storage.add_patient(user_info)
+        self.cache.invalidate(normalize_id(user_info["patient_id"]))
+
+    def remove_patient(self, patient_id):
+        """
+        Removes a patient and its heart rates.
+        Args:
+            patient_id (str): ID of the patient to remove.
+
+        Returns:
+            bool: Whether or not the user was removed.
+        """
+        removed = self.storage.remove_patient(patient_id)
+        self.cache.invalidate(normalize_id(patient_id))
+        return removed
+
+    def after_fork(self):
+        """
+        Drops the cache of the parent process along with its connections.
+        """
+        self.cache.clear()
+        self.storage.after_fork()
+
+    def metrics(self):
+        """
+        Gets metrics of the backend and of the cache.
+        Returns:
+            dict: Metrics of the backend, with the cache's under
+                patient_cache.
+        """
+        metrics = self.storage.metrics()
+        metrics["patient_cache"] = self.cache.metrics()
+        return metrics
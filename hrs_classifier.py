@@ -0,0 +1,45 @@
+import bisect
+import numpy as np
+
+# Based on: https://en.wikipedia.org/wiki/Tachycardia
+# youngest age of each bracket, and the heart rate above which it is tachycardic
+AGE_BRACKETS = (1, 3, 5, 8, 12, 16)
+HR_THRESHOLDS = (151, 137, 133, 130, 119, 100)
+
+_AGE_BRACKETS = np.array(AGE_BRACKETS)
+# younger than the first bracket is never tachycardic
+_HR_THRESHOLDS = np.array((np.inf,) + HR_THRESHOLDS)
+
+
+def is_tachycardic(age, heart_rate):
+    """
+    Determines if a single patient is tachycardic.
+    Args:
+        age (int): Age of the patient.
+        heart_rate (int): Heart rate of the patient.
+
+    Returns:
+        bool: Whether or not the patient is tachycardic.
+    """
+    bracket = bisect.bisect_right(AGE_BRACKETS, age)
+    if bracket == 0:
+        return False
+    return heart_rate > HR_THRESHOLDS[bracket - 1]
+
+
+def classify(ages, heart_rates):
+    """
+    Determines which of many (age, heart rate) pairs are tachycardic at once.
+    The age bracket of every pair is found with a binary search over the
+    bracket table and compared against its threshold, all vectorized.
+    Args:
+        ages: Ages of the patients, integers.
+        heart_rates: Heart rates matching the ages.
+
+    Returns:
+        numpy.ndarray: Boolean array, True where tachycardic.
+    """
+    ages = np.asarray(ages)
+    heart_rates = np.asarray(heart_rates)
+    brackets = np.searchsorted(_AGE_BRACKETS, ages, side="right")
+    return heart_rates > _HR_THRESHOLDS[brackets]
@@ -1,38 +1,465 @@
+import os
 import json
+import bisect
+import datetime
+import functools
+import threading
+import numpy as np
+from pymongo import IndexModel, UpdateOne, ASCENDING, monitoring
 from pymodm import connect
 from pymodm import MongoModel, fields
+from hrs_time import parse_timestamp, format_timestamp, to_micros, \
+    from_micros, utc_now
+from hrs_downsample import aggregate
+from hrs_storage import HRStorage, SAMPLE_FIELDS, PATIENT_FIELDS, \
+    normalize_id, aggregate_stats
+
+# samples are chunked into one HRBucket document per patient per span
+BUCKET_SPAN = datetime.timedelta(hours=1)
+_EPOCH = datetime.datetime(1970, 1, 1)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+# resolution of the rollups kept in each bucket besides the bucket itself
+ROLLUP_SPAN = datetime.timedelta(minutes=1)
+# config.json keys of MongoClient options, HRS_<KEY> overrides them
+CLIENT_OPTIONS = {
+    "mongo_max_pool_size": ("maxPoolSize", int),
+    "mongo_min_pool_size": ("minPoolSize", int),
+    "mongo_wait_queue_timeout_ms": ("waitQueueTimeoutMS", int),
+    "mongo_max_idle_time_ms": ("maxIdleTimeMS", int),
+    "mongo_connect_timeout_ms": ("connectTimeoutMS", int),
+    "mongo_server_selection_timeout_ms": ("serverSelectionTimeoutMS", int),
+    "mongo_socket_timeout_ms": ("socketTimeoutMS", int),
+    "mongo_read_preference": ("readPreference", str),
+}
+# pymongo's default, when mongo_max_pool_size is not set
+DEFAULT_MAX_POOL_SIZE = 100
 
 
 class Patient(MongoModel):
     patient_id = fields.CharField(primary_key=True)
     attending_email = fields.EmailField()
     user_age = fields.IntegerField()
-    heart_rates = fields.ListField()
-    timestamps = fields.ListField()
+    # bumped after every write to the patient, see HRStorage.get_version
+    version = fields.IntegerField(default=0)
+    # running aggregates over every sample, maintained by add_hr
+    sample_count = fields.IntegerField(default=0)
+    hr_sum = fields.IntegerField(default=0)
+    hr_sum_sq = fields.IntegerField(default=0)
+    hr_min = fields.IntegerField(blank=True)
+    hr_max = fields.IntegerField(blank=True)
+    last_heart_rate = fields.IntegerField(blank=True)
+    # microseconds since epoch, mongo dates would drop the microseconds
+    last_timestamp = fields.IntegerField(blank=True)
+    # status of the last sample, evaluated when it was posted
+    last_is_tachycardic = fields.BooleanField(blank=True)
+
+    class Meta:
+        # raw updates and bulk writes never set _cls
+        final = True
+        # documents from before bucketing still carry heart_rates/timestamps
+        ignore_unknown_fields = True
+
+
+class HRBucket(MongoModel):
+    """
+    Heart rates of one patient within one BUCKET_SPAN. Samples are stored as
+    parallel arrays of microsecond offsets from start and heart rates, next
+    to hourly and per minute rollups of them.
+    """
+    patient_id = fields.CharField()
+    start = fields.DateTimeField()
+    offsets = fields.ListField(fields.IntegerField())
+    heart_rates = fields.ListField(fields.IntegerField())
+    count = fields.IntegerField()
+    # rollups maintained on ingest, for downsampling without the samples
+    hr_sum = fields.IntegerField(blank=True)
+    hr_min = fields.IntegerField(blank=True)
+    hr_max = fields.IntegerField(blank=True)
+    # count, sum, min and max per minute, keyed by minute of the hour
+    minutes = fields.DictField(blank=True)
+
+    class Meta:
+        final = True
+        indexes = [
+            IndexModel([("patient_id", ASCENDING), ("start", ASCENDING)],
+                       unique=True),
+        ]
+
+
+def mongo_settings(config):
+    """
+    Reads the mongo URI and client options. HRS_MONGO_URI and the
+    HRS_MONGO_* variables override the matching keys of config.json.
+    Without a URI one is built from mongo_user and mongo_pass for the mlab
+    sandbox.
+    Args:
+        config (dict): Contents of config.json.
+
+    Returns:
+        tuple: URI, None if not configured, and a dict of MongoClient
+            options.
+    """
+    url = os.environ.get("HRS_MONGO_URI", config.get("mongo_uri"))
+    if url is None and "mongo_user" in config:
+        url = "mongodb://{}:{}@ds041337.mlab.com:41337/heart_rate_sentinel".format(
+            config["mongo_user"], config["mongo_pass"])
+    options = {}
+    for key, (option, kind) in CLIENT_OPTIONS.items():
+        value = os.environ.get("HRS_" + key.upper(), config.get(key))
+        if value is not None:
+            options[option] = kind(value)
+    return url, options
+
 
+def _connected(method):
+    """
+    Decorates HRDatabase methods that use the database, so the first of
+    them to be called connects.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self._connect()
+        return method(self, *args, **kwargs)
+    return wrapper
+
+
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    """
+    Counts connection pool events of one MongoClient, to report how much of
+    the pool is in use.
+    """
 
-class HRDatabase(object):
     def __init__(self):
-        with open("config.json", 'r') as f:
-            config_info = json.load(f)
-            db_user = config_info["mongo_user"]
-            db_pass = config_info["mongo_pass"]
+        self._lock = threading.Lock()
+        self._counts = dict.fromkeys(
+            ("created", "closed", "checked_out", "checked_in",
+             "checkout_failed", "pool_cleared"), 0)
+        self._peak_in_use = 0
+
+    def _count(self, name):
+        with self._lock:
+            self._counts[name] += 1
+            in_use = self._counts["checked_out"] - self._counts["checked_in"]
+            self._peak_in_use = max(self._peak_in_use, in_use)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._count("pool_cleared")
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._count("created")
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._count("closed")
 
-            url = "mongodb://{}:{}@ds041337.mlab.com:41337/heart_rate_sentinel".format(
-                db_user, db_pass)
-            connect(url)
+    def connection_check_out_started(self, event):
+        pass
 
-    def get_all(self):
+    def connection_check_out_failed(self, event):
+        self._count("checkout_failed")
+
+    def connection_checked_out(self, event):
+        self._count("checked_out")
+
+    def connection_checked_in(self, event):
+        self._count("checked_in")
+
+    def metrics(self):
         """
-        Obtains a dictionary of every patient, accessible by ID. Testing only!
+        Gets the counters.
         Returns:
-            dict: Patients in the database
+            dict: Event counts, plus open, in_use and peak_in_use
+                connections.
         """
-        ret_json = {}
-        for user in Patient.objects.all():
-            ret_json[user.patient_id] = self.convert_to_json(user)
-        return ret_json
+        with self._lock:
+            metrics = dict(self._counts)
+            metrics["peak_in_use"] = self._peak_in_use
+        metrics["open"] = metrics["created"] - metrics["closed"]
+        metrics["in_use"] = metrics["checked_out"] - metrics["checked_in"]
+        return metrics
+
+
+def _bucket_start(timestamp):
+    """
+    Finds the start of the bucket a timestamp falls into.
+    Args:
+        timestamp (datetime.datetime): Timestamp of a sample.
+
+    Returns:
+        datetime.datetime: Start of the bucket.
+    """
+    return _EPOCH + ((timestamp - _EPOCH) // BUCKET_SPAN) * BUCKET_SPAN
+
+
+def _sorted_samples(bucket):
+    """
+    Gets the samples of a bucket in time order. Samples are appended in
+    arrival order, which is almost always time order already.
+    Args:
+        bucket (HRBucket): Bucket to read.
+
+    Returns:
+        tuple: List of sorted offsets and list of matching heart rates.
+    """
+    offsets = bucket.offsets
+    if all(a <= b for a, b in zip(offsets, offsets[1:])):
+        return offsets, bucket.heart_rates
+    order = sorted(range(len(offsets)), key=offsets.__getitem__)
+    return ([offsets[i] for i in order],
+            [bucket.heart_rates[i] for i in order])
+
+
+def _aggregate_push(patient_id, samples):
+    """
+    Builds the updates that fold samples into a patient's running
+    aggregates. The last sample only moves forward in time, so concurrent
+    and out of order writers agree on it.
+    Args:
+        patient_id (str): Normalized ID of the patient.
+        samples (list): (heart_rate, timestamp, is_tachycardic) tuples.
+
+    Returns:
+        list: (filter, update) pairs for the patient collection.
+    """
+    hrs = [sample[0] for sample in samples]
+    last_hr, last_ts, last_status = max(
+        ((heart_rate, parse_timestamp(timestamp), is_tachycardic)
+         for heart_rate, timestamp, is_tachycardic in samples),
+        key=lambda sample: sample[1])
+    last_ts = to_micros(last_ts)
+    return [
+        ({"_id": patient_id}, {
+            "$inc": {
+                "sample_count": len(hrs),
+                "hr_sum": sum(hrs),
+                "hr_sum_sq": sum(heart_rate * heart_rate for heart_rate in hrs),
+            },
+            "$min": {"hr_min": min(hrs)},
+            "$max": {"hr_max": max(hrs)},
+        }),
+        ({"_id": patient_id, "last_timestamp": {"$not": {"$gt": last_ts}}}, {
+            "$set": {
+                "last_heart_rate": last_hr,
+                "last_timestamp": last_ts,
+                "last_is_tachycardic": last_status,
+            },
+        }),
+    ]
+
+
+def _bucket_push(patient_id, samples):
+    """
+    Builds the upserts that append samples to a patient's buckets and fold
+    them into the bucket's hourly and per minute rollups.
+    Args:
+        patient_id (str): Normalized ID of the patient.
+        samples (list): (heart_rate, timestamp, is_tachycardic) tuples.
+
+    Returns:
+        list: One (filter, update) pair per bucket touched.
+    """
+    grouped = {}
+    for heart_rate, timestamp, _ in samples:
+        timestamp = parse_timestamp(timestamp)
+        start = _bucket_start(timestamp)
+        offsets, hrs = grouped.setdefault(start, ([], []))
+        offsets.append((timestamp - start) // _MICROSECOND)
+        hrs.append(heart_rate)
+
+    updates = []
+    for start, (offsets, hrs) in grouped.items():
+        inc = {"count": len(hrs), "hr_sum": sum(hrs)}
+        low = {"hr_min": min(hrs)}
+        high = {"hr_max": max(hrs)}
+        by_minute = {}
+        for offset, heart_rate in zip(offsets, hrs):
+            minute = offset // (ROLLUP_SPAN // _MICROSECOND)
+            by_minute.setdefault("minutes.{:02d}".format(minute), []).append(
+                heart_rate)
+        for key, minute_hrs in by_minute.items():
+            inc[key + ".count"] = len(minute_hrs)
+            inc[key + ".sum"] = sum(minute_hrs)
+            low[key + ".min"] = min(minute_hrs)
+            high[key + ".max"] = max(minute_hrs)
+        updates.append(({"patient_id": patient_id, "start": start}, {
+            "$push": {
+                "offsets": {"$each": offsets},
+                "heart_rates": {"$each": hrs},
+            },
+            "$inc": inc,
+            "$min": low,
+            "$max": high,
+        }))
+    return updates
+
 
+def _bucket_rollups(bucket, span):
+    """
+    Gets the rollups of a bucket. Buckets holding samples from before
+    rollups existed are summarized from their samples instead.
+    Args:
+        bucket (dict): Raw bucket document.
+        span (datetime.timedelta): BUCKET_SPAN or ROLLUP_SPAN.
+
+    Returns:
+        list: (start, count, sum, min, max) rows, start in microseconds
+            since epoch.
+    """
+    start = to_micros(bucket["start"])
+    minutes = bucket.get("minutes", {})
+    if sum(rollup["count"] for rollup in minutes.values()) != bucket["count"]:
+        bucket = HRBucket._mongometa.collection.find_one({"_id": bucket["_id"]})
+        offsets = np.asarray(bucket["offsets"], dtype=np.int64)
+        hrs = np.asarray(bucket["heart_rates"], dtype=np.int64)
+        order = np.argsort(offsets, kind="stable")
+        rows = aggregate(start + offsets[order], np.ones_like(hrs),
+                         hrs[order], hrs[order], hrs[order],
+                         span // _MICROSECOND)
+        return [tuple(int(value) for value in row) for row in zip(*rows)]
+    if span == BUCKET_SPAN:
+        return [(start, bucket["count"], bucket["hr_sum"], bucket["hr_min"],
+                 bucket["hr_max"])]
+    minute_micros = ROLLUP_SPAN // _MICROSECOND
+    return [(start + int(minute) * minute_micros, rollup["count"],
+             rollup["sum"], rollup["min"], rollup["max"])
+            for minute, rollup in sorted(minutes.items())]
+
+
+class HRDatabase(HRStorage):
+    """
+    Storage backend on MongoDB.
+    """
+
+    def __init__(self, url=None, **client_options):
+        """
+        Sets up the mongo database. Nothing connects until the database is
+        first used, so importing and forking stay cheap.
+        Args:
+            url (str): Mongo URI. Read through mongo_settings from the
+                environment and config.json on first use if not given.
+            client_options: Options for the MongoClient, e.g. maxPoolSize.
+        """
+        super(HRDatabase, self).__init__()
+        self.url = url
+        self.client_options = client_options
+        self._pid = None
+        self._pool_monitor = None
+        self._connect_lock = threading.Lock()
+
+    def _connect(self):
+        """
+        Connects to the database if this process is not connected yet. A
+        client does not survive a fork, so every forked worker builds its
+        own client and pool on first use instead of sharing sockets.
+        """
+        if self._pid == os.getpid():
+            return
+        with self._connect_lock:
+            if self._pid == os.getpid():
+                return
+            if self.url is None:
+                with open("config.json", 'r') as f:
+                    self.url, options = mongo_settings(json.load(f))
+                self.client_options = dict(options, **self.client_options)
+            if self.url is None:
+                raise ValueError("No mongo URI configured.")
+            monitor = PoolMonitor()
+            connect(self.url, event_listeners=[monitor], **self.client_options)
+            self._pool_monitor = monitor
+            self._pid = os.getpid()
+
+    def after_fork(self):
+        """
+        Forgets the connection of the parent process, so this worker builds
+        its own pool on first use.
+        """
+        self._pid = None
+        self._pool_monitor = None
+
+    def metrics(self):
+        """
+        Gets the connection pool settings and utilization of this worker.
+        Returns:
+            dict: backend, pid, connected, max_pool_size, and the counters
+                of PoolMonitor with utilization, the fraction of the pool in
+                use.
+        """
+        metrics = super(HRDatabase, self).metrics()
+        max_pool_size = self.client_options.get(
+            "maxPoolSize", DEFAULT_MAX_POOL_SIZE)
+        metrics.update({
+            "pid": os.getpid(),
+            "connected": self._pid == os.getpid(),
+            "max_pool_size": max_pool_size,
+        })
+        monitor = self._pool_monitor
+        if metrics["connected"] and monitor is not None:
+            metrics.update(monitor.metrics())
+            if max_pool_size:
+                metrics["utilization"] = metrics["in_use"] / max_pool_size
+        return metrics
+
+    def _query(self, patient_id):
+        """
+        Builds a primary key query for a single patient.
+        Args:
+            patient_id: ID of the patient.
+
+        Returns:
+            QuerySet: Query matching only that patient.
+        """
+        return Patient.objects.raw({"_id": normalize_id(patient_id)})
+
+    @_connected
+    def iter_patients(self, after=None, limit=None, fields=PATIENT_FIELDS):
+        """
+        Iterates over patients in ID order from a database cursor, so only a
+        batch of patients is in memory at a time.
+        Args:
+            after: Only patients with an ID after this one, for paging.
+            limit (int): Maximum number of patients.
+            fields (tuple): Fields of PATIENT_FIELDS to include. Samples are
+                only read if heart_rates or timestamps are asked for.
+
+        Returns:
+            generator: Json dictionaries of the patients.
+        """
+        query = {}
+        if after is not None:
+            query["_id"] = {"$gt": normalize_id(after)}
+        projection = {field: 1 for field in fields
+                      if field not in ("patient_id",) + SAMPLE_FIELDS}
+        cursor = Patient._mongometa.collection.find(
+            query, projection, batch_size=500).sort("_id", ASCENDING)
+        if limit is not None:
+            cursor = cursor.limit(limit)
+
+        with_samples = any(field in fields for field in SAMPLE_FIELDS)
+        for user in cursor:
+            patient = {}
+            for field in fields:
+                if field == "patient_id":
+                    patient[field] = user["_id"]
+                elif field not in SAMPLE_FIELDS:
+                    patient[field] = user.get(field)
+            if with_samples:
+                timestamps, heart_rates = self.get_samples(user["_id"])
+                if "heart_rates" in fields:
+                    patient["heart_rates"] = heart_rates
+                if "timestamps" in fields:
+                    patient["timestamps"] = [format_timestamp(ts)
+                                             for ts in timestamps]
+            yield patient
+
+    @_connected
     def add_patient(self, user_info):
         """
         Adds a new patient into the database.
@@ -43,12 +470,14 @@ class HRDatabase(object):
         if patient:
             raise ValueError("The patient is already in the database.")
 
-        p = Patient(patient_id=user_info["patient_id"],
+        p = Patient(patient_id=normalize_id(user_info["patient_id"]),
                     attending_email=user_info["attending_email"],
                     user_age=user_info["user_age"],
+                    version=to_micros(utc_now()),
                     )
         p.save()
 
+    @_connected
     def remove_patient(self, patient_id):
         """
         Removes the patient from the database.
@@ -58,65 +487,377 @@ class HRDatabase(object):
         Returns:
             bool: Whether or not the user was removed.
         """
-        removed = False
-        # raw won't work for some reason
-        for user in Patient.objects.all():
-            if str(user.patient_id) == patient_id:
-                removed = True
-                user.delete()
-        return removed
+        HRBucket.objects.raw({"patient_id": normalize_id(patient_id)}).delete()
+        self._drop_index(normalize_id(patient_id))
+        return self._query(patient_id).delete() > 0
 
+    @_connected
     def get_patient(self, patient_id):
         """
         Finds the patient from the database.
         Args:
-            patient_id (str): ID of the patient to remove
+            patient_id (str): ID of the patient to find.
 
         Returns:
-            dict: Information of the patient. Returns None if DNE.
+            Patient: Information of the patient. Returns None if DNE.
+
+        """
+        try:
+            return self._query(patient_id).first()
+        except Patient.DoesNotExist:
+            return None
+
+    @_connected
+    def get_patients(self, patient_ids):
+        """
+        Finds many patients with a single query.
+        Args:
+            patient_ids (list): IDs of the patients to find.
 
+        Returns:
+            dict: Patients that exist, keyed by normalized ID.
         """
-        # raw won't work for some weird reason...
-        for user in Patient.objects.all():
-            if str(user.patient_id) == patient_id:
-                return user
-        return None
+        patient_ids = list({normalize_id(patient_id)
+                            for patient_id in patient_ids})
+        if not patient_ids:
+            return {}
+        users = Patient.objects.raw({"_id": {"$in": patient_ids}})
+        return {user.patient_id: user for user in users}
 
-    def add_hr(self, patient_id, heart_rate, timestamp):
+    @_connected
+    def add_hr(self, patient_id, heart_rate, timestamp, is_tachycardic=None):
         """
-        Adds a heart rate and corresponding timestamp to a user.
+        Adds a heart rate and corresponding timestamp to a user. The running
+        aggregates are updated atomically, then the sample is pushed server
+        side into the bucket covering its timestamp, so the cost does not
+        grow with the patient's history.
         Args:
             patient_id: ID of the patient to add hr to.
             heart_rate: New heart rate.
             timestamp: New timestamp.
+            is_tachycardic (bool): Status of the sample, kept as the patient's
+                status while it is the latest sample.
+
+        Returns:
+            bool: Whether or not the patient exists.
+        """
+        patient_id = normalize_id(patient_id)
+        sample = [(heart_rate, timestamp, is_tachycardic)]
+        result = Patient._mongometa.collection.bulk_write([
+            UpdateOne(query, update)
+            for query, update in _aggregate_push(patient_id, sample)
+        ])
+        if result.matched_count == 0:
+            return False
+        (query, update), = _bucket_push(patient_id, sample)
+        HRBucket._mongometa.collection.update_one(query, update, upsert=True)
+        # only once the sample is in its bucket
+        Patient._mongometa.collection.update_one(
+            {"_id": patient_id}, {"$inc": {"version": 1}})
+        return True
+
+    @_connected
+    def add_hr_batch(self, samples):
+        """
+        Adds many heart rates across many patients. Samples are grouped by
+        patient and bucket and written with one bulk write per collection.
+        Args:
+            samples (list): (patient_id, heart_rate, timestamp) tuples, with
+                an optional fourth element is_tachycardic as in add_hr.
+
+        Returns:
+            set: Normalized IDs of the patients that exist and were written.
         """
-        user_exists = False
-        query = {
-            "patient_id": patient_id
-        }
-        for user in Patient.objects.all():
-            if str(user.patient_id) == patient_id:
-                user.heart_rates.append(heart_rate)
-                user.timestamps.append(timestamp)
-                user.save()
-                user_exists = True
-        return user_exists
+        grouped = {}
+        for sample in samples:
+            is_tachycardic = sample[3] if len(sample) > 3 else None
+            grouped.setdefault(normalize_id(sample[0]), []).append(
+                (sample[1], sample[2], is_tachycardic))
+        if not grouped:
+            return set()
+
+        existing = Patient.objects.raw({"_id": {"$in": list(grouped)}})
+        existing = {user["_id"] for user in existing.only("patient_id").values()}
+        if not existing:
+            return existing
+        self._bulk_push(
+            {patient_id: grouped[patient_id] for patient_id in existing})
+        return existing
 
-    def convert_to_json(self, db_object):
+    def _bulk_push(self, grouped):
         """
-        Converts a database entry into a json object.
+        Writes samples of several patients to their aggregates and buckets.
         Args:
-            db_object: Database entry.
+            grouped (dict): (heart_rate, timestamp, is_tachycardic) tuples
+                keyed by normalized patient ID.
+        """
+        aggregates = []
+        buckets = []
+        for patient_id, samples in grouped.items():
+            aggregates.extend(UpdateOne(query, update) for query, update
+                              in _aggregate_push(patient_id, samples))
+            buckets.extend(UpdateOne(query, update, upsert=True)
+                           for query, update in _bucket_push(patient_id, samples))
+        Patient._mongometa.collection.bulk_write(aggregates)
+        HRBucket._mongometa.collection.bulk_write(buckets, ordered=False)
+        # only once the samples are in their buckets
+        Patient._mongometa.collection.update_many(
+            {"_id": {"$in": list(grouped)}}, {"$inc": {"version": 1}})
+
+    @_connected
+    def reclassify(self, classify, chunk_size=10000):
+        """
+        Re-evaluates the stored status of every patient's latest sample, e.g.
+        after the thresholds changed. Patients are read and written in chunks
+        and each chunk is classified with one call. A status is only written
+        if no newer sample arrived in the meantime.
+        Args:
+            classify: Function of (ages, heart_rates) arrays returning an array
+                of statuses.
+            chunk_size (int): Patients per chunk.
 
         Returns:
-            dict: Dictionary of the database entry.
+            tuple: Number of patients evaluated, and of statuses changed.
+        """
+        collection = Patient._mongometa.collection
+        cursor = collection.find(
+            {"sample_count": {"$gt": 0}},
+            {"user_age": 1, "last_heart_rate": 1, "last_timestamp": 1,
+             "last_is_tachycardic": 1},
+            batch_size=chunk_size)
+        evaluated = 0
+        changed = 0
+        chunk = []
+        for user in cursor:
+            chunk.append(user)
+            if len(chunk) < chunk_size:
+                continue
+            changed += self._reclassify_chunk(chunk, classify)
+            evaluated += len(chunk)
+            chunk = []
+        if chunk:
+            changed += self._reclassify_chunk(chunk, classify)
+            evaluated += len(chunk)
+        return evaluated, changed
 
+    def _reclassify_chunk(self, users, classify):
+        """
+        Classifies one chunk of reclassify and writes the changed statuses.
+        Returns:
+            int: Number of statuses changed.
+        """
+        statuses = classify([user["user_age"] for user in users],
+                            [user["last_heart_rate"] for user in users])
+        writes = [
+            UpdateOne({"_id": user["_id"],
+                       "last_timestamp": user["last_timestamp"]},
+                      {"$set": {"last_is_tachycardic": bool(status)},
+                       "$inc": {"version": 1}})
+            for user, status in zip(users, statuses)
+            if user.get("last_is_tachycardic") != bool(status)
+        ]
+        if not writes:
+            return 0
+        return Patient._mongometa.collection.bulk_write(
+            writes, ordered=False).modified_count
+
+    @_connected
+    def get_stats(self, patient_id):
+        """
+        Reads the running aggregates of a patient. Never touches the samples.
+        Args:
+            patient_id: ID of the patient.
+
+        Returns:
+            dict: count, mean, min, max, variance, last_heart_rate,
+                last_timestamp and last_is_tachycardic. Returns None if the
+                patient DNE.
+        """
+        fields = ("sample_count", "hr_sum", "hr_sum_sq", "hr_min", "hr_max",
+                  "last_heart_rate", "last_timestamp", "last_is_tachycardic")
+        user = Patient._mongometa.collection.find_one(
+            {"_id": normalize_id(patient_id)}, {field: 1 for field in fields})
+        if user is None:
+            return None
+
+        return aggregate_stats(*(user.get(field) for field in fields))
+
+    @_connected
+    def get_version(self, patient_id):
+        """
+        Reads the version of a patient. Writes bump it after the samples are
+        in their buckets, so a reader never sees a version whose samples are
+        missing.
+        Args:
+            patient_id: ID of the patient.
+
+        Returns:
+            int: Version of the patient. Returns None if the patient DNE.
+        """
+        user = Patient._mongometa.collection.find_one(
+            {"_id": normalize_id(patient_id)}, {"version": 1})
+        if user is None:
+            return None
+        # patients from before versions have none
+        return user.get("version", 0)
+
+    def _buckets(self, patient_id, since=None, until=None):
+        """
+        Finds the buckets of a patient that can hold samples in a time range.
+        Args:
+            patient_id: ID of the patient.
+            since (datetime.datetime): Earliest timestamp of interest.
+            until (datetime.datetime): End of the range, exclusive.
+
+        Returns:
+            QuerySet: Matching buckets ordered by start.
+        """
+        query = {"patient_id": normalize_id(patient_id)}
+        start = {}
+        if since is not None:
+            start["$gte"] = _bucket_start(since)
+        if until is not None:
+            start["$lt"] = until
+        if start:
+            query["start"] = start
+        return HRBucket.objects.raw(query).order_by([("start", ASCENDING)])
+
+    @_connected
+    def iter_samples(self, patient_id, since=None, until=None):
+        """
+        Iterates over the heart rates of a patient with since <= timestamp <
+        until, in time order. Buckets overlapping the range are found with an
+        indexed range query and fetched lazily from the cursor, and only the
+        two boundary buckets are binary searched.
+        Args:
+            patient_id: ID of the patient.
+            since (datetime.datetime): Start of the range. Unbounded if None.
+            until (datetime.datetime): End of the range. Unbounded if None.
+
+        Returns:
+            generator: (timestamp, heart_rate) tuples.
+        """
+        for bucket in self._buckets(patient_id, since, until):
+            offsets, hrs = _sorted_samples(bucket)
+            lo, hi = 0, len(offsets)
+            if since is not None and since > bucket.start:
+                lo = bisect.bisect_left(
+                    offsets, (since - bucket.start) // _MICROSECOND)
+            if until is not None and until < bucket.start + BUCKET_SPAN:
+                hi = bisect.bisect_left(
+                    offsets, (until - bucket.start) // _MICROSECOND)
+            for offset, heart_rate in zip(offsets[lo:hi], hrs[lo:hi]):
+                yield bucket.start + offset * _MICROSECOND, heart_rate
+
+    @_connected
+    def _sample_arrays(self, patient_id, since=None, until=None):
+        """
+        Reads the samples of a patient into arrays, for indexing.
+        Args:
+            patient_id: ID of the patient.
+            since (int): Earliest timestamp to read, in microseconds since
+                epoch.
+            until (int): End of the range to read, exclusive, in microseconds
+                since epoch.
+
+        Returns:
+            tuple: Sorted timestamps in microseconds since epoch and the
+                matching heart rates, both numpy arrays.
+        """
+        since_ts = None if since is None else from_micros(since)
+        until_ts = None if until is None else from_micros(until)
+        timestamps = []
+        heart_rates = []
+        for bucket in self._buckets(patient_id, since_ts, until_ts).values():
+            offsets = np.asarray(bucket["offsets"], dtype=np.int64)
+            order = np.argsort(offsets, kind="stable")
+            timestamps.append(offsets[order] + to_micros(bucket["start"]))
+            heart_rates.append(
+                np.asarray(bucket["heart_rates"], dtype=np.int64)[order])
+        if not timestamps:
+            return np.empty(0, np.int64), np.empty(0, np.int64)
+
+        timestamps = np.concatenate(timestamps)
+        heart_rates = np.concatenate(heart_rates)
+        keep = np.ones(len(timestamps), dtype=bool)
+        if since is not None:
+            keep &= timestamps >= since
+        if until is not None:
+            keep &= timestamps < until
+        return timestamps[keep], heart_rates[keep]
+
+    def _rollups(self, patient_id, span, since=None, until=None):
+        """
+        Reads the rollups of a patient without the samples behind them.
+        Args:
+            patient_id: ID of the patient.
+            span (datetime.timedelta): BUCKET_SPAN or ROLLUP_SPAN.
+            since (datetime.datetime): Start of the range, aligned to span.
+            until (datetime.datetime): End of the range, exclusive, aligned
+                to span.
+
+        Returns:
+            tuple: Arrays of rollup starts in microseconds since epoch,
+                counts, sums, minimums and maximums.
+        """
+        buckets = self._buckets(patient_id, since, until).only(
+            "start", "count", "hr_sum", "hr_min", "hr_max", "minutes")
+        rows = [row for bucket in buckets.values()
+                for row in _bucket_rollups(bucket, span)]
+        since = None if since is None else to_micros(since)
+        until = None if until is None else to_micros(until)
+        rows = [row for row in rows if (since is None or row[0] >= since) and
+                (until is None or row[0] < until)]
+        if not rows:
+            return (np.empty(0, dtype=np.int64),) * 5
+        return tuple(np.array(column, dtype=np.int64) for column in zip(*rows))
+
+    @_connected
+    def downsample(self, patient_id, width, since=None, until=None):
+        """
+        Summarizes the heart rates of a patient with since <= timestamp <
+        until per bucket of width, aligned to the epoch. The hourly or per
+        minute rollups are read instead of the samples whenever width and
+        the window line up with them.
+        Args:
+            patient_id: ID of the patient.
+            width (datetime.timedelta): Width of the buckets.
+            since (datetime.datetime): Start of the window. Unbounded if None.
+            until (datetime.datetime): End of the window. Unbounded if None.
+
+        Returns:
+            tuple: Arrays of bucket starts in microseconds since epoch,
+                counts, sums, minimums and maximums. Empty buckets are left
+                out.
+        """
+        zero = datetime.timedelta(0)
+        for span in (BUCKET_SPAN, ROLLUP_SPAN):
+            if width % span == zero and all(
+                    timestamp is None or (timestamp - _EPOCH) % span == zero
+                    for timestamp in (since, until)):
+                rows = self._rollups(patient_id, span, since, until)
+                return aggregate(*rows, width // _MICROSECOND)
+
+        return super(HRDatabase, self).downsample(patient_id, width, since, until)
+
+    @_connected
+    def migrate_legacy_samples(self):
+        """
+        Moves heart rates stored inline on patient documents (the layout from
+        before bucketing) into buckets.
+
+        Returns:
+            int: Number of patients migrated.
         """
-        patient = {
-            "patient_id": db_object.patient_id,
-            "attending_email": db_object.attending_email,
-            "user_age": db_object.user_age,
-            "heart_rates": db_object.heart_rates,
-            "timestamps": db_object.timestamps,
-        }
-        return patient
+        collection = Patient._mongometa.collection
+        migrated = 0
+        for user in collection.find({"heart_rates": {"$exists": True}}):
+            samples = [(heart_rate, timestamp, None) for heart_rate, timestamp
+                       in zip(user.get("heart_rates", []),
+                              user.get("timestamps", []))]
+            if samples:
+                self._bulk_push({user["_id"]: samples})
+            collection.update_one({"_id": user["_id"]}, {
+                "$unset": {"heart_rates": "", "timestamps": ""}})
+            migrated += 1
+        return migrated
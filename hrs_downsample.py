@@ -0,0 +1,69 @@
+import numpy as np
+
+
+def aggregate(starts, counts, sums, mins, maxs, width):
+    """
+    Merges summarized rows, e.g. minute rollups, into buckets of a fixed
+    width aligned to the epoch. Raw samples are rows with a count of one.
+    Args:
+        starts: Start of every row in microseconds since epoch, sorted.
+        counts: Number of samples of every row.
+        sums: Sum of the heart rates of every row.
+        mins: Minimum heart rate of every row.
+        maxs: Maximum heart rate of every row.
+        width (int): Width of the buckets in microseconds.
+
+    Returns:
+        tuple: Arrays of bucket starts, counts, sums, minimums and maximums.
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    if len(starts) == 0:
+        return (np.empty(0, dtype=np.int64),) * 5
+    keys = starts // width
+    first = np.concatenate(([0], np.flatnonzero(np.diff(keys)) + 1))
+    count = np.add.reduceat(np.asarray(counts, dtype=np.int64), first)
+    total = np.add.reduceat(np.asarray(sums, dtype=np.int64), first)
+    low = np.minimum.reduceat(np.asarray(mins, dtype=np.int64), first)
+    high = np.maximum.reduceat(np.asarray(maxs, dtype=np.int64), first)
+    return keys[first] * width, count, total, low, high
+
+
+def lttb(x, y, threshold):
+    """
+    Reduces a series to threshold points with Largest-Triangle-Three-Buckets,
+    which keeps the visual shape of the series. The first and last points
+    are always kept. Each bucket picks the point spanning the largest
+    triangle with the previous pick and the mean of the next bucket.
+    Args:
+        x: Sorted x values, e.g. timestamps.
+        y: Values matching x.
+        threshold (int): Number of points to keep, at least 3.
+
+    Returns:
+        numpy.ndarray: Indices of the kept points, increasing.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    # edges of the threshold - 2 buckets between the first and last point
+    edges = (np.arange(threshold - 1) * (n - 2) / (threshold - 2)).astype(
+        np.int64) + 1
+    edges[-1] = n - 1
+
+    picked = np.empty(threshold, dtype=np.int64)
+    picked[0], picked[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        lo, hi = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_x = x[hi:edges[i + 2]].mean()
+            next_y = y[hi:edges[i + 2]].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+        area = np.abs((x[a] - next_x) * (y[lo:hi] - y[a]) -
+                      (x[a] - x[lo:hi]) * (next_y - y[a]))
+        a = lo + int(np.argmax(area))
+        picked[i + 1] = a
+    return picked
@@ -0,0 +1,179 @@
+import numpy as np
+
+_INITIAL_CAPACITY = 1024
+_INT64 = np.iinfo(np.int64)
+
+
+class IntervalIndex(object):
+    """
+    Answers count, mean, min and max of a patient's heart rates over any
+    [since, until) window in O(log n). Timestamps are kept sorted in a
+    growable array, sums come from prefix sums and min/max from segment
+    trees. Samples may only be appended in time order.
+    """
+
+    def __init__(self, timestamps=None, heart_rates=None):
+        """
+        Creates the index, optionally from existing samples.
+        Args:
+            timestamps: Sample times in microseconds since epoch, sorted.
+            heart_rates: Heart rates matching the timestamps.
+        """
+        self._n = 0
+        self._capacity = 0
+        self._ts = np.empty(0, dtype=np.int64)
+        self._csum = np.zeros(1, dtype=np.int64)
+        self._csq = np.zeros(1, dtype=np.int64)
+        self._min_tree = np.empty(0, dtype=np.int64)
+        self._max_tree = np.empty(0, dtype=np.int64)
+        if timestamps is not None:
+            self.extend(timestamps, heart_rates)
+
+    def __len__(self):
+        return self._n
+
+    @property
+    def last_timestamp(self):
+        """
+        int: Latest timestamp in the index, None if empty.
+        """
+        if self._n == 0:
+            return None
+        return int(self._ts[self._n - 1])
+
+    def _grow(self, n):
+        """
+        Doubles the capacity until n samples fit, rebuilding the trees.
+        Args:
+            n (int): Number of samples that must fit.
+        """
+        capacity = max(self._capacity, _INITIAL_CAPACITY)
+        while capacity < n:
+            capacity *= 2
+        if capacity == self._capacity:
+            return
+
+        ts = np.empty(capacity, dtype=np.int64)
+        ts[:self._n] = self._ts[:self._n]
+        csum = np.zeros(capacity + 1, dtype=np.int64)
+        csum[:self._n + 1] = self._csum[:self._n + 1]
+        csq = np.zeros(capacity + 1, dtype=np.int64)
+        csq[:self._n + 1] = self._csq[:self._n + 1]
+
+        min_tree = np.full(2 * capacity, _INT64.max, dtype=np.int64)
+        max_tree = np.full(2 * capacity, _INT64.min, dtype=np.int64)
+        if self._n:
+            old = self._capacity
+            min_tree[capacity:capacity + self._n] = \
+                self._min_tree[old:old + self._n]
+            max_tree[capacity:capacity + self._n] = \
+                self._max_tree[old:old + self._n]
+
+        self._ts, self._csum, self._csq = ts, csum, csq
+        self._min_tree, self._max_tree = min_tree, max_tree
+        self._capacity = capacity
+        self._update_parents(0, self._n)
+
+    def _update_parents(self, lo, hi):
+        """
+        Recomputes the tree nodes above leaves [lo, hi), level by level.
+        Args:
+            lo (int): First changed leaf.
+            hi (int): One past the last changed leaf.
+        """
+        lo += self._capacity
+        hi += self._capacity - 1
+        while lo > 1:
+            lo //= 2
+            hi //= 2
+            left = np.arange(2 * lo, 2 * hi + 1, 2)
+            self._min_tree[lo:hi + 1] = np.minimum(
+                self._min_tree[left], self._min_tree[left + 1])
+            self._max_tree[lo:hi + 1] = np.maximum(
+                self._max_tree[left], self._max_tree[left + 1])
+
+    def extend(self, timestamps, heart_rates):
+        """
+        Appends samples to the index.
+        Args:
+            timestamps: Sample times in microseconds since epoch, sorted and
+                not earlier than the last timestamp already indexed.
+            heart_rates: Heart rates matching the timestamps.
+        """
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        heart_rates = np.asarray(heart_rates, dtype=np.int64)
+        k = len(timestamps)
+        if k == 0:
+            return
+        if np.any(np.diff(timestamps) < 0) or \
+                (self._n and timestamps[0] < self._ts[self._n - 1]):
+            raise ValueError("Samples must be appended in time order.")
+
+        lo, hi = self._n, self._n + k
+        self._grow(hi)
+        self._ts[lo:hi] = timestamps
+        self._csum[lo + 1:hi + 1] = self._csum[lo] + np.cumsum(heart_rates)
+        self._csq[lo + 1:hi + 1] = self._csq[lo] + np.cumsum(heart_rates ** 2)
+        leaves = self._capacity
+        self._min_tree[leaves + lo:leaves + hi] = heart_rates
+        self._max_tree[leaves + lo:leaves + hi] = heart_rates
+        self._n = hi
+        self._update_parents(lo, hi)
+
+    def _range_extreme(self, lo, hi):
+        """
+        Finds min and max of the heart rates at positions [lo, hi).
+        Args:
+            lo (int): First position.
+            hi (int): One past the last position.
+
+        Returns:
+            tuple: Minimum and maximum heart rate.
+        """
+        lo += self._capacity
+        hi += self._capacity
+        low, high = _INT64.max, _INT64.min
+        while lo < hi:
+            if lo & 1:
+                low = min(low, self._min_tree[lo])
+                high = max(high, self._max_tree[lo])
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                low = min(low, self._min_tree[hi])
+                high = max(high, self._max_tree[hi])
+            lo //= 2
+            hi //= 2
+        return int(low), int(high)
+
+    def query(self, since=None, until=None):
+        """
+        Summarizes the heart rates with since <= timestamp < until.
+        Args:
+            since (int): Start of the window in microseconds since epoch.
+                Unbounded if None.
+            until (int): End of the window in microseconds since epoch.
+                Unbounded if None.
+
+        Returns:
+            dict: count, mean, min, max and variance. Everything but count is
+                None if the window holds no samples.
+        """
+        ts = self._ts[:self._n]
+        lo = 0 if since is None else int(np.searchsorted(ts, since, "left"))
+        hi = self._n if until is None else int(np.searchsorted(ts, until, "left"))
+        count = max(hi - lo, 0)
+        stats = {
+            "count": count,
+            "mean": None,
+            "min": None,
+            "max": None,
+            "variance": None,
+        }
+        if count:
+            mean = int(self._csum[hi] - self._csum[lo]) / count
+            mean_sq = int(self._csq[hi] - self._csq[lo]) / count
+            stats["mean"] = mean
+            stats["variance"] = max(mean_sq - mean * mean, 0.0)
+            stats["min"], stats["max"] = self._range_extreme(lo, hi)
+        return stats
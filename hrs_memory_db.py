@@ -0,0 +1,452 @@
+import os
+import json
+import bisect
+import threading
+import numpy as np
+from hrs_time import parse_timestamp, format_timestamp, to_micros, \
+    from_micros, utc_now
+from hrs_storage import HRStorage, SAMPLE_FIELDS, PATIENT_FIELDS, \
+    normalize_id, aggregate_stats
+
+_INITIAL_CAPACITY = 64
+# aggregates of a patient, in the order aggregate_stats takes them
+_AGGREGATES = ("sample_count", "hr_sum", "hr_sum_sq", "hr_min", "hr_max",
+               "last_heart_rate", "last_timestamp", "last_is_tachycardic")
+
+
+class MemoryPatient(object):
+    """
+    A patient with its running aggregates and its samples, kept in growable
+    arrays of timestamps in microseconds since epoch and heart rates.
+    Samples are sorted lazily, the first time they are read after an out of
+    order append.
+    """
+
+    def __init__(self, patient_id, attending_email, user_age, version=0):
+        self.patient_id = patient_id
+        self.attending_email = attending_email
+        self.user_age = user_age
+        self.version = version
+        self.sample_count = 0
+        self.hr_sum = 0
+        self.hr_sum_sq = 0
+        self.hr_min = None
+        self.hr_max = None
+        self.last_heart_rate = None
+        self.last_timestamp = None
+        self.last_is_tachycardic = None
+        self._ts = np.empty(0, dtype=np.int64)
+        self._hr = np.empty(0, dtype=np.int64)
+        self._sorted = True
+
+    def append(self, timestamps, heart_rates):
+        """
+        Appends samples, doubling the arrays when they are full.
+        Args:
+            timestamps (list): Timestamps in microseconds since epoch.
+            heart_rates (list): Heart rates matching the timestamps.
+        """
+        lo = self.sample_count
+        hi = lo + len(timestamps)
+        if hi > len(self._ts):
+            capacity = max(len(self._ts), _INITIAL_CAPACITY)
+            while capacity < hi:
+                capacity *= 2
+            ts = np.empty(capacity, dtype=np.int64)
+            hr = np.empty(capacity, dtype=np.int64)
+            ts[:lo], hr[:lo] = self._ts[:lo], self._hr[:lo]
+            self._ts, self._hr = ts, hr
+        self._ts[lo:hi] = timestamps
+        self._hr[lo:hi] = heart_rates
+        if self._sorted and (np.any(np.diff(self._ts[lo:hi]) < 0) or
+                             (lo and self._ts[lo] < self._ts[lo - 1])):
+            self._sorted = False
+
+        added = self._hr[lo:hi]
+        self.sample_count = hi
+        self.hr_sum += int(added.sum())
+        self.hr_sum_sq += int(np.dot(added, added))
+        low, high = int(added.min()), int(added.max())
+        self.hr_min = low if self.hr_min is None else min(self.hr_min, low)
+        self.hr_max = high if self.hr_max is None else max(self.hr_max, high)
+
+    def arrays(self):
+        """
+        Gets the samples in time order. Later appends do not change the
+        returned arrays.
+        Returns:
+            tuple: Timestamps in microseconds since epoch and heart rates,
+                both numpy arrays.
+        """
+        n = self.sample_count
+        if not self._sorted:
+            order = np.argsort(self._ts[:n], kind="stable")
+            ts = np.empty_like(self._ts)
+            hr = np.empty_like(self._hr)
+            ts[:n], hr[:n] = self._ts[order], self._hr[order]
+            self._ts, self._hr = ts, hr
+            self._sorted = True
+        return self._ts[:n], self._hr[:n]
+
+
+class MemoryDatabase(HRStorage):
+    """
+    Storage backend keeping everything in process memory, for edge
+    deployments, tests and benchmarks. Patients are indexed by ID in a dict
+    next to a sorted list of IDs for paging. Optionally snapshotted to disk
+    and loaded back on start. The data lives in one process, so it must be
+    served by a single worker.
+    """
+    process_local = True
+
+    def __init__(self, snapshot_path=None):
+        """
+        Args:
+            snapshot_path (str): File the snapshot is written to and loaded
+                from. Nothing is persisted if not given.
+        """
+        super(MemoryDatabase, self).__init__()
+        self.snapshot_path = snapshot_path
+        self._patients = {}
+        self._ids = []
+        self._lock = threading.RLock()
+        # pid of the last process that changed the data
+        self._written_by = None
+        if snapshot_path is not None and os.path.exists(snapshot_path):
+            self.load(snapshot_path)
+
+    def iter_patients(self, after=None, limit=None, fields=PATIENT_FIELDS):
+        """
+        Iterates over patients in ID order.
+        Args:
+            after: Only patients with an ID after this one, for paging.
+            limit (int): Maximum number of patients.
+            fields (tuple): Fields of PATIENT_FIELDS to include.
+
+        Returns:
+            generator: Json dictionaries of the patients.
+        """
+        with self._lock:
+            start = 0
+            if after is not None:
+                start = bisect.bisect_right(self._ids, normalize_id(after))
+            stop = None if limit is None else start + limit
+            patient_ids = self._ids[start:stop]
+
+        with_samples = any(field in fields for field in SAMPLE_FIELDS)
+        for patient_id in patient_ids:
+            user = self._patients.get(patient_id)
+            if user is None:
+                continue
+            patient = {field: getattr(user, field) for field in fields
+                       if field not in SAMPLE_FIELDS}
+            if with_samples:
+                with self._lock:
+                    timestamps, heart_rates = user.arrays()
+                if "heart_rates" in fields:
+                    patient["heart_rates"] = heart_rates.tolist()
+                if "timestamps" in fields:
+                    patient["timestamps"] = [
+                        format_timestamp(from_micros(timestamp))
+                        for timestamp in timestamps.tolist()]
+            yield patient
+
+    def add_patient(self, user_info):
+        """
+        Adds a new patient.
+        Args:
+            user_info (dict): Dictionary with the user's info.
+        """
+        patient_id = normalize_id(user_info["patient_id"])
+        with self._lock:
+            if patient_id in self._patients:
+                raise ValueError("The patient is already in the database.")
+            self._patients[patient_id] = MemoryPatient(
+                patient_id, user_info["attending_email"], user_info["user_age"],
+                to_micros(utc_now()))
+            bisect.insort(self._ids, patient_id)
+            self._written_by = os.getpid()
+
+    def remove_patient(self, patient_id):
+        """
+        Removes a patient and its heart rates.
+        Args:
+            patient_id (str): ID of the patient to remove.
+
+        Returns:
+            bool: Whether or not the user was removed.
+        """
+        patient_id = normalize_id(patient_id)
+        with self._lock:
+            if self._patients.pop(patient_id, None) is None:
+                return False
+            del self._ids[bisect.bisect_left(self._ids, patient_id)]
+            self._written_by = os.getpid()
+        self._drop_index(patient_id)
+        return True
+
+    def get_patient(self, patient_id):
+        """
+        Finds a patient.
+        Args:
+            patient_id (str): ID of the patient to find.
+
+        Returns:
+            MemoryPatient: Information of the patient. Returns None if DNE.
+        """
+        return self._patients.get(normalize_id(patient_id))
+
+    def get_patients(self, patient_ids):
+        """
+        Finds many patients at once.
+        Args:
+            patient_ids (list): IDs of the patients to find.
+
+        Returns:
+            dict: Patients that exist, keyed by normalized ID.
+        """
+        found = {}
+        for patient_id in patient_ids:
+            patient_id = normalize_id(patient_id)
+            patient = self._patients.get(patient_id)
+            if patient is not None:
+                found[patient_id] = patient
+        return found
+
+    def _push(self, patient, samples):
+        """
+        Appends samples to a patient. Called with the lock. The last sample
+        only moves forward in time, as in the mongo backend.
+        Args:
+            patient (MemoryPatient): Patient to append to.
+            samples (list): (heart_rate, timestamp, is_tachycardic) tuples.
+        """
+        timestamps = [to_micros(parse_timestamp(timestamp))
+                      for _, timestamp, _ in samples]
+        heart_rates = [heart_rate for heart_rate, _, _ in samples]
+        patient.append(timestamps, heart_rates)
+        last = max(range(len(samples)), key=timestamps.__getitem__)
+        if patient.last_timestamp is None or \
+                patient.last_timestamp <= timestamps[last]:
+            patient.last_heart_rate = heart_rates[last]
+            patient.last_timestamp = timestamps[last]
+            patient.last_is_tachycardic = samples[last][2]
+        patient.version += 1
+        self._written_by = os.getpid()
+
+    def add_hr(self, patient_id, heart_rate, timestamp, is_tachycardic=None):
+        """
+        Adds a heart rate and corresponding timestamp to a user.
+        Args:
+            patient_id: ID of the patient to add hr to.
+            heart_rate: New heart rate.
+            timestamp: New timestamp.
+            is_tachycardic (bool): Status of the sample, kept as the patient's
+                status while it is the latest sample.
+
+        Returns:
+            bool: Whether or not the patient exists.
+        """
+        with self._lock:
+            patient = self._patients.get(normalize_id(patient_id))
+            if patient is None:
+                return False
+            self._push(patient, [(heart_rate, timestamp, is_tachycardic)])
+        return True
+
+    def add_hr_batch(self, samples):
+        """
+        Adds many heart rates across many patients, one append per patient.
+        Args:
+            samples (list): (patient_id, heart_rate, timestamp) tuples, with
+                an optional fourth element is_tachycardic as in add_hr.
+
+        Returns:
+            set: Normalized IDs of the patients that exist and were written.
+        """
+        grouped = {}
+        for sample in samples:
+            is_tachycardic = sample[3] if len(sample) > 3 else None
+            grouped.setdefault(normalize_id(sample[0]), []).append(
+                (sample[1], sample[2], is_tachycardic))
+
+        existing = set()
+        with self._lock:
+            for patient_id, patient_samples in grouped.items():
+                patient = self._patients.get(patient_id)
+                if patient is None:
+                    continue
+                self._push(patient, patient_samples)
+                existing.add(patient_id)
+        return existing
+
+    def reclassify(self, classify, chunk_size=10000):
+        """
+        Re-evaluates the stored status of every patient's latest sample,
+        classifying chunk_size patients per call.
+        Args:
+            classify: Function of (ages, heart_rates) arrays returning an array
+                of statuses.
+            chunk_size (int): Patients per chunk.
+
+        Returns:
+            tuple: Number of patients evaluated, and of statuses changed.
+        """
+        with self._lock:
+            users = [user for user in self._patients.values()
+                     if user.sample_count]
+        evaluated = 0
+        changed = 0
+        for i in range(0, len(users), chunk_size):
+            chunk = users[i:i + chunk_size]
+            with self._lock:
+                statuses = classify([user.user_age for user in chunk],
+                                    [user.last_heart_rate for user in chunk])
+                for user, status in zip(chunk, statuses):
+                    if user.last_is_tachycardic != bool(status):
+                        user.last_is_tachycardic = bool(status)
+                        user.version += 1
+                        changed += 1
+                        self._written_by = os.getpid()
+            evaluated += len(chunk)
+        return evaluated, changed
+
+    def get_stats(self, patient_id):
+        """
+        Reads the running aggregates of a patient. Never touches the samples.
+        Args:
+            patient_id: ID of the patient.
+
+        Returns:
+            dict: As built by aggregate_stats. Returns None if the patient
+                DNE.
+        """
+        with self._lock:
+            patient = self._patients.get(normalize_id(patient_id))
+            if patient is None:
+                return None
+            return aggregate_stats(*(getattr(patient, field)
+                                     for field in _AGGREGATES))
+
+    def get_version(self, patient_id):
+        """
+        Reads the version of a patient, bumped by every write to it.
+        Args:
+            patient_id: ID of the patient.
+
+        Returns:
+            int: Version of the patient. Returns None if the patient DNE.
+        """
+        patient = self._patients.get(normalize_id(patient_id))
+        return None if patient is None else patient.version
+
+    def _sample_arrays(self, patient_id, since=None, until=None):
+        """
+        Gets the samples of a patient in a range as arrays.
+        Args:
+            patient_id: ID of the patient.
+            since (int): Earliest timestamp, in microseconds since epoch.
+            until (int): End of the range, exclusive, in microseconds since
+                epoch.
+
+        Returns:
+            tuple: Sorted timestamps in microseconds since epoch and the
+                matching heart rates, both numpy arrays.
+        """
+        with self._lock:
+            patient = self._patients.get(normalize_id(patient_id))
+            if patient is None:
+                return np.empty(0, np.int64), np.empty(0, np.int64)
+            timestamps, heart_rates = patient.arrays()
+        lo = 0 if since is None else np.searchsorted(timestamps, since, "left")
+        hi = len(timestamps) if until is None else \
+            np.searchsorted(timestamps, until, "left")
+        return timestamps[lo:hi], heart_rates[lo:hi]
+
+    def iter_samples(self, patient_id, since=None, until=None):
+        """
+        Iterates over the heart rates of a patient with since <= timestamp <
+        until, in time order.
+        Args:
+            patient_id: ID of the patient.
+            since (datetime.datetime): Start of the range. Unbounded if None.
+            until (datetime.datetime): End of the range. Unbounded if None.
+
+        Returns:
+            generator: (timestamp, heart_rate) tuples.
+        """
+        timestamps, heart_rates = self._sample_arrays(
+            patient_id,
+            None if since is None else to_micros(since),
+            None if until is None else to_micros(until))
+        for timestamp, heart_rate in zip(timestamps.tolist(),
+                                         heart_rates.tolist()):
+            yield from_micros(timestamp), heart_rate
+
+    def snapshot(self, path=None):
+        """
+        Writes every patient and sample to disk. The file is replaced
+        atomically, so a crash never leaves a partial snapshot behind.
+        Args:
+            path (str): File to write. snapshot_path if not given.
+        """
+        path = path or self.snapshot_path
+        with self._lock:
+            users = [self._patients[patient_id] for patient_id in self._ids]
+            arrays = [user.arrays() for user in users]
+            meta = [dict({"patient_id": user.patient_id,
+                          "attending_email": user.attending_email,
+                          "user_age": user.user_age,
+                          "version": user.version},
+                         **{field: getattr(user, field)
+                            for field in _AGGREGATES})
+                    for user in users]
+        timestamps = [ts for ts, _ in arrays]
+        heart_rates = [hr for _, hr in arrays]
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, meta=np.array(json.dumps(meta)),
+                     timestamps=np.concatenate(timestamps or [np.empty(0)]),
+                     heart_rates=np.concatenate(heart_rates or [np.empty(0)]))
+        os.replace(tmp_path, path)
+
+    def snapshot_at_exit(self):
+        """
+        Writes the snapshot on exit, only from the process that changed the
+        data. A parent that forked workers, e.g. gunicorn's master with
+        preload_app, holds a stale copy and must not overwrite what the
+        worker wrote.
+        """
+        if self.snapshot_path is not None and \
+                self._written_by == os.getpid():
+            self.snapshot()
+
+    def load(self, path=None):
+        """
+        Replaces the contents of the database with a snapshot.
+        Args:
+            path (str): File to read. snapshot_path if not given.
+        """
+        path = path or self.snapshot_path
+        with np.load(path) as snapshot:
+            meta = json.loads(str(snapshot["meta"]))
+            timestamps = snapshot["timestamps"].astype(np.int64)
+            heart_rates = snapshot["heart_rates"].astype(np.int64)
+
+        patients = {}
+        start = 0
+        for user in meta:
+            # snapshots from before versions have none
+            patient = MemoryPatient(user["patient_id"], user["attending_email"],
+                                    user["user_age"], user.get("version", 0))
+            count = user["sample_count"]
+            if count:
+                patient.append(timestamps[start:start + count],
+                               heart_rates[start:start + count].tolist())
+            start += count
+            for field in _AGGREGATES:
+                setattr(patient, field, user[field])
+            patients[patient.patient_id] = patient
+        with self._lock:
+            self._patients = patients
+            self._ids = sorted(patients)
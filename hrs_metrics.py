@@ -0,0 +1,402 @@
+"""
+Request, storage and alert timings of one server process, exposed at
+/metrics in the Prometheus text format. Counters are plain dictionaries
+behind a lock, cheap enough to leave on: benchmarks/bench_metrics.py
+measures the cost per request.
+"""
+import time
+import bisect
+import inspect
+import threading
+
+# upper bounds in seconds of the latency histograms, the memory backend
+# answers in well under a millisecond and alerts can take seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# storage methods that do not touch the database
+UNTIMED_METHODS = frozenset(("after_fork", "metrics", "snapshot"))
+
+
+def _escape(value):
+    """
+    Escapes a label value.
+    Args:
+        value: Label value.
+
+    Returns:
+        str: The value with backslashes, quotes and newlines escaped.
+    """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"') \
+        .replace("\n", "\\n")
+
+
+def _labels(names, values, extra=()):
+    """
+    Formats the labels of a sample.
+    Args:
+        names (tuple): Label names.
+        values (tuple): Label values, in the order of names.
+        extra (tuple): More (name, value) pairs, e.g. the le of a bucket.
+
+    Returns:
+        str: {name="value",...}, empty if there are no labels.
+    """
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, _escape(value))
+                          for name, value in pairs) + "}"
+
+
+def _number(value):
+    """
+    Formats a sample value.
+    Args:
+        value (float): Value of the sample.
+
+    Returns:
+        str: The value, +Inf for infinity.
+    """
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_family(name, kind, help_text, samples):
+    """
+    Formats a metric family that is counted elsewhere, e.g. the counts of
+    the alert pipeline.
+    Args:
+        name (str): Name of the metric.
+        kind (str): counter or gauge.
+        help_text (str): Description of the metric.
+        samples (list): (labels dict, value) pairs.
+
+    Returns:
+        str: Lines of the family in the text format.
+    """
+    lines = ["# HELP {} {}".format(name, help_text),
+             "# TYPE {} {}".format(name, kind)]
+    for labels, value in samples:
+        lines.append("{}{} {}".format(name, _labels(tuple(labels),
+                                                    tuple(labels.values())),
+                                      _number(value)))
+    return "\n".join(lines) + "\n"
+
+
+class _Family(object):
+    """
+    Metric with one series per combination of label values.
+    """
+    kind = None
+
+    def __init__(self, name, help_text, label_names=()):
+        """
+        Args:
+            name (str): Name of the metric.
+            help_text (str): Description of the metric.
+            label_names (tuple): Names of the labels.
+        """
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def render(self):
+        """
+        Formats the family.
+        Returns:
+            str: Lines of the family in the text format.
+        """
+        with self._lock:
+            series = sorted(self._series.items())
+            return format_family(self.name, self.kind, self.help_text, [
+                (dict(zip(self.label_names, values)), value)
+                for values, value in series])
+
+    def clear(self):
+        """
+        Drops every series.
+        """
+        with self._lock:
+            self._series.clear()
+
+
+class Counter(_Family):
+    """
+    Count that only goes up.
+    """
+    kind = "counter"
+
+    def inc(self, labels=(), amount=1):
+        """
+        Adds to the count of a series.
+        Args:
+            labels (tuple): Label values, in the order of label_names.
+            amount (int): Amount to add.
+        """
+        with self._lock:
+            self._series[labels] = self._series.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        """
+        Gets the count of a series.
+        Returns:
+            int: The count, 0 if nothing was counted.
+        """
+        with self._lock:
+            return self._series.get(labels, 0)
+
+
+class Gauge(Counter):
+    """
+    Value that goes up and down, e.g. requests in flight.
+    """
+    kind = "gauge"
+
+    def dec(self, labels=(), amount=1):
+        """
+        Subtracts from the value of a series.
+        Args:
+            labels (tuple): Label values, in the order of label_names.
+            amount (int): Amount to subtract.
+        """
+        self.inc(labels, -amount)
+
+
+class Histogram(_Family):
+    """
+    Distribution of observed values over fixed buckets.
+    """
+    kind = "histogram"
+
+    def __init__(self, name, help_text, label_names=(),
+                 buckets=LATENCY_BUCKETS):
+        """
+        Args:
+            name (str): Name of the metric.
+            help_text (str): Description of the metric.
+            label_names (tuple): Names of the labels.
+            buckets (tuple): Increasing upper bounds of the buckets, +Inf is
+                added.
+        """
+        super(Histogram, self).__init__(name, help_text, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, labels, value):
+        """
+        Records a value.
+        Args:
+            labels (tuple): Label values, in the order of label_names.
+            value (float): Observed value, e.g. seconds.
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # a count per bucket and +Inf, then the sum
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def count(self, labels=()):
+        """
+        Gets the number of values recorded for a series.
+        Returns:
+            int: Number of observed values.
+        """
+        with self._lock:
+            series = self._series.get(labels)
+            return sum(series[:-1]) if series else 0
+
+    def render(self):
+        """
+        Formats the family, with cumulative buckets.
+        Returns:
+            str: Lines of the family in the text format.
+        """
+        with self._lock:
+            series = sorted((values, list(counts))
+                            for values, counts in self._series.items())
+        lines = ["# HELP {} {}".format(self.name, self.help_text),
+                 "# TYPE {} histogram".format(self.name)]
+        bounds = self.buckets + (float("inf"),)
+        for values, counts in series:
+            total = 0
+            for bound, count in zip(bounds, counts):
+                total += count
+                lines.append("{}_bucket{} {}".format(
+                    self.name, _labels(self.label_names, values,
+                                       (("le", _number(bound)),)), total))
+            labels = _labels(self.label_names, values)
+            lines.append("{}_sum{} {}".format(self.name, labels,
+                                              _number(counts[-1])))
+            lines.append("{}_count{} {}".format(self.name, labels, total))
+        return "\n".join(lines) + "\n"
+
+
+class Metrics(object):
+    """
+    Metrics of one server process: requests by route, storage calls by
+    method and alert sends by outcome.
+    """
+
+    def __init__(self):
+        self.request_seconds = Histogram(
+            "hrs_request_duration_seconds",
+            "Time to build the response of a request.", ("method", "route"))
+        self.requests = Counter(
+            "hrs_requests_total", "Requests answered, by status code.",
+            ("method", "route", "status"))
+        self.in_flight = Gauge("hrs_requests_in_flight",
+                               "Requests being handled.")
+        self.storage_seconds = Histogram(
+            "hrs_storage_duration_seconds",
+            "Time spent in storage calls, iterators included.",
+            ("method", "outcome"))
+        self.alert_seconds = Histogram(
+            "hrs_alert_send_duration_seconds",
+            "Time to send one alert email, retries counted apart.",
+            ("outcome",))
+        self.families = (self.request_seconds, self.requests, self.in_flight,
+                         self.storage_seconds, self.alert_seconds)
+
+    def render(self):
+        """
+        Formats every metric.
+        Returns:
+            str: The metrics in the Prometheus text format.
+        """
+        return "".join(family.render() for family in self.families)
+
+    def clear(self):
+        """
+        Drops every series, e.g. those inherited by a forked worker.
+        """
+        for family in self.families:
+            family.clear()
+
+
+class TimedStorage(object):
+    """
+    Times every call to a storage backend into Metrics.storage_seconds.
+    Calls returning an iterator are timed while it is consumed, since
+    cursors read lazily. Everything else goes straight to the backend.
+    """
+
+    def __init__(self, storage, metrics):
+        """
+        Args:
+            storage (HRStorage): Backend to time.
+            metrics (Metrics): Metrics to record into.
+        """
+        self.storage = storage
+        self.histogram = metrics.storage_seconds
+
+    def __getattr__(self, name):
+        attribute = getattr(self.storage, name)
+        if name in UNTIMED_METHODS or name.startswith("_") or \
+                not callable(attribute):
+            return attribute
+        timed = _timed(attribute, name, self.histogram)
+        # found without __getattr__ from now on
+        setattr(self, name, timed)
+        return timed
+
+
+def _timed(method, name, histogram):
+    """
+    Wraps a storage method to time its calls.
+    Args:
+        method: Bound method of the backend.
+        name (str): Name of the method, the method label.
+        histogram (Histogram): Histogram to record into.
+
+    Returns:
+        function: The timed method.
+    """
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = method(*args, **kwargs)
+        except Exception:
+            histogram.observe((name, "error"), time.perf_counter() - start)
+            raise
+        if inspect.isgenerator(result):
+            return _timed_iterator(result, name, histogram,
+                                   time.perf_counter() - start)
+        histogram.observe((name, "ok"), time.perf_counter() - start)
+        return result
+    return timed
+
+
+def _timed_iterator(iterator, name, histogram, elapsed):
+    """
+    Consumes an iterator returned by a storage method, timing each step.
+    Args:
+        iterator: Iterator returned by the method.
+        name (str): Name of the method.
+        histogram (Histogram): Histogram to record into.
+        elapsed (float): Seconds spent in the call itself.
+
+    Returns:
+        generator: Items of the iterator.
+    """
+    outcome = "ok"
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            except Exception:
+                outcome = "error"
+                raise
+            finally:
+                elapsed += time.perf_counter() - start
+            yield item
+    finally:
+        # iterators dropped part way are recorded when closed
+        iterator.close()
+        histogram.observe((name, outcome), elapsed)
+
+
+class TimedSender(object):
+    """
+    Times every send of an alert sender into Metrics.alert_seconds.
+    """
+
+    def __init__(self, sender, metrics):
+        """
+        Args:
+            sender: Object with send(to_address, email_subject, email_content).
+            metrics (Metrics): Metrics to record into.
+        """
+        self.sender = sender
+        self.histogram = metrics.alert_seconds
+
+    def __getattr__(self, name):
+        return getattr(self.sender, name)
+
+    def send(self, to_address, email_subject, email_content):
+        """
+        Sends an email with the wrapped sender.
+        Args:
+            to_address: Address to send to
+            email_subject: Subject of the email.
+            email_content: Content of the email.
+
+        Returns:
+            object: Whatever the wrapped sender returns.
+        """
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            result = self.sender.send(to_address, email_subject, email_content)
+            outcome = "ok"
+            return result
+        finally:
+            self.histogram.observe((outcome,), time.perf_counter() - start)
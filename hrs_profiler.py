@@ -0,0 +1,239 @@
+"""
+Opt-in cProfile sampling of requests, to see where a slow route spends its
+time (storage scans, jsonify, email sending) without redeploying. Off
+unless "profile_dir" is set in config.json. Then every profile_sample_every
+th request is profiled, and, if profile_token is set, any request carrying
+it in the X-HRS-Profile header. Profiles are added up per route on disk,
+one file per worker process, so the admin endpoints of any worker report
+the whole deployment. Files are replaced whole, so a worker never reads
+another one's half-written profile.
+"""
+import io
+import os
+import re
+import hmac
+import glob
+import json
+import marshal
+import pstats
+import cProfile
+import tempfile
+import itertools
+import threading
+
+PROFILE_HEADER = "X-HRS-Profile"
+# orders a report can be sorted by
+SORT_KEYS = ("cumulative", "tottime", "calls", "ncalls", "time")
+
+
+def profile_name(method, route):
+    """
+    Names the profile of a route, safe as a file name and in a URL.
+    Args:
+        method (str): HTTP method.
+        route (str): URL rule of the route.
+
+    Returns:
+        str: e.g. GET_api_status_patient_id.
+    """
+    return re.sub(r"[^A-Za-z0-9]+", "_", "{} {}".format(method, route)) \
+        .strip("_")
+
+
+class Profiler(object):
+    """
+    Profiles sampled requests with cProfile, one at a time, and adds each
+    profile to its route's total in directory.
+    """
+
+    def __init__(self, directory, sample_every=0, token=None):
+        """
+        Args:
+            directory (str): Folder of the profiles, created if missing.
+            sample_every (int): Profile one request in this many, 0 to
+                profile only requests asking for it.
+            token (str): Value the X-HRS-Profile header must carry, to
+                profile a request or to read the profiles. Neither is
+                allowed if not given.
+        """
+        self.directory = directory
+        self.sample_every = sample_every
+        self.token = token
+        self._counter = itertools.count(1)
+        # profiles run one at a time, requests arriving meanwhile are not
+        # profiled
+        self._active = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def authorized(self, headers):
+        """
+        Determines if the request carries the profiling header.
+        Args:
+            headers: Headers of the request.
+
+        Returns:
+            bool: Whether or not a token is set and the header matches it.
+        """
+        value = headers.get(PROFILE_HEADER)
+        if value is None or self.token is None:
+            return False
+        # constant time, the token is a secret
+        return hmac.compare_digest(value.encode("utf-8"),
+                                   self.token.encode("utf-8"))
+
+    def start(self, headers):
+        """
+        Starts profiling the request if it is sampled or asks for it.
+        Args:
+            headers: Headers of the request.
+
+        Returns:
+            cProfile.Profile: The running profile, None if the request is
+                not profiled.
+        """
+        sampled = self.sample_every and \
+            next(self._counter) % self.sample_every == 0
+        if not sampled and not self.authorized(headers):
+            return None
+        if not self._active.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler is running, e.g. a debugger
+            self._active.release()
+            return None
+        return profile
+
+    def finish(self, profile, method, route):
+        """
+        Stops a profile and adds it to the route's total of this process.
+        Args:
+            profile (cProfile.Profile): Profile returned by start.
+            method (str): HTTP method of the request.
+            route (str): URL rule of the request.
+        """
+        try:
+            profile.disable()
+            name = profile_name(method, route)
+            path = self._path(name, os.getpid())
+            stats = pstats.Stats(profile)
+            if os.path.exists(path):
+                stats.add(path)
+            self._replace(path, stats.dump_stats)
+
+            index_path = self._path("index", os.getpid(), ".json")
+            index = {}
+            if os.path.exists(index_path):
+                with open(index_path) as f:
+                    index = json.load(f)
+            entry = index.setdefault(name, {"method": method, "route": route,
+                                            "requests": 0})
+            entry["requests"] += 1
+
+            def write_index(index_tmp):
+                with open(index_tmp, "w") as f:
+                    json.dump(index, f)
+            self._replace(index_path, write_index)
+        finally:
+            self._active.release()
+
+    def _replace(self, path, write):
+        """
+        Writes a file to a temporary file next to it, then moves it in
+        place, so readers see the old or the new contents, never part.
+        Args:
+            path (str): Path of the file.
+            write: Function writing the contents to the path it is given.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        os.close(fd)
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def _path(self, name, pid, extension=".prof"):
+        return os.path.join(self.directory,
+                            "{}.{}{}".format(name, pid, extension))
+
+    def profiles(self):
+        """
+        Lists the profiled routes of every worker.
+        Returns:
+            list: name, method, route, requests and total seconds of each
+                route, slowest first.
+        """
+        merged = {}
+        for index_path in glob.glob(self._path("index", "*", ".json")):
+            with open(index_path) as f:
+                for name, entry in json.load(f).items():
+                    if name in merged:
+                        merged[name]["requests"] += entry["requests"]
+                    else:
+                        merged[name] = dict(entry, name=name)
+        for name, entry in merged.items():
+            stats = self.stats(name)
+            entry["seconds"] = stats.total_tt if stats is not None else 0.0
+        return sorted(merged.values(), key=lambda entry: -entry["seconds"])
+
+    def stats(self, name):
+        """
+        Adds up the profiles of a route across workers.
+        Args:
+            name (str): Name of the profile, from profile_name.
+
+        Returns:
+            pstats.Stats: The total, None if the route was not profiled.
+        """
+        if not re.match(r"^[A-Za-z0-9_]+$", name):
+            return None
+        paths = glob.glob(self._path(name, "*"))
+        if not paths:
+            return None
+        return pstats.Stats(*paths, stream=io.StringIO())
+
+    def report(self, name, sort="cumulative", limit=30):
+        """
+        Formats the total profile of a route as text.
+        Args:
+            name (str): Name of the profile.
+            sort (str): Column to sort by, one of SORT_KEYS.
+            limit (int): Number of functions listed.
+
+        Returns:
+            str: The pstats report, None if the route was not profiled.
+        """
+        stats = self.stats(name)
+        if stats is None:
+            return None
+        stats.stream = io.StringIO()
+        stats.strip_dirs().sort_stats(sort).print_stats(limit)
+        return stats.stream.getvalue()
+
+    def dump(self, name):
+        """
+        Serializes the total profile of a route for pstats or snakeviz.
+        Args:
+            name (str): Name of the profile.
+
+        Returns:
+            bytes: Contents of a .prof file, None if the route was not
+                profiled.
+        """
+        stats = self.stats(name)
+        if stats is None:
+            return None
+        return marshal.dumps(stats.stats)
+
+    def clear(self):
+        """
+        Deletes the profiles of every worker.
+        """
+        with self._active:
+            for path in glob.glob(os.path.join(self.directory, "*.prof")) + \
+                    glob.glob(self._path("index", "*", ".json")):
+                os.remove(path)
@@ -0,0 +1,459 @@
+import os
+import sqlite3
+import itertools
+import threading
+from contextlib import contextmanager
+import numpy as np
+from hrs_time import parse_timestamp, format_timestamp, to_micros, \
+    from_micros, utc_now
+from hrs_storage import HRStorage, SAMPLE_FIELDS, PATIENT_FIELDS, \
+    normalize_id, aggregate_stats
+
+# aggregates of a patient, in the order aggregate_stats takes them
+_AGGREGATES = ("sample_count", "hr_sum", "hr_sum_sq", "hr_min", "hr_max",
+               "last_heart_rate", "last_timestamp", "last_is_tachycardic")
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS patients (
+    patient_id TEXT PRIMARY KEY,
+    attending_email TEXT,
+    user_age INTEGER,
+    version INTEGER NOT NULL DEFAULT 0,
+    sample_count INTEGER NOT NULL DEFAULT 0,
+    hr_sum INTEGER NOT NULL DEFAULT 0,
+    hr_sum_sq INTEGER NOT NULL DEFAULT 0,
+    hr_min INTEGER,
+    hr_max INTEGER,
+    last_heart_rate INTEGER,
+    last_timestamp INTEGER,
+    last_is_tachycardic INTEGER
+);
+CREATE TABLE IF NOT EXISTS samples (
+    patient_id TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    heart_rate INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS samples_patient_ts ON samples (patient_id, ts);
+"""
+
+
+class SQLitePatient(object):
+    """
+    A patient as read from the patients table.
+    """
+
+    def __init__(self, patient_id, attending_email, user_age):
+        self.patient_id = patient_id
+        self.attending_email = attending_email
+        self.user_age = user_age
+
+
+class SQLiteDatabase(HRStorage):
+    """
+    Storage backend on a local SQLite file in WAL mode, for deployments
+    without a mongo server. Samples are rows of (patient_id, timestamp in
+    microseconds since epoch, heart rate) under an index on (patient_id,
+    ts), so range reads are index scans. Every write is one transaction,
+    and a batch of samples is inserted with a single executemany.
+    """
+
+    def __init__(self, path="hrs.sqlite3", synchronous="FULL", timeout=30.0):
+        """
+        Opens the database, creating it if needed.
+        Args:
+            path (str): File of the database.
+            synchronous (str): SQLite synchronous setting. FULL survives a
+                power loss, NORMAL only a crash of the process.
+            timeout (float): Seconds to wait for another writer.
+        """
+        super(SQLiteDatabase, self).__init__()
+        self.path = path
+        self.synchronous = synchronous
+        self.timeout = timeout
+        self._local = threading.local()
+        conn = self._connect()
+        conn.executescript(_SCHEMA)
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(patients)")]
+        if "version" not in columns:
+            # files created before versions
+            try:
+                conn.execute("ALTER TABLE patients ADD COLUMN "
+                             "version INTEGER NOT NULL DEFAULT 0")
+            except sqlite3.OperationalError:
+                # added by another process in the meantime
+                pass
+
+    def _connect(self):
+        """
+        Gets the connection of the current thread. Connections are not
+        shared between threads, and not carried over a fork.
+        Returns:
+            sqlite3.Connection: Connection in autocommit mode.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        conn = sqlite3.connect(self.path, timeout=self.timeout,
+                               isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous={}".format(self.synchronous))
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Runs a block in a write transaction, taking the write lock up front
+        so concurrent writers wait instead of failing to upgrade.
+        """
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def after_fork(self):
+        """
+        Drops the connections inherited from the parent process.
+        """
+        self._local = threading.local()
+
+    def close(self):
+        """
+        Closes the connection of the current thread.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def iter_patients(self, after=None, limit=None, fields=PATIENT_FIELDS):
+        """
+        Iterates over patients in ID order from a database cursor.
+        Args:
+            after: Only patients with an ID after this one, for paging.
+            limit (int): Maximum number of patients.
+            fields (tuple): Fields of PATIENT_FIELDS to include.
+
+        Returns:
+            generator: Json dictionaries of the patients.
+        """
+        columns = [field for field in fields if field not in SAMPLE_FIELDS]
+        query = "SELECT patient_id, {} FROM patients WHERE patient_id > ? " \
+                "ORDER BY patient_id LIMIT ?".format(
+                    ", ".join(columns) or "NULL")
+        rows = self._connect().execute(
+            query, ("" if after is None else normalize_id(after),
+                    -1 if limit is None else limit))
+
+        with_samples = any(field in fields for field in SAMPLE_FIELDS)
+        for row in rows:
+            patient = dict(zip(columns, row[1:]))
+            if with_samples:
+                timestamps, heart_rates = self._sample_arrays(row[0])
+                if "heart_rates" in fields:
+                    patient["heart_rates"] = heart_rates.tolist()
+                if "timestamps" in fields:
+                    patient["timestamps"] = [
+                        format_timestamp(from_micros(timestamp))
+                        for timestamp in timestamps.tolist()]
+            yield patient
+
+    def add_patient(self, user_info):
+        """
+        Adds a new patient.
+        Args:
+            user_info (dict): Dictionary with the user's info.
+        """
+        try:
+            with self._transaction() as conn:
+                conn.execute(
+                    "INSERT INTO patients (patient_id, attending_email, "
+                    "user_age, version) VALUES (?, ?, ?, ?)",
+                    (normalize_id(user_info["patient_id"]),
+                     user_info["attending_email"], user_info["user_age"],
+                     to_micros(utc_now())))
+        except sqlite3.IntegrityError:
+            raise ValueError("The patient is already in the database.")
+
+    def remove_patient(self, patient_id):
+        """
+        Removes a patient and its heart rates.
+        Args:
+            patient_id (str): ID of the patient to remove.
+
+        Returns:
+            bool: Whether or not the user was removed.
+        """
+        patient_id = normalize_id(patient_id)
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM samples WHERE patient_id = ?",
+                         (patient_id,))
+            removed = conn.execute("DELETE FROM patients WHERE patient_id = ?",
+                                   (patient_id,)).rowcount
+        self._drop_index(patient_id)
+        return removed > 0
+
+    def get_patient(self, patient_id):
+        """
+        Finds a patient.
+        Args:
+            patient_id (str): ID of the patient to find.
+
+        Returns:
+            SQLitePatient: Information of the patient. Returns None if DNE.
+        """
+        row = self._connect().execute(
+            "SELECT patient_id, attending_email, user_age FROM patients "
+            "WHERE patient_id = ?", (normalize_id(patient_id),)).fetchone()
+        return None if row is None else SQLitePatient(*row)
+
+    def get_patients(self, patient_ids):
+        """
+        Finds many patients with a single query.
+        Args:
+            patient_ids (list): IDs of the patients to find.
+
+        Returns:
+            dict: Patients that exist, keyed by normalized ID.
+        """
+        patient_ids = list({normalize_id(patient_id)
+                            for patient_id in patient_ids})
+        found = {}
+        # stay below the host parameter limit of older SQLite versions
+        for lo in range(0, len(patient_ids), 900):
+            chunk = patient_ids[lo:lo + 900]
+            rows = self._connect().execute(
+                "SELECT patient_id, attending_email, user_age FROM patients "
+                "WHERE patient_id IN ({})".format(",".join("?" * len(chunk))),
+                chunk)
+            found.update((row[0], SQLitePatient(*row)) for row in rows)
+        return found
+
+    def _push(self, conn, grouped):
+        """
+        Folds samples of several patients into their aggregates and inserts
+        them, with one statement of each kind for all patients. Called
+        inside a transaction. The last sample only moves forward in time, as
+        in the mongo backend.
+        Args:
+            conn (sqlite3.Connection): Connection in a transaction.
+            grouped (dict): (heart_rate, timestamp, is_tachycardic) tuples
+                keyed by normalized patient ID.
+
+        Returns:
+            set: Normalized IDs of the patients that exist and were written.
+        """
+        patient_ids = list(grouped)
+        existing = set()
+        # stay below the host parameter limit of older SQLite versions
+        for lo in range(0, len(patient_ids), 900):
+            chunk = patient_ids[lo:lo + 900]
+            existing.update(row[0] for row in conn.execute(
+                "SELECT patient_id FROM patients WHERE patient_id IN ({})"
+                .format(",".join("?" * len(chunk))), chunk))
+
+        aggregates = []
+        lasts = []
+        rows = []
+        for patient_id in existing:
+            samples = grouped[patient_id]
+            timestamps = [to_micros(parse_timestamp(timestamp))
+                          for _, timestamp, _ in samples]
+            hrs = [heart_rate for heart_rate, _, _ in samples]
+            low, high = min(hrs), max(hrs)
+            aggregates.append((
+                len(hrs), sum(hrs),
+                sum(heart_rate * heart_rate for heart_rate in hrs),
+                low, low, high, high, patient_id))
+            last = max(range(len(samples)), key=timestamps.__getitem__)
+            lasts.append((hrs[last], timestamps[last], samples[last][2],
+                          patient_id, timestamps[last]))
+            rows.extend(zip(itertools.repeat(patient_id), timestamps, hrs))
+        conn.executemany(
+            "UPDATE patients SET sample_count = sample_count + ?, "
+            "hr_sum = hr_sum + ?, hr_sum_sq = hr_sum_sq + ?, "
+            "hr_min = min(coalesce(hr_min, ?), ?), "
+            "hr_max = max(coalesce(hr_max, ?), ?), version = version + 1 "
+            "WHERE patient_id = ?", aggregates)
+        conn.executemany(
+            "UPDATE patients SET last_heart_rate = ?, last_timestamp = ?, "
+            "last_is_tachycardic = ? WHERE patient_id = ? AND "
+            "(last_timestamp IS NULL OR last_timestamp <= ?)", lasts)
+        conn.executemany(
+            "INSERT INTO samples (patient_id, ts, heart_rate) VALUES (?, ?, ?)",
+            rows)
+        return existing
+
+    def add_hr(self, patient_id, heart_rate, timestamp, is_tachycardic=None):
+        """
+        Adds a heart rate and corresponding timestamp to a user, in one
+        transaction with the update of its aggregates.
+        Args:
+            patient_id: ID of the patient to add hr to.
+            heart_rate: New heart rate.
+            timestamp: New timestamp.
+            is_tachycardic (bool): Status of the sample, kept as the patient's
+                status while it is the latest sample.
+
+        Returns:
+            bool: Whether or not the patient exists.
+        """
+        with self._transaction() as conn:
+            return bool(self._push(conn, {normalize_id(patient_id): [
+                (heart_rate, timestamp, is_tachycardic)]}))
+
+    def add_hr_batch(self, samples):
+        """
+        Adds many heart rates across many patients in a single transaction.
+        Args:
+            samples (list): (patient_id, heart_rate, timestamp) tuples, with
+                an optional fourth element is_tachycardic as in add_hr.
+
+        Returns:
+            set: Normalized IDs of the patients that exist and were written.
+        """
+        grouped = {}
+        for sample in samples:
+            is_tachycardic = sample[3] if len(sample) > 3 else None
+            grouped.setdefault(normalize_id(sample[0]), []).append(
+                (sample[1], sample[2], is_tachycardic))
+        if not grouped:
+            return set()
+        with self._transaction() as conn:
+            return self._push(conn, grouped)
+
+    def reclassify(self, classify, chunk_size=10000):
+        """
+        Re-evaluates the stored status of every patient's latest sample,
+        reading and writing chunk_size patients at a time. A status is only
+        written if no newer sample arrived in the meantime.
+        Args:
+            classify: Function of (ages, heart_rates) arrays returning an array
+                of statuses.
+            chunk_size (int): Patients per chunk.
+
+        Returns:
+            tuple: Number of patients evaluated, and of statuses changed.
+        """
+        evaluated = 0
+        changed = 0
+        after = ""
+        while True:
+            users = self._connect().execute(
+                "SELECT patient_id, user_age, last_heart_rate, last_timestamp, "
+                "last_is_tachycardic FROM patients WHERE sample_count > 0 "
+                "AND patient_id > ? ORDER BY patient_id LIMIT ?",
+                (after, chunk_size)).fetchall()
+            if not users:
+                return evaluated, changed
+            after = users[-1][0]
+            statuses = classify([user[1] for user in users],
+                                [user[2] for user in users])
+            writes = [(bool(status), user[0], user[3])
+                      for user, status in zip(users, statuses)
+                      if user[4] is None or bool(user[4]) != bool(status)]
+            with self._transaction() as conn:
+                for write in writes:
+                    changed += conn.execute(
+                        "UPDATE patients SET last_is_tachycardic = ?, "
+                        "version = version + 1 "
+                        "WHERE patient_id = ? AND last_timestamp = ?",
+                        write).rowcount
+            evaluated += len(users)
+
+    def get_stats(self, patient_id):
+        """
+        Reads the running aggregates of a patient. Never touches the samples.
+        Args:
+            patient_id: ID of the patient.
+
+        Returns:
+            dict: As built by aggregate_stats. Returns None if the patient
+                DNE.
+        """
+        row = self._connect().execute(
+            "SELECT {} FROM patients WHERE patient_id = ?".format(
+                ", ".join(_AGGREGATES)), (normalize_id(patient_id),)).fetchone()
+        if row is None:
+            return None
+        row = list(row)
+        if row[-1] is not None:
+            row[-1] = bool(row[-1])
+        return aggregate_stats(*row)
+
+    def get_version(self, patient_id):
+        """
+        Reads the version of a patient, bumped in the transaction of every
+        write to it.
+        Args:
+            patient_id: ID of the patient.
+
+        Returns:
+            int: Version of the patient. Returns None if the patient DNE.
+        """
+        row = self._connect().execute(
+            "SELECT version FROM patients WHERE patient_id = ?",
+            (normalize_id(patient_id),)).fetchone()
+        return None if row is None else row[0]
+
+    def _sample_rows(self, patient_id, since=None, until=None):
+        """
+        Reads the samples of a patient in a range with an index scan.
+        Args:
+            patient_id: ID of the patient.
+            since (int): Earliest timestamp, in microseconds since epoch.
+            until (int): End of the range, exclusive, in microseconds since
+                epoch.
+
+        Returns:
+            sqlite3.Cursor: (ts, heart_rate) rows in time order.
+        """
+        query = "SELECT ts, heart_rate FROM samples WHERE patient_id = ?"
+        params = [normalize_id(patient_id)]
+        if since is not None:
+            query += " AND ts >= ?"
+            params.append(since)
+        if until is not None:
+            query += " AND ts < ?"
+            params.append(until)
+        return self._connect().execute(query + " ORDER BY ts, rowid", params)
+
+    def _sample_arrays(self, patient_id, since=None, until=None):
+        """
+        Reads the samples of a patient in a range into arrays.
+        Args:
+            patient_id: ID of the patient.
+            since (int): Earliest timestamp, in microseconds since epoch.
+            until (int): End of the range, exclusive, in microseconds since
+                epoch.
+
+        Returns:
+            tuple: Sorted timestamps in microseconds since epoch and the
+                matching heart rates, both numpy arrays.
+        """
+        rows = np.array(self._sample_rows(patient_id, since, until).fetchall(),
+                        dtype=np.int64).reshape(-1, 2)
+        return rows[:, 0], rows[:, 1]
+
+    def iter_samples(self, patient_id, since=None, until=None):
+        """
+        Iterates over the heart rates of a patient with since <= timestamp <
+        until, in time order, from a database cursor.
+        Args:
+            patient_id: ID of the patient.
+            since (datetime.datetime): Start of the range. Unbounded if None.
+            until (datetime.datetime): End of the range. Unbounded if None.
+
+        Returns:
+            generator: (timestamp, heart_rate) tuples.
+        """
+        rows = self._sample_rows(
+            patient_id,
+            None if since is None else to_micros(since),
+            None if until is None else to_micros(until))
+        for timestamp, heart_rate in rows:
+            yield from_micros(timestamp), heart_rate
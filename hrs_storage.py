@@ -0,0 +1,486 @@
+import os
+import atexit
+import datetime
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
+from hrs_time import to_micros, from_micros
+from hrs_index import IntervalIndex
+from hrs_downsample import aggregate, lttb
+
+# fields of a patient's json, the sample arrays are the expensive ones
+SAMPLE_FIELDS = ("heart_rates", "timestamps")
+PATIENT_FIELDS = ("patient_id", "attending_email", "user_age") + SAMPLE_FIELDS
+# patients whose interval index is kept in memory
+INDEX_CACHE_SIZE = 128
+_MICROSECOND = datetime.timedelta(microseconds=1)
+# storage backends selectable with HRS_STORAGE or "storage" in config.json
+STORAGE_BACKENDS = ("mongo", "memory", "sqlite")
+
+
+def normalize_id(patient_id):
+    """
+    Normalizes a patient ID to the string form stored as the primary key.
+    IDs arrive as ints from JSON bodies and as strings from URLs, so both
+    must map onto the same key.
+    Args:
+        patient_id: ID of the patient.
+
+    Returns:
+        str: Normalized patient ID.
+    """
+    return str(patient_id)
+
+
+def aggregate_stats(count, hr_sum, hr_sum_sq, hr_min, hr_max, last_heart_rate,
+                    last_timestamp, last_is_tachycardic):
+    """
+    Builds the result of get_stats from a patient's running aggregates.
+    Args:
+        count (int): Number of samples.
+        hr_sum (int): Sum of the heart rates.
+        hr_sum_sq (int): Sum of the squared heart rates.
+        hr_min (int): Minimum heart rate.
+        hr_max (int): Maximum heart rate.
+        last_heart_rate (int): Heart rate of the latest sample.
+        last_timestamp (int): Timestamp of the latest sample in microseconds
+            since epoch.
+        last_is_tachycardic (bool): Status of the latest sample.
+
+    Returns:
+        dict: count, mean, min, max, variance, last_heart_rate,
+            last_timestamp and last_is_tachycardic.
+    """
+    stats = {
+        "count": count,
+        "mean": None,
+        "min": hr_min,
+        "max": hr_max,
+        "variance": None,
+        "last_heart_rate": last_heart_rate,
+        "last_timestamp": None,
+        "last_is_tachycardic": last_is_tachycardic,
+    }
+    if count:
+        mean = hr_sum / count
+        stats["mean"] = mean
+        stats["variance"] = max(hr_sum_sq / count - mean * mean, 0.0)
+        stats["last_timestamp"] = from_micros(last_timestamp)
+    return stats
+
+
+class HRStorage(object):
+    """
+    Storage of patients and their heart rates. Backends implement the
+    abstract methods, the rest is built on top of them.
+    """
+    # whether the data lives in the process, so workers cannot share it
+    process_local = False
+
+    def __init__(self):
+        self._indexes = OrderedDict()
+        # guards _indexes and _index_locks, never held while reading samples
+        self._index_lock = threading.Lock()
+        # per patient lock and number of threads using it
+        self._index_locks = {}
+
+    def iter_patients(self, after=None, limit=None, fields=PATIENT_FIELDS):
+        """
+        Iterates over patients in ID order, without loading all of them.
+        Args:
+            after: Only patients with an ID after this one, for paging.
+            limit (int): Maximum number of patients.
+            fields (tuple): Fields of PATIENT_FIELDS to include. Samples are
+                only read if heart_rates or timestamps are asked for.
+
+        Returns:
+            generator: Json dictionaries of the patients.
+        """
+        raise NotImplementedError
+
+    def add_patient(self, user_info):
+        """
+        Adds a new patient.
+        Args:
+            user_info (dict): Dictionary with the user's info.
+        """
+        raise NotImplementedError
+
+    def remove_patient(self, patient_id):
+        """
+        Removes a patient and its heart rates.
+        Args:
+            patient_id (str): ID of the patient to remove.
+
+        Returns:
+            bool: Whether or not the user was removed.
+        """
+        raise NotImplementedError
+
+    def get_patient(self, patient_id):
+        """
+        Finds a patient.
+        Args:
+            patient_id (str): ID of the patient to find.
+
+        Returns:
+            object: Patient with patient_id, attending_email and user_age
+                attributes. Returns None if DNE.
+        """
+        raise NotImplementedError
+
+    def get_patients(self, patient_ids):
+        """
+        Finds many patients at once.
+        Args:
+            patient_ids (list): IDs of the patients to find.
+
+        Returns:
+            dict: Patients that exist, keyed by normalized ID.
+        """
+        raise NotImplementedError
+
+    def add_hr(self, patient_id, heart_rate, timestamp, is_tachycardic=None):
+        """
+        Adds a heart rate and corresponding timestamp to a user.
+        Args:
+            patient_id: ID of the patient to add hr to.
+            heart_rate: New heart rate.
+            timestamp: New timestamp.
+            is_tachycardic (bool): Status of the sample, kept as the patient's
+                status while it is the latest sample.
+
+        Returns:
+            bool: Whether or not the patient exists.
+        """
+        raise NotImplementedError
+
+    def add_hr_batch(self, samples):
+        """
+        Adds many heart rates across many patients.
+        Args:
+            samples (list): (patient_id, heart_rate, timestamp) tuples, with
+                an optional fourth element is_tachycardic as in add_hr.
+
+        Returns:
+            set: Normalized IDs of the patients that exist and were written.
+        """
+        raise NotImplementedError
+
+    def reclassify(self, classify, chunk_size=10000):
+        """
+        Re-evaluates the stored status of every patient's latest sample.
+        A status is only written if no newer sample arrived in the meantime.
+        Args:
+            classify: Function of (ages, heart_rates) arrays returning an array
+                of statuses.
+            chunk_size (int): Patients per chunk.
+
+        Returns:
+            tuple: Number of patients evaluated, and of statuses changed.
+        """
+        raise NotImplementedError
+
+    def get_stats(self, patient_id):
+        """
+        Reads the running aggregates of a patient. Never touches the samples.
+        Args:
+            patient_id: ID of the patient.
+
+        Returns:
+            dict: As built by aggregate_stats. Returns None if the patient
+                DNE.
+        """
+        raise NotImplementedError
+
+    def get_version(self, patient_id):
+        """
+        Reads the version of a patient, which changes whenever its samples or
+        status do. It starts at the creation time of the patient in
+        microseconds since epoch, so a patient that is removed and added
+        again does not repeat the versions of the old one. It is bumped
+        after the change is written, so anything read after the version
+        is at least as new as that version.
+        Args:
+            patient_id: ID of the patient.
+
+        Returns:
+            int: Version of the patient. Returns None if the patient DNE.
+        """
+        raise NotImplementedError
+
+    def iter_samples(self, patient_id, since=None, until=None):
+        """
+        Iterates over the heart rates of a patient with since <= timestamp <
+        until, in time order.
+        Args:
+            patient_id: ID of the patient.
+            since (datetime.datetime): Start of the range. Unbounded if None.
+            until (datetime.datetime): End of the range. Unbounded if None.
+
+        Returns:
+            generator: (timestamp, heart_rate) tuples.
+        """
+        raise NotImplementedError
+
+    def _sample_arrays(self, patient_id, since=None, until=None):
+        """
+        Reads the samples of a patient into arrays.
+        Args:
+            patient_id: ID of the patient.
+            since (int): Earliest timestamp to read, in microseconds since
+                epoch.
+            until (int): End of the range to read, exclusive, in microseconds
+                since epoch.
+
+        Returns:
+            tuple: Sorted timestamps in microseconds since epoch and the
+                matching heart rates, both numpy arrays.
+        """
+        raise NotImplementedError
+
+    def get_all(self):
+        """
+        Obtains a dictionary of every patient, accessible by ID. Testing only!
+        Returns:
+            dict: Patients in the database
+        """
+        return {patient["patient_id"]: patient
+                for patient in self.iter_patients()}
+
+    def get_samples(self, patient_id, since=None, until=None):
+        """
+        Gets the heart rates of a patient with since <= timestamp < until, in
+        time order.
+        Args:
+            patient_id: ID of the patient.
+            since (datetime.datetime): Start of the range. Unbounded if None.
+            until (datetime.datetime): End of the range. Unbounded if None.
+
+        Returns:
+            tuple: List of timestamps and list of matching heart rates.
+        """
+        timestamps = []
+        heart_rates = []
+        for timestamp, heart_rate in self.iter_samples(patient_id, since, until):
+            timestamps.append(timestamp)
+            heart_rates.append(heart_rate)
+        return timestamps, heart_rates
+
+    @contextmanager
+    def _patient_index_lock(self, patient_id):
+        """
+        Holds the index lock of one patient, so that the index of a patient
+        is built once while other patients are queried meanwhile. The lock
+        is forgotten once no thread uses it.
+        Args:
+            patient_id (str): Normalized ID of the patient.
+        """
+        with self._index_lock:
+            entry = self._index_locks.get(patient_id)
+            if entry is None:
+                entry = self._index_locks[patient_id] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._index_lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._index_locks[patient_id]
+
+    def _interval_index(self, patient_id, sample_count):
+        """
+        Gets the interval index of a patient, bringing it up to date. Samples
+        newer than the index are appended, anything else forces a rebuild.
+        Called with the index lock of the patient.
+        Args:
+            patient_id (str): Normalized ID of the patient.
+            sample_count (int): Number of samples the patient has.
+
+        Returns:
+            IntervalIndex: Index over all samples of the patient.
+        """
+        with self._index_lock:
+            index = self._indexes.get(patient_id)
+        if index is not None and len(index) != sample_count and len(index):
+            timestamps, heart_rates = self._sample_arrays(
+                patient_id, since=index.last_timestamp + 1)
+            if len(index) + len(timestamps) == sample_count:
+                index.extend(timestamps, heart_rates)
+        if index is None or len(index) != sample_count:
+            index = IntervalIndex(*self._sample_arrays(patient_id))
+
+        with self._index_lock:
+            self._indexes[patient_id] = index
+            self._indexes.move_to_end(patient_id)
+            while len(self._indexes) > INDEX_CACHE_SIZE:
+                self._indexes.popitem(last=False)
+        return index
+
+    def _drop_index(self, patient_id):
+        """
+        Forgets the interval index of a removed patient.
+        Args:
+            patient_id (str): Normalized ID of the patient.
+        """
+        with self._patient_index_lock(patient_id):
+            with self._index_lock:
+                self._indexes.pop(patient_id, None)
+
+    def get_interval_stats(self, patient_id, since=None, until=None):
+        """
+        Summarizes the heart rates of a patient with since <= timestamp <
+        until in O(log n), through an in memory index of the patient.
+        Args:
+            patient_id: ID of the patient.
+            since (datetime.datetime): Start of the window. Unbounded if None.
+            until (datetime.datetime): End of the window. Unbounded if None.
+
+        Returns:
+            dict: count, mean, min, max and variance. Returns None if the
+                patient DNE.
+        """
+        stats = self.get_stats(patient_id)
+        if stats is None:
+            return None
+        patient_id = normalize_id(patient_id)
+        with self._patient_index_lock(patient_id):
+            index = self._interval_index(patient_id, stats["count"])
+            return index.query(
+                None if since is None else to_micros(since),
+                None if until is None else to_micros(until))
+
+    def downsample(self, patient_id, width, since=None, until=None):
+        """
+        Summarizes the heart rates of a patient with since <= timestamp <
+        until per bucket of width, aligned to the epoch.
+        Args:
+            patient_id: ID of the patient.
+            width (datetime.timedelta): Width of the buckets.
+            since (datetime.datetime): Start of the window. Unbounded if None.
+            until (datetime.datetime): End of the window. Unbounded if None.
+
+        Returns:
+            tuple: Arrays of bucket starts in microseconds since epoch,
+                counts, sums, minimums and maximums. Empty buckets are left
+                out.
+        """
+        timestamps, heart_rates = self._sample_arrays(
+            patient_id,
+            None if since is None else to_micros(since),
+            None if until is None else to_micros(until))
+        return aggregate(timestamps, np.ones_like(heart_rates), heart_rates,
+                         heart_rates, heart_rates, width // _MICROSECOND)
+
+    def downsample_lttb(self, patient_id, points, since=None, until=None):
+        """
+        Reduces the heart rates of a patient with since <= timestamp < until
+        to at most points samples that keep the shape of the series.
+        Args:
+            patient_id: ID of the patient.
+            points (int): Number of samples to keep.
+            since (datetime.datetime): Start of the window. Unbounded if None.
+            until (datetime.datetime): End of the window. Unbounded if None.
+
+        Returns:
+            tuple: Arrays of timestamps in microseconds since epoch and
+                heart rates of the kept samples.
+        """
+        timestamps, heart_rates = self._sample_arrays(
+            patient_id,
+            None if since is None else to_micros(since),
+            None if until is None else to_micros(until))
+        kept = lttb(timestamps, heart_rates, points)
+        return timestamps[kept], heart_rates[kept]
+
+    def after_fork(self):
+        """
+        Called in a worker process after it was forked, e.g. from gunicorn's
+        post_fork hook, to drop connections inherited from the parent.
+        """
+
+    def metrics(self):
+        """
+        Gets metrics of the backend, e.g. connection pool utilization.
+        Returns:
+            dict: Metrics, at least the name of the backend.
+        """
+        return {"backend": type(self).__name__}
+
+    def convert_to_json(self, db_object):
+        """
+        Converts a patient into a json object.
+        Args:
+            db_object: Patient as returned by get_patient.
+
+        Returns:
+            dict: Dictionary of the patient.
+
+        """
+        patient = {
+            "patient_id": db_object.patient_id,
+            "attending_email": db_object.attending_email,
+            "user_age": db_object.user_age,
+        }
+        return patient
+
+
+def make_storage(config, metrics=None):
+    """
+    Builds the storage backend named by the HRS_STORAGE environment variable,
+    or by "storage" in config.json. Defaults to mongo. Database backends
+    get a patient metadata cache in front unless patient_cache_size is 0.
+    Args:
+        config (dict): Contents of config.json.
+        metrics (Metrics): If given, calls reaching the backend are timed
+            into it. Cache hits are not.
+
+    Returns:
+        HRStorage: The storage backend.
+    """
+    backend = os.environ.get("HRS_STORAGE", config.get("storage", "mongo"))
+    if backend == "memory":
+        from hrs_memory_db import MemoryDatabase
+        storage = MemoryDatabase(config.get("memory_snapshot"))
+        if storage.snapshot_path is not None:
+            atexit.register(storage.snapshot_at_exit)
+        return _timed(storage, metrics)
+    if backend == "sqlite":
+        from hrs_sqlite_db import SQLiteDatabase
+        storage = SQLiteDatabase(config.get("sqlite_path", "hrs.sqlite3"),
+                                 config.get("sqlite_synchronous", "FULL"))
+    elif backend == "mongo":
+        from hrs_db import HRDatabase, mongo_settings
+        url, options = mongo_settings(config)
+        storage = HRDatabase(url, **options)
+    else:
+        raise ValueError("storage must be one of {}.".format(
+            ", ".join(STORAGE_BACKENDS)))
+
+    storage = _timed(storage, metrics)
+    cache_size = config.get("patient_cache_size", 10000)
+    if not cache_size:
+        return storage
+    from hrs_cache import CachedStorage, LRUCache
+    return CachedStorage(storage, LRUCache(
+        cache_size, config.get("patient_cache_ttl_seconds", 60.0)))
+
+
+def _timed(storage, metrics):
+    """
+    Times the calls to a backend if metrics are kept.
+    Args:
+        storage (HRStorage): The backend.
+        metrics (Metrics): Metrics to record into, or None.
+
+    Returns:
+        HRStorage: The backend, wrapped in a TimedStorage if metrics are
+            kept.
+    """
+    if metrics is None:
+        return storage
+    from hrs_metrics import TimedStorage
+    return TimedStorage(storage, metrics)
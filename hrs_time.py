@@ -0,0 +1,120 @@
+import re
+import datetime
+from email.utils import parsedate_to_datetime
+
+# timestamps are handled as naive datetimes in UTC, the way mongo stores them
+_EPOCH = datetime.datetime(1970, 1, 1)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+_ISO_8601 = re.compile(
+    r"^(\d{4})-(\d{2})-(\d{2})"
+    r"(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:[.,](\d+))?)?)?"
+    r"\s*(Z|[+-]\d{2}:?\d{2})?$",
+    re.IGNORECASE)
+
+
+def utc_now():
+    """
+    Gets the current time.
+    Returns:
+        datetime.datetime: Current time in UTC, without tzinfo.
+    """
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def _to_utc(timestamp):
+    """
+    Converts a datetime to a naive datetime in UTC. Naive inputs are assumed
+    to already be in UTC.
+    Args:
+        timestamp (datetime.datetime): Timestamp to convert.
+
+    Returns:
+        datetime.datetime: Naive UTC timestamp.
+    """
+    if timestamp.tzinfo is None:
+        return timestamp
+    return timestamp.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def parse_timestamp(timestamp):
+    """
+    Parses an ISO-8601 timestamp such as 2018-11-16T10:23:45.123456+05:00.
+    Space separated timestamps (YYYY-MM-DD HH:MM:SS.######) and HTTP dates
+    are accepted as well. Timestamps without a time zone are taken as UTC.
+    Args:
+        timestamp: Timestamp string, or an already parsed datetime.
+
+    Returns:
+        datetime.datetime: The parsed timestamp as naive UTC.
+
+    Raises:
+        ValueError: If the timestamp is malformed, or out of range once
+            converted to UTC, e.g. 0001-01-01T00:00:00+01:00.
+    """
+    if isinstance(timestamp, datetime.datetime):
+        try:
+            return _to_utc(timestamp)
+        except OverflowError:
+            raise ValueError("Invalid timestamp: {}".format(timestamp))
+    if type(timestamp) != str:
+        raise TypeError("timestamp must be type str.")
+
+    match = _ISO_8601.match(timestamp.strip())
+    if match is None:
+        try:
+            return _to_utc(parsedate_to_datetime(timestamp))
+        except (TypeError, ValueError, IndexError, OverflowError):
+            raise ValueError("Invalid timestamp: {}".format(timestamp))
+
+    year, month, day, hour, minute, second, fraction, zone = match.groups()
+    microsecond = int((fraction or "0")[:6].ljust(6, "0"))
+    tzinfo = None
+    if zone is not None and zone.upper() == "Z":
+        tzinfo = datetime.timezone.utc
+    elif zone is not None:
+        zone = zone.replace(":", "")
+        offset = datetime.timedelta(hours=int(zone[1:3]), minutes=int(zone[3:5]))
+        tzinfo = datetime.timezone(-offset if zone[0] == "-" else offset)
+    try:
+        parsed = datetime.datetime(int(year), int(month), int(day),
+                                   int(hour or 0), int(minute or 0),
+                                   int(second or 0), microsecond, tzinfo)
+        return _to_utc(parsed)
+    except (ValueError, OverflowError):
+        raise ValueError("Invalid timestamp: {}".format(timestamp))
+
+
+def format_timestamp(timestamp):
+    """
+    Formats a timestamp for a json response.
+    Args:
+        timestamp (datetime.datetime): Naive UTC timestamp to format.
+
+    Returns:
+        str: ISO-8601 timestamp with an explicit UTC offset.
+    """
+    return timestamp.replace(tzinfo=datetime.timezone.utc).isoformat()
+
+
+def to_micros(timestamp):
+    """
+    Converts a timestamp to microseconds since epoch.
+    Args:
+        timestamp (datetime.datetime): Naive UTC timestamp.
+
+    Returns:
+        int: Microseconds since epoch.
+    """
+    return (timestamp - _EPOCH) // _MICROSECOND
+
+
+def from_micros(micros):
+    """
+    Converts microseconds since epoch to a timestamp.
+    Args:
+        micros (int): Microseconds since epoch.
+
+    Returns:
+        datetime.datetime: Naive UTC timestamp.
+    """
+    return _EPOCH + micros * _MICROSECOND
@@ -0,0 +1,5 @@
+import os
+
+# the suite runs against the in memory backend unless told otherwise, so it
+# needs neither network nor credentials
+os.environ.setdefault("HRS_STORAGE", "memory")
@@ -14,6 +14,13 @@ def test_get_all_patients():
     assert hr_api.get_all_patients()[p_id]["patient_id"] == patient["patient_id"]
 
 
+def test_iter_all_patients():
+    p_id = _new_patient_id()
+    hr_api.add_new_patient(p_id, "test@gmail.com", 21)
+    ids = [p["patient_id"] for p in hr_api.iter_all_patients(2, ["patient_id"])]
+    assert p_id in ids and ids == sorted(ids)
+
+
 def test_add_new_patient():
     p_id = _new_patient_id()
     hr_api.add_new_patient(p_id, "test@gmail.com", 21)
@@ -40,6 +47,22 @@ def test_get_interval_average():
     assert avg == 90
 
 
+def test_get_interval_stats():
+    p_id = _new_patient_id()
+    hr_api.add_new_patient(p_id, "test@gmail.com", 21)
+    hr_api.post_heart_rate_batch([
+        (p_id, 80, "2018-11-16T10:00:00Z"),
+        (p_id, 100, "2018-11-16T10:30:00Z"),
+        (p_id, 120, "2018-11-16T11:30:00Z"),
+    ])
+    stats = hr_api.get_interval_stats(p_id, "2018-11-16T10:15:00Z",
+                                      "2018-11-16T11:30:00Z")
+    assert stats["count"] == 1 and stats["mean"] == 100
+    avg = hr_api.get_interval_average(p_id, "2018-11-16T10:00:00Z",
+                                      until="2018-11-16T12:00:00Z")
+    assert avg == 100
+
+
 def test_get_interval_average_no_exist():
     p_id = _new_patient_id()
     with pytest.raises(ValueError):
@@ -50,7 +73,7 @@ def test_post_heart_rate():
     p_id = _new_patient_id()
     hr_api.add_new_patient(p_id, "test@gmail.com", 21)
     resp = hr_api.post_heart_rate(p_id, 90)
-    assert resp["heart_rates"] == [90]
+    assert resp["heart_rate"] == 90
 
 
 @pytest.mark.parametrize("heart_rate, error", [
@@ -65,6 +88,14 @@ def test_post_heart_rate_bad(heart_rate, error):
         hr_api.post_heart_rate(p_id, heart_rate)
 
 
+def test_post_heart_rate_batch():
+    p_id = _new_patient_id()
+    hr_api.add_new_patient(p_id, "test@gmail.com", 21)
+    resp = hr_api.post_heart_rate_batch([(p_id, 80), (p_id, -1), (p_id, 100)])
+    assert [r["status_code"] for r in resp] == [200, 400, 200]
+    assert hr_api.get_heart_rate(p_id) == [80, 100]
+
+
 def test_get_patient_status():
     p_id = _new_patient_id()
     hr_api.add_new_patient(p_id, "test@gmail.com", 21)
@@ -96,6 +127,29 @@ def test_get_heart_rate_no_exist():
         hr_api.post_heart_rate(p_id, 90)
 
 
+def test_iter_heart_rates():
+    p_id = _new_patient_id()
+    hr_api.add_new_patient(p_id, "test@gmail.com", 21)
+    hr_api.post_heart_rate_batch([
+        (p_id, 70 + i, "2018-11-16T10:0{}:00Z".format(i)) for i in range(5)])
+    records = list(hr_api.iter_heart_rates(
+        p_id, since="2018-11-16T10:01:00Z", until="2018-11-16T10:04:00Z",
+        page_size=2))
+    assert [r["heart_rate"] for r in records] == [71, 72, 73]
+
+
+def test_get_downsampled():
+    p_id = _new_patient_id()
+    hr_api.add_new_patient(p_id, "test@gmail.com", 21)
+    hr_api.post_heart_rate_batch([
+        (p_id, 70 + i, "2018-11-16T10:{:02d}:00Z".format(i)) for i in range(10)])
+    resp = hr_api.get_downsampled(p_id, width=300)
+    assert [b["count"] for b in resp["buckets"]] == [5, 5]
+    assert [b["mean"] for b in resp["buckets"]] == [72, 77]
+    resp = hr_api.get_downsampled(p_id, points=4, method="lttb")
+    assert len(resp["records"]) == 4
+
+
 def test_get_heart_rate_average():
     p_id = _new_patient_id()
     hr_api.add_new_patient(p_id, "test@gmail.com", 21)
@@ -122,3 +176,22 @@ def test_get_heart_rate_average_no_exist():
 def test_error_catcher(json_info, error):
     with pytest.raises(error):
         hr_api.error_catcher(json_info)
+
+
+def test_async_client_fan_out():
+    import asyncio
+    from hr_api_async import AsyncHRClient
+    p_ids = [_new_patient_id() for _ in range(20)]
+
+    async def run():
+        async with AsyncHRClient(concurrency=8) as client:
+            await asyncio.gather(*(client.add_new_patient(p_id, "a@duke.edu", 21)
+                                   for p_id in p_ids))
+            await asyncio.gather(*(client.post_heart_rate(p_id, 80)
+                                   for p_id in p_ids))
+            return await asyncio.gather(*(client.get_heart_rate(p_id)
+                                          for p_id in p_ids))
+
+    assert asyncio.run(run()) == [[80]] * 20
+    assert hr_api.fan_out("get_heart_rate_average",
+                          [(p_id,) for p_id in p_ids]) == [80] * 20
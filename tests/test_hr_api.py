@@ -0,0 +1,183 @@
+import json
+import time
+import asyncio
+import threading
+import pytest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import hr_api
+from hr_api_async import AsyncHRClient
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # keep-alive
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def _reply(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.command, self.path))
+            server.ports.add(self.client_address[1])
+            server.in_flight += 1
+            server.peak = max(server.peak, server.in_flight)
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        time.sleep(server.delay)
+        status = server.statuses.pop(0) if server.statuses else 200
+        body = json.dumps(server.body).encode()
+        with server.lock:
+            server.in_flight -= 1
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = _reply
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    server.requests = []
+    server.ports = set()
+    server.statuses = []
+    server.body = [True, "2018-11-16T10:00:00"]
+    server.delay = 0
+    server.lock = threading.Lock()
+    server.in_flight = server.peak = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _client(server, **kwargs):
+    return hr_api.HRClient("http://127.0.0.1:{}/api".format(
+        server.server_address[1]), backoff=0, **kwargs)
+
+
+def test_keep_alive(server):
+    with _client(server) as client:
+        for _ in range(5):
+            assert client.get_patient_status("p") == [True, "2018-11-16T10:00:00"]
+    assert server.requests == [("GET", "/api/status/p")] * 5
+    assert len(server.ports) == 1
+
+
+def test_get_retried(server):
+    server.statuses = [503, 502]
+    with _client(server) as client:
+        assert client.get_heart_rate_average("p")
+    assert len(server.requests) == 3
+
+
+def test_post_not_retried(server):
+    server.statuses = [503]
+    with _client(server) as client:
+        assert client.post("heart_rate", {"patient_id": "p"}).status_code == 503
+    assert len(server.requests) == 1
+
+
+def test_module_functions_use_default_client(server, monkeypatch):
+    monkeypatch.setattr(hr_api, "default_client", hr_api.default_client)
+    hr_api.set_default_client(_client(server))
+    hr_api.get_patient_status("q")
+    assert server.requests == [("GET", "/api/status/q")]
+
+
+def test_fan_out(server):
+    server.delay = 0.01
+    with _client(server, pool_size=4) as client:
+        results = client.fan_out("post_heart_rate",
+                                 [("p{}".format(i), 80) for i in range(20)])
+    assert len(results) == 20 and server.peak == 4
+    assert len(server.ports) == 4
+
+    server.body = {"status_code": 400, "msg": "Patient does not exist yet.",
+                   "error_type": "ValueError"}
+    with _client(server) as client:
+        results = client.fan_out("post_heart_rate", [("p", 80)],
+                                 return_exceptions=True)
+        assert isinstance(results[0], ValueError)
+        with pytest.raises(ValueError):
+            client.fan_out("post_heart_rate", [("p", 80)])
+
+
+def test_async_client(server):
+    server.delay = 0.01
+    url = "http://127.0.0.1:{}/api".format(server.server_address[1])
+
+    async def run():
+        async with AsyncHRClient(url, concurrency=5, backoff=0) as client:
+            statuses = await asyncio.gather(*(
+                client.get_patient_status("p{}".format(i)) for i in range(30)))
+            server.body = {"status_code": 500, "msg": "User does not exist.",
+                           "error_type": "ValueError"}
+            with pytest.raises(ValueError):
+                await client.get_heart_rate_average("nobody")
+        return statuses
+
+    statuses = asyncio.run(run())
+    assert statuses == [[True, "2018-11-16T10:00:00"]] * 30
+    assert server.peak == 5
+
+
+def test_async_iter_heart_rates(server):
+    url = "http://127.0.0.1:{}/api".format(server.server_address[1])
+    server.body = {"records": [{"timestamp": "2018-11-16T10:00:00",
+                                "heart_rate": 80}] * 2, "next_cursor": None}
+
+    async def run():
+        async with AsyncHRClient(url, concurrency=2) as client:
+            return [record async for record in client.iter_heart_rates(
+                "p", page_size=2)]
+
+    assert len(asyncio.run(run())) == 2
+
+
+def test_async_retries(server):
+    url = "http://127.0.0.1:{}/api".format(server.server_address[1])
+    server.statuses = [503, 502]
+
+    async def run():
+        async with AsyncHRClient(url, concurrency=2, backoff=0) as client:
+            await client.get_heart_rate_average("p")
+            server.statuses = [503]
+            await client.post_heart_rate("p", 80)
+
+    asyncio.run(run())
+    assert [method for method, _ in server.requests] == [
+        "GET", "GET", "GET", "POST"]
+    assert len(server.ports) == 1
+
+
+def test_clients_send_the_same_requests(server):
+    url = "http://127.0.0.1:{}/api".format(server.server_address[1])
+    since = "2018-11-16T10:00:00+00:00"
+    with _client(server) as client:
+        client.get_downsampled("p", since=since, width=60)
+        client.get_interval_stats("p", since=since)
+    sync_requests, server.requests = server.requests, []
+
+    async def run():
+        async with AsyncHRClient(url, backoff=0) as client:
+            await client.get_downsampled("p", since=since, width=60)
+            await client.get_interval_stats("p", since=since)
+
+    asyncio.run(run())
+    assert server.requests == sync_requests
+    assert sync_requests[0] == (
+        "GET", "/api/heart_rate/downsample/p?points=500&method=bucket"
+               "&since=2018-11-16T10%3A00%3A00%2B00%3A00&width=60")
+
+
+def test_page_requests_quote_the_cursor():
+    assert hr_api.heart_rates_page_request("p", cursor="1-0 x")[1] == \
+        "heart_rate/p?limit=1000&cursor=1-0%20x"
+    assert hr_api.patients_page_request(2, cursor="a b")[1] == \
+        "all_patients?limit=2&cursor=a%20b"
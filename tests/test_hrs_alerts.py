@@ -0,0 +1,60 @@
+import pytest
+from hrs_alerts import AlertDispatcher, StubSender
+
+
+@pytest.fixture()
+def sender():
+    return StubSender()
+
+
+def test_submit_sends(sender):
+    alerts = AlertDispatcher(sender)
+    assert alerts.submit("1", "doc@duke.edu", "Subject", "Content")
+    alerts.flush()
+    assert list(sender.sent) == [("doc@duke.edu", "Subject", "Content")]
+    assert alerts.metrics()["sent"] == 1
+
+
+def test_submit_deduplicates_within_window(sender):
+    alerts = AlertDispatcher(sender, window=60)
+    alerts.submit("1", "doc@duke.edu", "Subject", "Content")
+    alerts.flush()
+    assert not alerts.submit("1", "doc@duke.edu", "Subject", "Content")
+    assert alerts.submit("2", "doc@duke.edu", "Subject", "Content")
+    alerts.flush()
+    metrics = alerts.metrics()
+    assert metrics["sent"] == 2 and metrics["suppressed"] == 1
+
+
+def test_submit_resends_after_window(sender):
+    alerts = AlertDispatcher(sender, window=0)
+    alerts.submit("1", "doc@duke.edu", "Subject", "Content")
+    alerts.flush()
+    assert alerts.submit("1", "doc@duke.edu", "Subject", "Content")
+    alerts.flush()
+    assert len(sender.sent) == 2
+
+
+def test_submit_coalesces_and_drops_while_queued(sender):
+    # no workers, so everything stays queued
+    alerts = AlertDispatcher(sender, workers=0, max_queue=1)
+    assert alerts.submit("1", "doc@duke.edu", "Subject", "Content")
+    assert not alerts.submit("1", "doc@duke.edu", "Subject", "Content")
+    assert not alerts.submit("2", "doc@duke.edu", "Subject", "Content")
+    metrics = alerts.metrics()
+    assert metrics["queue_depth"] == 1
+    assert metrics["coalesced"] == 1 and metrics["dropped"] == 1
+
+
+@pytest.mark.parametrize("fail_times, sent, failed", [
+    (2, 1, 0),
+    (5, 0, 1),
+])
+def test_send_retries(fail_times, sent, failed):
+    sender = StubSender(fail_times=fail_times)
+    alerts = AlertDispatcher(sender, max_retries=2, backoff=0.001)
+    alerts.submit("1", "doc@duke.edu", "Subject", "Content")
+    alerts.flush()
+    metrics = alerts.metrics()
+    assert (metrics["sent"], metrics["failed"]) == (sent, failed)
+    assert metrics["retries"] == 2
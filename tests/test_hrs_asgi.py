@@ -0,0 +1,175 @@
+import json
+import asyncio
+import pytest
+from hrs_asgi import ASGIApp, create_asgi_app
+import heart_rate_sentinel_server
+from heart_rate_sentinel_server import get_app
+
+
+@pytest.fixture()
+def asgi_app():
+    app = ASGIApp(get_app(), threads=4)
+    yield app
+    app.executor.shutdown()
+
+
+async def _request(app, method, path, body=None, headers=()):
+    path, _, query = path.partition("?")
+    data = b"" if body is None else json.dumps(body).encode()
+    scope = {"type": "http", "method": method, "path": path,
+             "query_string": query.encode(), "http_version": "1.1",
+             "headers": [(b"content-type", b"application/json")] +
+             [(name.encode(), value.encode()) for name, value in headers]}
+    # the body arrives in two pieces
+    messages = [{"type": "http.request", "body": data[:5], "more_body": True},
+                {"type": "http.request", "body": data[5:]}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    await app(scope, receive, send)
+    headers = {name.decode(): value.decode()
+               for name, value in sent[0]["headers"]}
+    return (sent[0]["status"], headers,
+            b"".join(message.get("body", b"") for message in sent[1:]))
+
+
+def _run(app, *args, **kwargs):
+    return asyncio.run(_request(app, *args, **kwargs))
+
+
+def test_same_json_as_flask(asgi_app):
+    patient = {"patient_id": "asgi", "attending_email": "a@duke.edu",
+               "user_age": 30}
+    status, _, body = _run(asgi_app, "POST", "/api/new_patient", patient)
+    assert status == 200 and json.loads(body) == patient
+    _run(asgi_app, "POST", "/api/heart_rate",
+         {"patient_id": "asgi", "heart_rate": 80})
+
+    client = get_app().test_client()
+    for path in ("/api/status/asgi", "/api/heart_rate/asgi?limit=5",
+                 "/api/heart_rate/average/asgi", "/api/status/nobody"):
+        status, _, body = _run(asgi_app, "GET", path)
+        assert status == 200
+        assert body == client.get(path).data
+
+
+def test_etag_and_stream(asgi_app):
+    _run(asgi_app, "POST", "/api/new_patient",
+         {"patient_id": "asgi2", "attending_email": "a@duke.edu",
+          "user_age": 30})
+    for heart_rate in (70, 80, 90):
+        _run(asgi_app, "POST", "/api/heart_rate",
+             {"patient_id": "asgi2", "heart_rate": heart_rate})
+    _, headers, _ = _run(asgi_app, "GET", "/api/status/asgi2")
+    status, _, body = _run(asgi_app, "GET", "/api/status/asgi2",
+                           headers=[("If-None-Match", headers["etag"])])
+    assert status == 304 and body == b""
+
+    _, headers, body = _run(asgi_app, "GET",
+                            "/api/heart_rate/asgi2?format=ndjson")
+    assert headers["content-type"] == "application/x-ndjson"
+    assert [json.loads(line)["heart_rate"]
+            for line in body.decode().splitlines()] == [70, 80, 90]
+
+
+def test_client_gone_mid_stream():
+    app = ASGIApp(get_app(), threads=1)
+    _run(app, "POST", "/api/new_patient",
+         {"patient_id": "asgi3", "attending_email": "a@duke.edu",
+          "user_age": 30})
+    _run(app, "POST", "/api/heart_rate/batch", {"records": [
+        {"patient_id": "asgi3", "heart_rate": 60 + i % 40,
+         "timestamp": "2018-11-16T10:{:02d}:{:02d}".format(i // 60, i % 60)}
+        for i in range(100)]})
+
+    async def gone():
+        sent = []
+        messages = [{"type": "http.request", "body": b""}]
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+            if len(sent) > 2:
+                raise OSError("connection reset")
+
+        scope = {"type": "http", "method": "GET",
+                 "path": "/api/heart_rate/asgi3",
+                 "query_string": b"format=ndjson", "headers": []}
+        with pytest.raises(OSError):
+            await app(scope, receive, send)
+
+    asyncio.run(gone())
+    # the only thread is free again
+    status, _, _ = _run(app, "GET", "/api/status/asgi3")
+    assert status == 200
+    app.executor.shutdown()
+
+
+def test_failure_mid_stream_aborts():
+    def failing(environ, start_response):
+        start_response("200 OK", [("Content-Type", "application/x-ndjson")])
+        yield b"{}\n"
+        raise RuntimeError("cursor lost")
+
+    app = ASGIApp(failing, threads=1)
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": b""}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "GET", "path": "/",
+             "query_string": b"", "headers": []}
+    with pytest.raises(RuntimeError):
+        asyncio.run(app(scope, receive, send))
+    # the body is never ended, so the client cannot take it as complete
+    assert [message["type"] for message in sent] == \
+        ["http.response.start", "http.response.body"]
+    assert sent[1]["more_body"]
+    app.executor.shutdown()
+
+
+def test_concurrent_requests(asgi_app):
+    async def poll():
+        return await asyncio.gather(*(_request(asgi_app, "GET",
+                                               "/api/all_patients?limit=1")
+                                      for _ in range(50)))
+    assert all(status == 200 for status, _, _ in asyncio.run(poll()))
+
+
+def test_body_too_large():
+    app = ASGIApp(get_app(), threads=1, max_body_size=4)
+    status, _, _ = _run(app, "POST", "/api/new_patient", {"patient_id": 1})
+    assert status == 413
+    app.executor.shutdown()
+
+
+def test_lifespan(monkeypatch):
+    monkeypatch.setenv("HRS_STORAGE", "memory")
+    for name in ("config_info", "metrics", "alerts", "patients",
+                 "responses"):
+        monkeypatch.setattr(heart_rate_sentinel_server, name, None)
+    app = create_asgi_app({"storage": "memory", "asgi_threads": 2})
+    assert app.threads == 2
+    monkeypatch.setenv("HRS_ASGI_THREADS", "3")
+    assert create_asgi_app({"storage": "memory"}).threads == 3
+    messages = [{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message["type"])
+
+    asyncio.run(app({"type": "lifespan"}, receive, send))
+    assert sent == ["lifespan.startup.complete", "lifespan.shutdown.complete"]
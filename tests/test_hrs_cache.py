@@ -0,0 +1,96 @@
+import pytest
+import hrs_cache
+from hrs_cache import LRUCache, CachedStorage
+from hrs_memory_db import MemoryDatabase
+
+
+class CountingDatabase(MemoryDatabase):
+    def __init__(self):
+        super(CountingDatabase, self).__init__()
+        self.reads = 0
+
+    def get_patient(self, patient_id):
+        self.reads += 1
+        return super(CountingDatabase, self).get_patient(patient_id)
+
+    def get_patients(self, patient_ids):
+        self.reads += 1
+        return super(CountingDatabase, self).get_patients(patient_ids)
+
+
+@pytest.fixture
+def cached():
+    storage = CachedStorage(CountingDatabase(), LRUCache(max_size=2, ttl=60))
+    for patient_id in ("a", "b", "c"):
+        storage.add_patient({"patient_id": patient_id,
+                             "attending_email": "test@duke.edu",
+                             "user_age": 21})
+    return storage
+
+
+def test_lru_eviction():
+    cache = LRUCache(max_size=2, ttl=None)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+    metrics = cache.metrics()
+    assert (metrics["hits"], metrics["misses"], metrics["evictions"]) == (3, 1, 1)
+
+
+def test_ttl_expiry(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(hrs_cache.time, "monotonic", lambda: now[0])
+    cache = LRUCache(ttl=10)
+    cache.put("a", 1)
+    now[0] += 5
+    assert cache.get("a") == 1
+    now[0] += 6
+    assert cache.get("a") is None
+    assert cache.metrics()["expirations"] == 1
+
+
+def test_byte_budget():
+    cache = LRUCache(max_size=10, ttl=None, max_bytes=10, max_entry_bytes=6)
+    assert cache.put("a", b"aaaa")
+    assert cache.put("b", b"bbbb")
+    # over the entry cap, not stored and nothing evicted for it
+    assert not cache.put("c", b"c" * 7)
+    assert cache.get("c") is None and cache.get("a") == b"aaaa"
+    # over the total, the least recently used goes
+    assert cache.put("d", b"dddd")
+    assert cache.get("b") is None
+    assert cache.put("a", b"aa")
+    metrics = cache.metrics()
+    assert (metrics["size"], metrics["bytes"]) == (2, 6)
+    assert (metrics["oversized"], metrics["evictions"]) == (1, 1)
+
+
+def test_get_patient_read_through(cached):
+    assert cached.get_patient("a").user_age == 21
+    assert cached.get_patient("a").user_age == 21
+    assert cached.storage.reads == 1
+    assert cached.get_patient("missing") is None
+    assert cached.get_patient("missing") is None
+    assert cached.storage.reads == 3
+
+
+def test_get_patients_reads_only_uncached(cached):
+    cached.get_patient("a")
+    reads = cached.storage.reads
+    assert set(cached.get_patients(["a", "b"])) == {"a", "b"}
+    assert cached.storage.reads == reads + 1
+    assert set(cached.get_patients(["a", "b"])) == {"a", "b"}
+    assert cached.storage.reads == reads + 1
+
+
+def test_remove_invalidates(cached):
+    assert cached.get_patient("a") is not None
+    assert cached.remove_patient("a")
+    assert cached.get_patient("a") is None
+    # everything else is passed through to the backend
+    assert cached.add_hr("b", 80, "2018-11-16T10:00:00Z")
+    assert cached.get_stats("b")["count"] == 1
+    assert "patient_cache" in cached.metrics()
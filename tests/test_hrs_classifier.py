@@ -0,0 +1,31 @@
+import numpy as np
+from hrs_classifier import classify, is_tachycardic
+
+
+def _reference(age, heart_rate):
+    # the original chain of branches
+    if 1 <= age <= 2 and heart_rate > 151:
+        return True
+    elif 3 <= age <= 4 and heart_rate > 137:
+        return True
+    elif 5 <= age <= 7 and heart_rate > 133:
+        return True
+    elif 8 <= age <= 11 and heart_rate > 130:
+        return True
+    elif 12 <= age <= 15 and heart_rate > 119:
+        return True
+    elif age > 15 and heart_rate > 100:
+        return True
+    return False
+
+
+def test_classify_matches_reference():
+    ages, heart_rates = np.meshgrid(np.arange(0, 30), np.arange(0, 250))
+    ages, heart_rates = ages.ravel(), heart_rates.ravel()
+    expect = [_reference(a, hr) for a, hr in zip(ages, heart_rates)]
+    assert classify(ages, heart_rates).tolist() == expect
+    assert [is_tachycardic(a, hr) for a, hr in zip(ages, heart_rates)] == expect
+
+
+def test_classify_empty():
+    assert classify([], []).tolist() == []
@@ -0,0 +1,40 @@
+import pymodm.connection
+from hrs_db import HRDatabase, PoolMonitor, mongo_settings
+
+
+def test_mongo_settings_from_config(monkeypatch):
+    monkeypatch.delenv("HRS_MONGO_URI", raising=False)
+    monkeypatch.delenv("HRS_MONGO_MAX_POOL_SIZE", raising=False)
+    url, options = mongo_settings({"mongo_user": "u", "mongo_pass": "p",
+                                   "mongo_max_pool_size": 10})
+    assert url.startswith("mongodb://u:p@")
+    assert options == {"maxPoolSize": 10}
+
+
+def test_mongo_settings_env_overrides(monkeypatch):
+    monkeypatch.setenv("HRS_MONGO_URI", "mongodb://localhost/hrs")
+    monkeypatch.setenv("HRS_MONGO_MAX_POOL_SIZE", "5")
+    monkeypatch.setenv("HRS_MONGO_READ_PREFERENCE", "secondaryPreferred")
+    url, options = mongo_settings({"mongo_uri": "mongodb://remote/hrs",
+                                   "mongo_max_pool_size": 10,
+                                   "mongo_connect_timeout_ms": 2000})
+    assert url == "mongodb://localhost/hrs"
+    assert options == {"maxPoolSize": 5, "connectTimeoutMS": 2000,
+                       "readPreference": "secondaryPreferred"}
+
+
+def test_pool_monitor():
+    monitor = PoolMonitor()
+    for event in ("connection_created", "connection_created",
+                  "connection_checked_out", "connection_checked_out",
+                  "connection_checked_in", "connection_closed"):
+        getattr(monitor, event)(None)
+    metrics = monitor.metrics()
+    assert (metrics["open"], metrics["in_use"], metrics["peak_in_use"]) == (1, 1, 2)
+
+
+def test_no_connection_until_used():
+    connections = dict(pymodm.connection._CONNECTIONS)
+    database = HRDatabase("mongodb://192.0.2.1:27017/unreachable")
+    assert not database.metrics()["connected"]
+    assert pymodm.connection._CONNECTIONS == connections
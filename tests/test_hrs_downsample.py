@@ -0,0 +1,46 @@
+import numpy as np
+from hrs_downsample import aggregate, lttb
+
+
+def test_aggregate_matches_loop():
+    rng = np.random.default_rng(0)
+    starts = np.sort(rng.integers(0, 10 ** 9, 1000))
+    hrs = rng.integers(40, 200, 1000)
+    width = 10 ** 7
+    out = aggregate(starts, np.ones_like(hrs), hrs, hrs, hrs, width)
+
+    expect = {}
+    for start, hr in zip(starts, hrs):
+        expect.setdefault(start // width * width, []).append(hr)
+    assert out[0].tolist() == sorted(expect)
+    assert out[1].tolist() == [len(expect[k]) for k in sorted(expect)]
+    assert out[2].tolist() == [sum(expect[k]) for k in sorted(expect)]
+    assert out[3].tolist() == [min(expect[k]) for k in sorted(expect)]
+    assert out[4].tolist() == [max(expect[k]) for k in sorted(expect)]
+
+
+def test_aggregate_merges_rollups():
+    # minute rollups merged into one two minute bucket
+    out = aggregate([0, 60], [2, 3], [150, 240], [70, 75], [80, 85], 120)
+    assert [column.tolist() for column in out] == \
+        [[0], [5], [390], [70], [85]]
+
+
+def test_aggregate_empty():
+    out = aggregate([], [], [], [], [], 60)
+    assert all(len(column) == 0 for column in out)
+
+
+def test_lttb_keeps_ends_and_peaks():
+    x = np.arange(1000)
+    y = np.full(1000, 60)
+    y[500] = 190
+    kept = lttb(x, y, 20)
+    assert len(kept) == 20
+    assert kept[0] == 0 and kept[-1] == 999
+    assert np.all(np.diff(kept) > 0)
+    assert 500 in kept
+
+
+def test_lttb_short_series():
+    assert lttb(np.arange(5), np.arange(5), 10).tolist() == [0, 1, 2, 3, 4]
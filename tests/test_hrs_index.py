@@ -0,0 +1,52 @@
+import pytest
+import numpy as np
+from hrs_index import IntervalIndex
+
+
+@pytest.fixture()
+def samples():
+    rng = np.random.default_rng(0)
+    timestamps = np.cumsum(rng.integers(0, 3, 3000))
+    heart_rates = rng.integers(40, 200, 3000)
+    return timestamps, heart_rates
+
+
+def _brute_force(timestamps, heart_rates, since, until):
+    keep = np.ones(len(timestamps), dtype=bool)
+    if since is not None:
+        keep &= timestamps >= since
+    if until is not None:
+        keep &= timestamps < until
+    return heart_rates[keep]
+
+
+def test_query_matches_brute_force(samples):
+    timestamps, heart_rates = samples
+    index = IntervalIndex()
+    # appended in uneven chunks to exercise growth of the trees
+    for lo, hi in [(0, 1), (1, 700), (700, 1030), (1030, 3000)]:
+        index.extend(timestamps[lo:hi], heart_rates[lo:hi])
+
+    rng = np.random.default_rng(1)
+    windows = [(None, None), (None, 500), (500, None)]
+    windows += [tuple(sorted(rng.integers(-10, timestamps[-1] + 10, 2)))
+                for _ in range(200)]
+    for since, until in windows:
+        expect = _brute_force(timestamps, heart_rates, since, until)
+        stats = index.query(since, until)
+        assert stats["count"] == len(expect)
+        if len(expect):
+            assert stats["mean"] == pytest.approx(expect.mean())
+            assert stats["variance"] == pytest.approx(expect.var())
+            assert (stats["min"], stats["max"]) == (expect.min(), expect.max())
+
+
+def test_query_empty():
+    stats = IntervalIndex().query(0, 10)
+    assert stats["count"] == 0 and stats["mean"] is None
+
+
+def test_extend_out_of_order():
+    index = IntervalIndex([10, 20], [80, 90])
+    with pytest.raises(ValueError):
+        index.extend([15], [100])
@@ -0,0 +1,63 @@
+import pytest
+from hrs_alerts import StubSender
+from hrs_memory_db import MemoryDatabase
+from hrs_metrics import Metrics, Histogram, Counter, TimedStorage, \
+    TimedSender, format_family
+
+
+def test_histogram_render():
+    histogram = Histogram("latency_seconds", "Latency.", ("route",),
+                          buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(("/a",), value)
+    assert histogram.count(("/a",)) == 4
+    assert histogram.render().splitlines() == [
+        "# HELP latency_seconds Latency.",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{route="/a",le="0.1"} 2',
+        'latency_seconds_bucket{route="/a",le="1.0"} 3',
+        'latency_seconds_bucket{route="/a",le="+Inf"} 4',
+        'latency_seconds_sum{route="/a"} 2.65',
+        'latency_seconds_count{route="/a"} 4',
+    ]
+
+
+def test_counter_escapes_labels():
+    counter = Counter("requests_total", "Requests.", ("route",))
+    counter.inc(('say "hi"\\\n',), 2)
+    assert counter.render().splitlines()[-1] == \
+        'requests_total{route="say \\"hi\\"\\\\\\n"} 2'
+    assert format_family("depth", "gauge", "Depth.", [({}, 3)]) \
+        .splitlines()[-1] == "depth 3"
+
+
+def test_timed_storage():
+    metrics = Metrics()
+    storage = TimedStorage(MemoryDatabase(), metrics)
+    storage.add_patient({"patient_id": "1", "attending_email": "a@duke.edu",
+                         "user_age": 30})
+    storage.add_hr("1", 80, "2018-11-16T10:00:00")
+    assert storage.get_patient("1") is not None
+    assert list(storage.iter_patients(fields=("patient_id",))) == \
+        [{"patient_id": "1"}]
+    with pytest.raises(ValueError):
+        storage.add_hr("1", 80, "not a time")
+
+    seconds = metrics.storage_seconds
+    for method in ("add_patient", "add_hr", "get_patient", "iter_patients"):
+        assert seconds.count((method, "ok")) == 1
+    assert seconds.count(("add_hr", "error")) == 1
+    # not a database call
+    storage.metrics()
+    assert seconds.count(("metrics", "ok")) == 0
+
+
+def test_timed_sender():
+    metrics = Metrics()
+    sender = TimedSender(StubSender(fail_times=1), metrics)
+    with pytest.raises(IOError):
+        sender.send("doc@duke.edu", "Subject", "Content")
+    sender.send("doc@duke.edu", "Subject", "Content")
+    assert len(sender.sent) == 1
+    assert metrics.alert_seconds.count(("ok",)) == 1
+    assert metrics.alert_seconds.count(("error",)) == 1
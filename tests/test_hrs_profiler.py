@@ -0,0 +1,88 @@
+import pytest
+from hrs_profiler import Profiler, profile_name
+
+
+def _work():
+    return sum(i * i for i in range(1000))
+
+
+HEADER = {"X-HRS-Profile": "secret"}
+
+
+def _profile(profiler, headers, route="/api/status/<patient_id>"):
+    profile = profiler.start(headers)
+    if profile is None:
+        return False
+    _work()
+    profiler.finish(profile, "GET", route)
+    return True
+
+
+def test_profile_name():
+    assert profile_name("GET", "/api/status/<patient_id>") == \
+        "GET_api_status_patient_id"
+
+
+def test_sampling(tmp_path):
+    profiler = Profiler(str(tmp_path), sample_every=4, token="secret")
+    assert [_profile(profiler, {}) for _ in range(8)] == \
+        [False, False, False, True] * 2
+    assert _profile(profiler, HEADER)
+    [entry] = profiler.profiles()
+    assert entry["name"] == "GET_api_status_patient_id"
+    assert entry["requests"] == 3 and entry["seconds"] > 0
+
+
+def test_token(tmp_path):
+    profiler = Profiler(str(tmp_path), token="secret")
+    assert not _profile(profiler, {})
+    assert not _profile(profiler, {"X-HRS-Profile": "guess"})
+    assert _profile(profiler, HEADER)
+    # without a token the header is ignored
+    profiler = Profiler(str(tmp_path))
+    assert not _profile(profiler, HEADER)
+
+
+def test_one_profile_at_a_time(tmp_path):
+    profiler = Profiler(str(tmp_path), token="secret")
+    profile = profiler.start(HEADER)
+    assert profiler.start(HEADER) is None
+    profiler.finish(profile, "GET", "/a")
+    assert _profile(profiler, HEADER)
+
+
+def test_report_and_clear(tmp_path):
+    profiler = Profiler(str(tmp_path), token="secret")
+    _profile(profiler, HEADER)
+    name = "GET_api_status_patient_id"
+    assert "_work" in profiler.report(name, limit=10)
+    assert profiler.dump(name)
+    assert profiler.report("../etc") is None
+    profiler.clear()
+    assert profiler.profiles() == [] and profiler.report(name) is None
+
+
+def test_workers_add_up(tmp_path, monkeypatch):
+    profiler = Profiler(str(tmp_path), token="secret")
+    for pid in (1, 2):
+        monkeypatch.setattr("os.getpid", lambda: pid)
+        _profile(profiler, HEADER)
+    assert len(list(tmp_path.glob("*.prof"))) == 2
+    assert profiler.profiles()[0]["requests"] == 2
+
+
+def test_files_replaced_whole(tmp_path, monkeypatch):
+    profiler = Profiler(str(tmp_path), token="secret")
+    _profile(profiler, HEADER)
+    before = {path.name: path.read_bytes() for path in tmp_path.iterdir()}
+    assert sorted(path.rsplit(".", 1)[1] for path in before) == \
+        ["json", "prof"]
+
+    def fail(src, dst):
+        raise OSError("disk full")
+    monkeypatch.setattr("os.replace", fail)
+    with pytest.raises(OSError):
+        _profile(profiler, HEADER)
+    # the totals are untouched and no temporary file is left behind
+    assert {path.name: path.read_bytes()
+            for path in tmp_path.iterdir()} == before
@@ -0,0 +1,198 @@
+import sqlite3
+import threading
+import datetime
+import pytest
+import numpy as np
+from hrs_storage import make_storage
+from hrs_memory_db import MemoryDatabase
+from hrs_sqlite_db import SQLiteDatabase
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def storage(request, tmp_path):
+    if request.param == "memory":
+        return MemoryDatabase(str(tmp_path / "snapshot.npz"))
+    return SQLiteDatabase(str(tmp_path / "hrs.sqlite3"))
+
+
+def _add(storage, patient_id, user_age=21):
+    storage.add_patient({"patient_id": patient_id,
+                         "attending_email": "test@duke.edu",
+                         "user_age": user_age})
+
+
+def test_add_get_remove(storage):
+    _add(storage, 1)
+    assert storage.get_patient("1").user_age == 21
+    with pytest.raises(ValueError):
+        _add(storage, "1")
+    assert storage.remove_patient(1)
+    assert storage.get_patient(1) is None
+    assert not storage.remove_patient(1)
+
+
+def test_iter_patients_pages(storage):
+    for patient_id in ("c", "a", "b", "d"):
+        _add(storage, patient_id)
+    first = list(storage.iter_patients(limit=2, fields=("patient_id",)))
+    rest = list(storage.iter_patients(after="b", fields=("patient_id",)))
+    assert first == [{"patient_id": "a"}, {"patient_id": "b"}]
+    assert rest == [{"patient_id": "c"}, {"patient_id": "d"}]
+
+
+def test_samples_out_of_order(storage):
+    _add(storage, "p")
+    assert storage.add_hr("p", 80, "2018-11-16T10:00:05Z", False)
+    assert storage.add_hr("p", 150, "2018-11-16T10:00:01Z", True)
+    assert not storage.add_hr("q", 80, "2018-11-16T10:00:05Z")
+    assert storage.add_hr_batch([("p", 70, "2018-11-16T10:00:03Z"),
+                                 ("q", 70, "2018-11-16T10:00:03Z")]) == {"p"}
+
+    stats = storage.get_stats("p")
+    assert (stats["count"], stats["min"], stats["max"]) == (3, 70, 150)
+    assert stats["mean"] == 100
+    # the latest sample wins, not the latest posted
+    assert stats["last_heart_rate"] == 80
+    assert stats["last_timestamp"] == datetime.datetime(2018, 11, 16, 10, 0, 5)
+    assert stats["last_is_tachycardic"] is False
+
+    _, heart_rates = storage.get_samples("p")
+    assert heart_rates == [150, 70, 80]
+    _, heart_rates = storage.get_samples(
+        "p", since=datetime.datetime(2018, 11, 16, 10, 0, 1),
+        until=datetime.datetime(2018, 11, 16, 10, 0, 5))
+    assert heart_rates == [150, 70]
+    window = storage.get_interval_stats(
+        "p", since=datetime.datetime(2018, 11, 16, 10, 0, 2))
+    assert (window["count"], window["mean"]) == (2, 75)
+
+
+def test_reclassify(storage):
+    _add(storage, "p", user_age=30)
+    storage.add_hr("p", 120, "2018-11-16T10:00:00Z", False)
+    assert storage.reclassify(lambda ages, hrs: np.asarray(hrs) > 100) == (1, 1)
+    assert storage.get_stats("p")["last_is_tachycardic"] is True
+
+
+def test_version(storage):
+    assert storage.get_version("p") is None
+    _add(storage, "p")
+    versions = [storage.get_version("p")]
+    storage.add_hr("p", 80, "2018-11-16T10:00:05Z", False)
+    versions.append(storage.get_version("p"))
+    storage.add_hr_batch([("p", 70, "2018-11-16T10:00:06Z", False)])
+    versions.append(storage.get_version("p"))
+    storage.reclassify(lambda ages, heart_rates: [True] * len(ages))
+    versions.append(storage.get_version("p"))
+    assert len(set(versions)) == 4
+    assert versions == sorted(versions)
+
+    storage.remove_patient("p")
+    _add(storage, "p")
+    assert storage.get_version("p") not in versions
+
+
+def test_downsample(storage):
+    _add(storage, "p")
+    storage.add_hr_batch([("p", 60 + i, "2018-11-16T10:00:{:02d}Z".format(i))
+                          for i in range(20)])
+    starts, counts, sums, mins, maxs = storage.downsample(
+        "p", datetime.timedelta(seconds=10))
+    assert counts.tolist() == [10, 10]
+    assert mins.tolist() == [60, 70] and maxs.tolist() == [69, 79]
+    timestamps, heart_rates = storage.downsample_lttb("p", 5)
+    assert len(heart_rates) == 5 and heart_rates[0] == 60
+
+
+def test_interval_index_rebuild_does_not_block_others():
+    storage = MemoryDatabase()
+    for patient_id in ("slow", "fast"):
+        _add(storage, patient_id)
+        storage.add_hr(patient_id, 80, "2018-11-16T10:00:00Z")
+    reading = threading.Event()
+    release = threading.Event()
+    sample_arrays = storage._sample_arrays
+
+    def blocking_arrays(patient_id, since=None, until=None):
+        if patient_id == "slow":
+            reading.set()
+            release.wait(5)
+        return sample_arrays(patient_id, since, until)
+
+    storage._sample_arrays = blocking_arrays
+    slow = threading.Thread(target=storage.get_interval_stats, args=("slow",))
+    slow.start()
+    assert reading.wait(5)
+    fast = []
+    query = threading.Thread(target=lambda: fast.append(
+        storage.get_interval_stats("fast")))
+    query.start()
+    # answered while the slow patient's index is still being built
+    query.join(2)
+    release.set()
+    assert fast and fast[0]["count"] == 1
+    slow.join()
+    assert storage._index_locks == {}
+
+
+def test_memory_snapshot(tmp_path):
+    path = str(tmp_path / "snapshot.npz")
+    storage = MemoryDatabase(path)
+    _add(storage, "p")
+    _add(storage, "empty")
+    storage.add_hr("p", 90, "2018-11-16T10:00:05Z", False)
+    storage.add_hr("p", 95, "2018-11-16T10:00:01Z", True)
+    storage.snapshot()
+
+    restored = MemoryDatabase(path)
+    assert list(restored.iter_patients()) == list(storage.iter_patients())
+    assert restored.get_stats("p") == storage.get_stats("p")
+    assert restored.get_stats("empty")["count"] == 0
+    assert restored.get_version("p") == storage.get_version("p")
+
+
+def test_memory_snapshot_at_exit_only_by_writer(tmp_path):
+    path = str(tmp_path / "snapshot.npz")
+    storage = MemoryDatabase(path)
+    _add(storage, "p")
+    storage.snapshot()
+    # a forked parent holding a copy it never wrote to leaves it alone
+    parent = MemoryDatabase(path)
+    storage.add_hr("p", 90, "2018-11-16T10:00:05Z", False)
+    storage.snapshot_at_exit()
+    parent.snapshot_at_exit()
+    assert MemoryDatabase(path).get_stats("p")["count"] == 1
+
+
+def test_sqlite_survives_restart(tmp_path):
+    path = str(tmp_path / "hrs.sqlite3")
+    storage = SQLiteDatabase(path)
+    _add(storage, "p")
+    storage.add_hr_batch([("p", 60 + i, "2018-11-16T10:00:{:02d}Z".format(i), i == 9)
+                          for i in range(10)])
+    storage.close()
+
+    restored = SQLiteDatabase(path)
+    assert restored.get_samples("p")[1] == list(range(60, 70))
+    assert restored.get_stats("p") == storage.get_stats("p")
+    assert restored.get_stats("p")["last_is_tachycardic"] is True
+
+
+def test_sqlite_adds_version_column(tmp_path):
+    path = str(tmp_path / "hrs.sqlite3")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE patients (patient_id TEXT PRIMARY KEY, "
+                 "attending_email TEXT, user_age INTEGER, "
+                 "sample_count INTEGER NOT NULL DEFAULT 0)")
+    conn.execute("INSERT INTO patients VALUES ('old', 'a@duke.edu', 30, 0)")
+    conn.commit()
+    conn.close()
+    assert SQLiteDatabase(path).get_version("old") == 0
+
+
+def test_make_storage(monkeypatch):
+    monkeypatch.setenv("HRS_STORAGE", "memory")
+    assert isinstance(make_storage({}), MemoryDatabase)
+    monkeypatch.setenv("HRS_STORAGE", "redis")
+    with pytest.raises(ValueError):
+        make_storage({})
@@ -0,0 +1,37 @@
+import pytest
+import datetime
+from hrs_time import parse_timestamp, format_timestamp
+
+
+@pytest.mark.parametrize("timestamp, expect", [
+    ("2018-11-16 10:23:45.123456", datetime.datetime(2018, 11, 16, 10, 23, 45, 123456)),
+    ("2018-11-16T10:23:45", datetime.datetime(2018, 11, 16, 10, 23, 45)),
+    ("2018-11-16T10:23:45Z", datetime.datetime(2018, 11, 16, 10, 23, 45)),
+    ("2018-11-16T10:23:45.5+02:00", datetime.datetime(2018, 11, 16, 8, 23, 45, 500000)),
+    ("2018-11-16T10:23:45-0530", datetime.datetime(2018, 11, 16, 15, 53, 45)),
+    ("2018-11-16", datetime.datetime(2018, 11, 16)),
+    ("Fri, 16 Nov 2018 10:23:45 GMT", datetime.datetime(2018, 11, 16, 10, 23, 45)),
+])
+def test_parse_timestamp(timestamp, expect):
+    assert parse_timestamp(timestamp) == expect
+
+
+@pytest.mark.parametrize("timestamp, error", [
+    ("yesterday", ValueError),
+    ("2018-13-16T10:23:45", ValueError),
+    # in range as written, out of range in UTC
+    ("0001-01-01T00:00:00+01:00", ValueError),
+    ("9999-12-31T23:59:59-01:00", ValueError),
+    (datetime.datetime(1, 1, 1, tzinfo=datetime.timezone(
+        datetime.timedelta(hours=1))), ValueError),
+    (20181116, TypeError),
+])
+def test_parse_timestamp_bad(timestamp, error):
+    with pytest.raises(error):
+        parse_timestamp(timestamp)
+
+
+def test_format_timestamp_round_trip():
+    timestamp = datetime.datetime(2018, 11, 16, 10, 23, 45, 123456)
+    assert format_timestamp(timestamp) == "2018-11-16T10:23:45.123456+00:00"
+    assert parse_timestamp(format_timestamp(timestamp)) == timestamp
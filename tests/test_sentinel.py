@@ -3,7 +3,8 @@ import pytest
 import datetime
 from random import choice
 from string import ascii_uppercase
-from heart_rate_sentinel_server import get_app
+import heart_rate_sentinel_server
+from heart_rate_sentinel_server import get_app, create_app
 
 
 def _new_patient_id():
@@ -55,12 +56,145 @@ def heart_rate_p2():
     return payload
 
 
+def test_create_app(monkeypatch):
+    monkeypatch.setenv("HRS_STORAGE", "memory")
+    monkeypatch.setattr(heart_rate_sentinel_server, "patients", None)
+    monkeypatch.setattr(heart_rate_sentinel_server, "alerts", None)
+    monkeypatch.setattr(heart_rate_sentinel_server, "metrics", None)
+    app = create_app({"storage": "memory", "alert_workers": 1})
+    assert heart_rate_sentinel_server.alerts.workers == 1
+    client = app.test_client()
+    client.post('/api/new_patient', json={"patient_id": "created",
+                                          "attending_email": "a@duke.edu",
+                                          "user_age": 30})
+    assert list(client.get('/api/all_patients').json) == ["created"]
+
+
+def test_get_storage_metrics(flask_app):
+    client = flask_app.test_client()
+    assert "backend" in client.get('/api/storage/metrics').json
+
+
+def test_get_metrics(flask_app, patient_1_info):
+    from heart_rate_sentinel_server import metrics
+    client = flask_app.test_client()
+    p_id = _new_patient_id()
+    client.post('/api/new_patient', json=dict(patient_1_info, patient_id=p_id))
+    labels = ("GET", "/api/status/<patient_id>")
+    count = metrics.request_seconds.count(labels)
+    client.get('/api/status/{}'.format(p_id))
+    assert metrics.request_seconds.count(labels) == count + 1
+    assert metrics.storage_seconds.count(("get_version", "ok")) > 0
+
+    resp = client.get('/metrics')
+    assert resp.content_type.startswith("text/plain")
+    text = resp.data.decode()
+    assert 'hrs_requests_total{method="GET",route="/api/status/<patient_id>",' \
+        'status="200"}' in text
+    assert "hrs_requests_in_flight 1" in text
+    assert 'hrs_alerts_total{event="sent"}' in text
+
+
+def test_get_heart_rate_too_large_to_cache(monkeypatch, flask_app,
+                                           patient_1_info):
+    monkeypatch.setattr(heart_rate_sentinel_server, "responses",
+                        heart_rate_sentinel_server._make_responses(
+                            {"response_cache_entry_bytes": 16}))
+    responses = heart_rate_sentinel_server.responses
+    p_id = _new_patient_id()
+    patient_1_info["patient_id"] = p_id
+    client = flask_app.test_client()
+    client.post('/api/new_patient', json=patient_1_info)
+    client.post('/api/heart_rate/batch', json={"records": [
+        {"patient_id": p_id, "heart_rate": 80} for _ in range(10)]})
+    url = "/api/heart_rate/{}".format(p_id)
+    first = client.get(url)
+    assert client.get(url).data == first.data
+    assert "ETag" in first.headers
+    metrics = responses.metrics()
+    assert (metrics["size"], metrics["oversized"]) == (0, 2)
+    client.get("/api/heart_rate/average/{}".format(p_id))
+    assert responses.metrics()["size"] == 1
+
+
+def test_profiles(monkeypatch, tmp_path):
+    monkeypatch.setenv("HRS_STORAGE", "memory")
+    for name in ("config_info", "metrics", "profiler", "alerts", "patients",
+                 "responses"):
+        monkeypatch.setattr(heart_rate_sentinel_server, name, None)
+    app = create_app({"storage": "memory", "profile_dir": str(tmp_path),
+                      "profile_token": "secret"})
+    client = app.test_client()
+    client.post('/api/new_patient', json={"patient_id": "profiled",
+                                          "attending_email": "a@duke.edu",
+                                          "user_age": 30})
+    header = {"X-HRS-Profile": "secret"}
+    client.get('/api/status/profiled', headers=header)
+    assert client.get('/api/admin/profiles').json["status_code"] == 403
+
+    [entry] = client.get('/api/admin/profiles', headers=header).json
+    assert entry["route"] == "/api/status/<patient_id>"
+    assert entry["requests"] == 1
+    report = client.get('/api/admin/profiles/{}'.format(entry["name"]),
+                        headers=header).data.decode()
+    assert "get_status" in report
+    resp = client.get('/api/admin/profiles/{}?sort=nope'.format(
+        entry["name"]), headers=header)
+    assert resp.json["status_code"] == 400
+    assert client.delete('/api/admin/profiles', headers=header).json == []
+
+    # without a token nobody may profile or read profiles
+    app = create_app({"storage": "memory", "profile_dir": str(tmp_path)})
+    client = app.test_client()
+    client.get('/api/status/profiled', headers=header)
+    resp = client.get('/api/admin/profiles', headers=header)
+    assert resp.json["status_code"] == 404
+    assert list(tmp_path.iterdir()) == []
+
+
 def test_post_new_patient(flask_app, patient_1_info):
     client = flask_app.test_client()
     resp = client.post('/api/new_patient', json=patient_1_info)
     assert resp.status_code == 200
 
 
+def test_get_all_pages(flask_app, patient_1_info):
+    client = flask_app.test_client()
+    for _ in range(3):
+        new_patient = dict(patient_1_info, patient_id=_new_patient_id())
+        client.post('/api/new_patient', json=new_patient)
+    everything = client.get('/api/all_patients').json
+
+    seen = []
+    cursor = None
+    while True:
+        url = '/api/all_patients?limit=2&fields=user_age'
+        if cursor is not None:
+            url += '&cursor={}'.format(cursor)
+        page = client.get(url).json
+        assert all(set(p) == {"patient_id", "user_age"} for p in page["patients"])
+        seen += [p["patient_id"] for p in page["patients"]]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert seen == sorted(everything)
+
+
+def test_get_all_ndjson(flask_app):
+    client = flask_app.test_client()
+    everything = client.get('/api/all_patients').json
+    resp = client.get('/api/all_patients?format=ndjson&fields=patient_id')
+    rows = [json.loads(line) for line in resp.data.decode().splitlines()]
+    assert [row["patient_id"] for row in rows] == sorted(everything)
+
+
+@pytest.mark.parametrize("query", ["limit=0", "limit=x", "fields=password", "format=xml"])
+def test_get_all_bad_query(flask_app, query):
+    client = flask_app.test_client()
+    resp = client.get('/api/all_patients?' + query)
+    assert resp.json["error_type"] == "ValueError"
+
+
 def test_post_new_patient_no_id(flask_app, patient_1_info):
     client = flask_app.test_client()
     patient = {
@@ -144,6 +278,54 @@ def test_post_heart_rate_no_hr(flask_app, patient_1_info, heart_rate_p1):
     assert resp.json["error_type"] == "AttributeError"
 
 
+def test_post_heart_rate_batch(flask_app, patient_1_info):
+    p_id = _new_patient_id()
+    new_patient = patient_1_info
+    new_patient["patient_id"] = p_id
+    client = flask_app.test_client()
+    client.post('/api/new_patient', json=new_patient)
+    payload = {"records": [
+        {"patient_id": p_id, "heart_rate": 80},
+        {"patient_id": p_id, "heart_rate": "80"},
+        {"patient_id": _new_patient_id(), "heart_rate": 80},
+        {"heart_rate": 80},
+        {"patient_id": p_id, "heart_rate": 90, "timestamp": "2018-11-16 10:00:00.000000"},
+        {"patient_id": p_id, "heart_rate": -1},
+        {"patient_id": p_id, "heart_rate": 70, "timestamp": "yesterday"},
+        {"patient_id": p_id, "heart_rate": 301},
+        {"patient_id": p_id, "heart_rate": 2 ** 62},
+        {"patient_id": p_id, "heart_rate": 2 ** 70},
+    ]}
+    resp = client.post('/api/heart_rate/batch', json=payload)
+    assert resp.json["accepted"] == 2
+    assert resp.json["is_tachycardic"] == \
+        [False, None, None, None, False, None, None, None, None, None]
+    assert [(e["index"], e["error_type"]) for e in resp.json["errors"]] == \
+        [(1, "TypeError"), (2, "ValueError"), (3, "AttributeError"),
+         (5, "ValueError"), (6, "ValueError"), (7, "ValueError"),
+         (8, "ValueError"), (9, "ValueError")]
+    resp = client.get("/api/heart_rate/{}".format(p_id))
+    assert resp.json == [90, 80]
+
+
+@pytest.mark.parametrize("heart_rate", [301, 2 ** 62, 2 ** 70])
+def test_post_heart_rate_too_high(flask_app, patient_1_info, heart_rate):
+    p_id = _new_patient_id()
+    client = flask_app.test_client()
+    client.post('/api/new_patient', json=dict(patient_1_info, patient_id=p_id))
+    resp = client.post('/api/heart_rate', json={"patient_id": p_id,
+                                                "heart_rate": heart_rate})
+    assert resp.json["status_code"] == 400
+    assert resp.json["error_type"] == "ValueError"
+    assert client.get("/api/heart_rate/{}".format(p_id)).json == []
+
+
+def test_post_heart_rate_batch_no_records(flask_app):
+    client = flask_app.test_client()
+    resp = client.post('/api/heart_rate/batch', json={})
+    assert resp.json["error_type"] == "AttributeError"
+
+
 def test_get_interval_average(flask_app, patient_1_info, heart_rate_p1):
     client = flask_app.test_client()
     new_patient = patient_1_info
@@ -193,6 +375,38 @@ def test_get_interval_average_no_time(flask_app, patient_1_info, heart_rate_p1):
     assert resp.json["error_type"] == "AttributeError"
 
 
+def test_get_interval_average_out_of_range(flask_app, patient_1_info):
+    p_id = _new_patient_id()
+    client = flask_app.test_client()
+    client.post('/api/new_patient', json=dict(patient_1_info, patient_id=p_id))
+    payload = {"patient_id": p_id,
+               "heart_rate_average_since": "0001-01-01T00:00:00+01:00"}
+    resp = client.post('/api/heart_rate/interval_average', json=payload)
+    assert resp.json["status_code"] == 400
+    assert resp.json["error_type"] == "ValueError"
+
+
+def test_get_interval_stats(flask_app, patient_1_info):
+    p_id = _new_patient_id()
+    new_patient = patient_1_info
+    new_patient["patient_id"] = p_id
+    client = flask_app.test_client()
+    client.post('/api/new_patient', json=new_patient)
+    records = [{"patient_id": p_id, "heart_rate": hr,
+                "timestamp": "2018-11-16T10:{:02d}:00+00:00".format(minute)}
+               for minute, hr in [(0, 70), (10, 90), (20, 110), (30, 60)]]
+    client.post('/api/heart_rate/batch', json={"records": records})
+    payload = {
+        "patient_id": p_id,
+        "since": "2018-11-16T10:05:00Z",
+        "until": "2018-11-16T10:30:00Z",
+    }
+    resp = client.post('/api/heart_rate/interval_stats', json=payload)
+    assert resp.json["count"] == 2
+    assert resp.json["mean"] == 100
+    assert (resp.json["min"], resp.json["max"]) == (90, 110)
+
+
 def test_get_status(flask_app, patient_1_info, heart_rate_p1):
     client = flask_app.test_client()
     new_patient = patient_1_info
@@ -207,6 +421,24 @@ def test_get_status(flask_app, patient_1_info, heart_rate_p1):
     assert resp.status_code == 200
 
 
+def test_post_heart_rate_tachycardic_alerts(flask_app, patient_2_info, heart_rate_p2):
+    from heart_rate_sentinel_server import alerts
+    client = flask_app.test_client()
+    p_id = _new_patient_id()
+    patient_2_info["patient_id"] = p_id
+    heart_rate_p2["patient_id"] = p_id
+    client.post('/api/new_patient', json=patient_2_info)
+    resp = client.post('/api/heart_rate', json=heart_rate_p2)
+    assert resp.json["is_tachycardic"] is True
+    resp = client.get('/api/status/{}'.format(p_id))
+    assert resp.json[0] is True
+
+    alerts.flush()
+    content = "Patient with ID {} is tachychardic.".format(p_id)
+    assert ("random@duke.edu", "Patient Tachychardic", content) in \
+        alerts.sender.sent
+
+
 def test_get_heart_rate(flask_app, patient_1_info, heart_rate_p1):
     client = flask_app.test_client()
     new_patient = patient_1_info
@@ -220,6 +452,161 @@ def test_get_heart_rate(flask_app, patient_1_info, heart_rate_p1):
     assert resp.status_code == 200
 
 
+def test_get_heart_rate_etag(flask_app, patient_1_info):
+    from heart_rate_sentinel_server import responses
+    p_id = _new_patient_id()
+    patient_1_info["patient_id"] = p_id
+    client = flask_app.test_client()
+    client.post('/api/new_patient', json=patient_1_info)
+    client.post('/api/heart_rate', json={"patient_id": p_id, "heart_rate": 80})
+    for url in ("/api/heart_rate/{}", "/api/heart_rate/average/{}",
+                "/api/status/{}"):
+        url = url.format(p_id)
+        first = client.get(url)
+        etag = first.headers["ETag"]
+        hits = responses.metrics()["hits"]
+        assert client.get(url).data == first.data
+        assert responses.metrics()["hits"] == hits + 1
+
+        resp = client.get(url, headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+        assert resp.headers["ETag"] == etag
+
+    client.post('/api/heart_rate', json={"patient_id": p_id, "heart_rate": 90})
+    resp = client.get("/api/heart_rate/{}".format(p_id),
+                      headers={"If-None-Match": etag})
+    assert resp.status_code == 200
+    assert resp.headers["ETag"] != etag
+    assert resp.json == [80, 90]
+    assert "ETag" not in client.get("/api/heart_rate/nobody").headers
+
+
+def test_get_heart_rate_pages(flask_app, patient_1_info):
+    p_id = _new_patient_id()
+    new_patient = patient_1_info
+    new_patient["patient_id"] = p_id
+    client = flask_app.test_client()
+    client.post('/api/new_patient', json=new_patient)
+    # two samples share a timestamp and the range spans two buckets
+    times = ["2018-11-16T09:59:00", "2018-11-16T10:00:00", "2018-11-16T10:00:00",
+             "2018-11-16T10:30:00", "2018-11-16T11:00:00"]
+    client.post('/api/heart_rate/batch', json={"records": [
+        {"patient_id": p_id, "heart_rate": 60 + i, "timestamp": t}
+        for i, t in enumerate(times)]})
+
+    url = '/api/heart_rate/{}?since=2018-11-16T10:00:00Z&until=2018-11-16T11:00:00Z'
+    resp = client.get(url.format(p_id)).json
+    assert resp["records"] == [
+        {"timestamp": "2018-11-16T10:00:00+00:00", "heart_rate": 61},
+        {"timestamp": "2018-11-16T10:00:00+00:00", "heart_rate": 62},
+        {"timestamp": "2018-11-16T10:30:00+00:00", "heart_rate": 63}]
+    assert resp["next_cursor"] is None
+
+    seen = []
+    cursor = None
+    while True:
+        url = '/api/heart_rate/{}?limit=1'.format(p_id)
+        if cursor is not None:
+            url += '&cursor={}'.format(cursor)
+        page = client.get(url).json
+        seen += [r["heart_rate"] for r in page["records"]]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert seen == [60, 61, 62, 63, 64]
+
+    resp = client.get('/api/heart_rate/{}?format=ndjson'.format(p_id))
+    rows = [json.loads(line) for line in resp.data.decode().splitlines()]
+    assert [row["heart_rate"] for row in rows] == [60, 61, 62, 63, 64]
+
+
+@pytest.mark.parametrize("query", [
+    "limit=0", "since=yesterday", "cursor=x", "format=xml",
+    "since=9999-12-31T23:59:59-01:00", "cursor=99999999999999999999-1"])
+def test_get_heart_rate_bad_query(flask_app, patient_1_info, query):
+    p_id = _new_patient_id()
+    new_patient = patient_1_info
+    new_patient["patient_id"] = p_id
+    client = flask_app.test_client()
+    client.post('/api/new_patient', json=new_patient)
+    resp = client.get('/api/heart_rate/{}?{}'.format(p_id, query))
+    assert resp.json["error_type"] == "ValueError"
+
+
+def test_get_downsampled(flask_app, patient_1_info):
+    p_id = _new_patient_id()
+    new_patient = patient_1_info
+    new_patient["patient_id"] = p_id
+    client = flask_app.test_client()
+    client.post('/api/new_patient', json=new_patient)
+    start = datetime.datetime(2018, 11, 16, 9, 50)
+    samples = [(start + datetime.timedelta(seconds=17 * i), 60 + i % 50)
+               for i in range(200)]
+    for i in range(0, 200, 50):
+        client.post('/api/heart_rate/batch', json={"records": [
+            {"patient_id": p_id, "heart_rate": hr, "timestamp": t.isoformat()}
+            for t, hr in samples[i:i + 50]]})
+
+    # 3600 and 60 are answered from the rollups, 90 from the samples
+    for width in (3600, 60, 90):
+        resp = client.get('/api/heart_rate/downsample/{}?width={}'.format(
+            p_id, width)).json
+        expect = {}
+        for t, hr in samples:
+            key = int(t.replace(tzinfo=datetime.timezone.utc).timestamp()) // width
+            expect.setdefault(key, []).append(hr)
+        assert resp["width"] == width
+        assert [(b["count"], b["mean"], b["min"], b["max"])
+                for b in resp["buckets"]] == \
+            [(len(v), sum(v) / len(v), min(v), max(v))
+             for _, v in sorted(expect.items())]
+
+    url = '/api/heart_rate/downsample/{}?since=2018-11-16T10:00:00Z' \
+          '&until=2018-11-16T10:30:00Z&points=10'
+    resp = client.get(url.format(p_id)).json
+    assert resp["width"] == 180
+    assert sum(b["count"] for b in resp["buckets"]) == \
+        sum(1 for t, _ in samples if 10 <= t.hour and t.minute < 30)
+
+    resp = client.get(url.format(p_id) + '&method=lttb').json
+    assert len(resp["records"]) == 10
+    assert resp["records"][0]["timestamp"] == "2018-11-16T10:00:12+00:00"
+
+
+def test_get_downsampled_without_window(flask_app, patient_1_info):
+    p_id = _new_patient_id()
+    new_patient = patient_1_info
+    new_patient["patient_id"] = p_id
+    client = flask_app.test_client()
+    client.post('/api/new_patient', json=new_patient)
+    start = datetime.datetime(2018, 11, 16)
+    client.post('/api/heart_rate/batch', json={"records": [
+        {"patient_id": p_id, "heart_rate": 60 + i % 40,
+         "timestamp": (start + datetime.timedelta(hours=i)).isoformat()}
+        for i in range(7 * 24)]})
+
+    # a week split into 10 points, not into minutes
+    url = '/api/heart_rate/downsample/{}?points=10'.format(p_id)
+    resp = client.get(url).json
+    assert resp["width"] == 17 * 3600
+    assert len(resp["buckets"]) <= 11
+    assert sum(b["count"] for b in resp["buckets"]) == 7 * 24
+    resp = client.get(url + '&since=2018-11-22T00:00:00Z').json
+    assert resp["width"] == 3 * 3600
+    assert sum(b["count"] for b in resp["buckets"]) == 24
+
+
+@pytest.mark.parametrize("query", ["points=2", "width=0", "width=x", "method=median"])
+def test_get_downsampled_bad_query(flask_app, patient_1_info, query):
+    p_id = _new_patient_id()
+    new_patient = patient_1_info
+    new_patient["patient_id"] = p_id
+    client = flask_app.test_client()
+    client.post('/api/new_patient', json=new_patient)
+    resp = client.get('/api/heart_rate/downsample/{}?{}'.format(p_id, query))
+    assert resp.json["error_type"] == "ValueError"
+
+
 def test_get_average(flask_app, patient_1_info, heart_rate_p1):
     client = flask_app.test_client()
     new_patient = patient_1_info
@@ -250,6 +637,51 @@ def test__is_tachychardic(age, hr, expect):
     assert _is_tachychardic(age, hr) == expect
 
 
+@pytest.mark.parametrize("timestamp, expect", [
+    ("2018-11-16 10:23:45.123456", True),
+    ("2018-11-16 10:23:45", True),
+    ("2018-11-16T10:23:45.123+05:00", True),
+    ("yesterday", False),
+    (20181116, False),
+])
+def test__is_valid_timestamp(timestamp, expect):
+    from heart_rate_sentinel_server import _is_valid_timestamp
+    assert _is_valid_timestamp(timestamp) == expect
+
+
+@pytest.mark.parametrize("payload, expect", [
+    ({"ages": [1, 3, 17, 0], "heart_rates": [190, 130, 120, 300]},
+     [True, False, True, False]),
+    ({"ages": [1, 3], "heart_rates": [190]}, "ValueError"),
+    ({"ages": [1.5], "heart_rates": [190]}, "TypeError"),
+    ({"ages": [1]}, "AttributeError"),
+])
+def test_post_classify(flask_app, payload, expect):
+    client = flask_app.test_client()
+    resp = client.post('/api/tachycardia/classify', json=payload)
+    if isinstance(expect, list):
+        assert resp.json == expect
+    else:
+        assert resp.json["error_type"] == expect
+
+
+def test_post_reevaluate_status(flask_app, monkeypatch):
+    client = flask_app.test_client()
+    resp = client.post('/api/status/reevaluate')
+    assert resp.json["status_code"] == 404
+
+    monkeypatch.setattr(heart_rate_sentinel_server, "config_info",
+                        {"admin_token": "secret"})
+    resp = client.post('/api/status/reevaluate')
+    assert resp.json["status_code"] == 403
+    resp = client.post('/api/status/reevaluate',
+                       headers={"X-HRS-Admin": "guess"})
+    assert resp.json["status_code"] == 403
+    resp = client.post('/api/status/reevaluate',
+                       headers={"X-HRS-Admin": "secret"})
+    assert resp.json["changed"] == 0
+
+
 @pytest.mark.parametrize("email, expect", [
     ("test@gmail.com", True),
     ("testgmail.com", False),
@@ -272,6 +704,9 @@ def test__is_valid_age(age, expect):
 
 @pytest.mark.parametrize("heart_rate, expect", [
     (123, True),
+    (300, True),
+    (301, False),
+    (2 ** 70, False),
     (123.4, False),
     (-345, False),
     ("test", False),